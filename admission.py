@@ -0,0 +1,68 @@
+"""
+admission.py - Admission control for render endpoints
+Each expensive endpoint gets a bounded number of in-flight requests.
+Past the limit new requests are rejected immediately with a Retry-After
+estimated from recent render timings, instead of piling up threads that
+each hold a decoded image and model activations.
+"""
+
+import math
+import threading
+from metrics import metrics
+
+
+class AdmissionRejected(Exception):
+    """Endpoint is saturated - retry after `retry_after` seconds"""
+
+    def __init__(self, endpoint, retry_after, in_flight):
+        super().__init__(f"{endpoint} is busy ({in_flight} requests in flight)")
+        self.endpoint = endpoint
+        self.retry_after = retry_after
+        self.in_flight = in_flight
+
+
+class AdmissionController:
+    """Bounded in-flight count per endpoint with wait estimates"""
+
+    def __init__(self, limits, workers=1, timing_metric='job_seconds', default_service_s=90.0):
+        """
+        Args:
+            limits: Dict endpoint -> max requests queued or running
+            workers: Renders that run in parallel
+            timing_metric: Metric holding recent render durations (seconds)
+            default_service_s: Render duration assumed before any timings exist
+        """
+        self.limits = limits
+        self.workers = max(1, workers)
+        self.timing_metric = timing_metric
+        self.default_service_s = default_service_s
+        self.in_flight = {endpoint: 0 for endpoint in limits}
+        self.lock = threading.Lock()
+
+    def service_time(self):
+        """Median recent render duration"""
+        median = metrics.percentile(self.timing_metric, 50)
+        return median if median is not None else self.default_service_s
+
+    def retry_after(self):
+        """Seconds until a slot is likely to free up"""
+        return max(1, int(math.ceil(self.service_time() / self.workers)))
+
+    def admit(self, endpoint):
+        """Take a slot or raise AdmissionRejected; returns the estimated wait"""
+        with self.lock:
+            current = self.in_flight.get(endpoint, 0)
+            limit = self.limits.get(endpoint)
+            if limit is not None and current >= limit:
+                metrics.incr('admission_rejected', endpoint=endpoint)
+                raise AdmissionRejected(endpoint, self.retry_after(), current)
+            ahead = sum(self.in_flight.values())
+            self.in_flight[endpoint] = current + 1
+            metrics.set_gauge('in_flight', current + 1, endpoint=endpoint)
+        metrics.incr('admission_accepted', endpoint=endpoint)
+        return math.ceil(ahead / self.workers) * self.service_time()
+
+    def release(self, endpoint):
+        with self.lock:
+            self.in_flight[endpoint] = max(0, self.in_flight.get(endpoint, 0) - 1)
+            metrics.set_gauge('in_flight', self.in_flight[endpoint], endpoint=endpoint)
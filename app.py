@@ -3,14 +3,26 @@ Flask Backend API for InterioAI - LOCAL STABLE DIFFUSION VERSION
 100% FREE - Runs on your computer
 """
 
-from flask import Flask, request, jsonify, send_file
+from flask import Flask, request, jsonify, send_file, send_from_directory
 from flask_cors import CORS
-from werkzeug.utils import secure_filename
 import os
-import base64
 from datetime import datetime
 from interioai_complete import InterioAI
+from admission import AdmissionController, AdmissionRejected
+from metrics import metrics
+from single_flight import SingleFlight, StatusTable, request_fingerprint
+from ingest import ingest_upload, IngestError, MAX_UPLOAD_BYTES
+from artifact_store import ArtifactStore
+from image_encoding import negotiate, data_url
+from derived_artifacts import DerivedArtifacts, compose_comparison, comparison_options
+from urllib.parse import urlencode
+from concurrent.futures import ThreadPoolExecutor
+import glob
+import hashlib
+import uuid
 import json
+import time
+import traceback
 
 app = Flask(__name__)
 CORS(app)
@@ -18,16 +30,33 @@ CORS(app)
 # Configuration
 UPLOAD_FOLDER = 'uploads'
 OUTPUT_FOLDER = 'outputs'
-ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg'}
+ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'webp'}
 
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 os.makedirs(OUTPUT_FOLDER, exist_ok=True)
 
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
-app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024
+app.config['MAX_CONTENT_LENGTH'] = MAX_UPLOAD_BYTES + 1024 * 1024
+
+# Uploads and results are stored by content hash; each folder is kept under
+# its quota by a background pass (expired first, then least recently used)
+upload_artifacts = ArtifactStore(UPLOAD_FOLDER, url_prefix='/uploads')
+output_artifacts = ArtifactStore(OUTPUT_FOLDER, url_prefix='/outputs')
+upload_artifacts.start_eviction(1024 * 1024 * 1024, ttl_s=7 * 24 * 3600)
+output_artifacts.start_eviction(1024 * 1024 * 1024, ttl_s=7 * 24 * 3600)
+
+# Comparisons, depth maps and floor plans are built on first GET, then served from disk
+derived = DerivedArtifacts(output_artifacts)
 
 ai_system = None
 
+# Analyses queued or running at once - beyond that: 429 + Retry-After
+admission = AdmissionController({'analyze': 2}, workers=1, timing_metric='analyze_seconds')
+
+# Identical analyses (same photo and preferences, or same Idempotency-Key) run once.
+# Results carry base64 images, so only a few are kept for replay.
+analysis_flights = SingleFlight(ttl=600, max_entries=16)
+
 def init_ai_system():
     """Initialize AI system once"""
     global ai_system
@@ -43,6 +72,45 @@ def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
 
+# Detection, depth and edge maps for uploaded photos run while the user picks preferences
+perception_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix='perception')
+perception_status = StatusTable(ttl=3600, max_entries=1000)  # upload_id -> 'running' / 'ready' / 'failed'
+
+
+def store_upload(stream):
+    """Stream an upload to disk under its content hash; returns (upload_id, path)"""
+    ingested = ingest_upload(stream, app.config['UPLOAD_FOLDER'], max_bytes=MAX_UPLOAD_BYTES)
+    return ingested.upload_id, ingested.path
+
+
+def find_upload(upload_id):
+    """Path of a stored upload, or None"""
+    if not upload_id or not upload_id.isalnum():
+        return None
+    matches = glob.glob(os.path.join(app.config['UPLOAD_FOLDER'], f"upload_{upload_id}.*"))
+    return matches[0] if matches else None
+
+
+def start_perception(upload_id, filepath):
+    """Run the style-independent stages for an upload in the background"""
+    if not perception_status.start(upload_id):
+        return  # already running or ready
+
+    def run():
+        started = time.time()
+        try:
+            init_ai_system()
+            ai_system.perceive(filepath)
+            perception_status.set(upload_id, 'ready')
+            metrics.observe('perception_seconds', time.time() - started)
+            print(f"✅ Pre-analysis ready for upload {upload_id}")
+        except Exception as e:
+            perception_status.set(upload_id, 'failed')
+            print(f"⚠️ Pre-analysis failed for upload {upload_id}: {e}")
+
+    perception_pool.submit(run)
+
+
 @app.route('/api/health', methods=['GET'])
 def health_check():
     """Health check endpoint"""
@@ -54,117 +122,235 @@ def health_check():
     })
 
 
+@app.route('/api/uploads', methods=['POST'])
+def upload_photo():
+    """Store the photo as soon as it is picked and start detection/depth in the background"""
+    if request.mimetype.startswith('image/') or request.mimetype == 'application/octet-stream':
+        # raw image body - streamed straight to disk
+        stream = request.stream
+    else:
+        file = request.files.get('roomPhoto')
+        if not file or file.filename == '':
+            return jsonify({'success': False, 'error': 'No image file uploaded'}), 400
+        if not allowed_file(file.filename):
+            return jsonify({'success': False, 'error': 'Invalid file type. Use PNG, JPG, JPEG or WebP'}), 400
+        stream = file.stream
+
+    try:
+        upload_id, filepath = store_upload(stream)
+    except IngestError as e:
+        metrics.incr('uploads_rejected', status=e.status)
+        return jsonify({'success': False, 'error': str(e)}), e.status
+    start_perception(upload_id, filepath)
+    return jsonify({'success': True, 'upload_id': upload_id,
+                    'perception': perception_status.get(upload_id)}), 201
+
+
+@app.route('/api/uploads/<upload_id>', methods=['GET'])
+def get_upload(upload_id):
+    if not find_upload(upload_id):
+        return jsonify({'success': False, 'error': 'Upload not found'}), 404
+    return jsonify({'success': True, 'upload_id': upload_id,
+                    'perception': perception_status.get(upload_id, 'unknown')}), 200
+
+
+def idempotency_key():
+    """Flight key from the client's Idempotency-Key header, if it sent one - scoped to the caller"""
+    key = request.headers.get('Idempotency-Key', '').strip()
+    return f"analyze:idem:{request.remote_addr}:{key}" if key else None
+
+
+def read_preferences():
+    """User preferences posted with an analysis (plus the negotiated output format)"""
+    return {
+        'room_type': request.form.get('roomType', 'Living Hall').strip(),
+        'style': request.form.get('style', 'Modern').strip(),
+        'palette': request.form.get('palette', '').strip(),
+        'width': request.form.get('width', '5-8'),
+        'length': request.form.get('length', '5-8'),
+        'furniture': request.form.get('furniture', '').strip(),
+        # WebP/JPEG for clients that accept them (?format= overrides), PNG otherwise
+        'format': negotiate(request.headers.get('Accept'), request.values.get('format'))
+    }
+
+
+def request_digest():
+    """Fingerprint of an analysis request body: preferences and photo (its upload id or its bytes)"""
+    photo_id = request.form.get('upload_id')
+    photo = request.files.get('roomPhoto')
+    if not photo_id and photo:
+        digest = hashlib.sha256()
+        for chunk in iter(lambda: photo.stream.read(64 * 1024), b''):
+            digest.update(chunk)
+        photo.stream.seek(0)
+        photo_id = digest.hexdigest()[:32]  # same as the upload id ingest assigns
+    return request_fingerprint(photo_id or '', read_preferences())
+
+
+def idempotency_conflict():
+    """422 for an Idempotency-Key reused with a different request body"""
+    metrics.incr('idempotency_conflicts')
+    return jsonify({'success': False, 'error': 'Idempotency-Key was already used for a different request'}), 422
+
+
 @app.route('/api/analyze', methods=['POST'])
 def analyze_room():
     """Main endpoint to analyze room image with USER PREFERENCES"""
     
+    # A retried request with the same Idempotency-Key is answered from the first one.
+    # Only finished results are replayed here - a retry of a running analysis is
+    # admitted below and attaches to it, instead of waiting before admission.
+    idem_key = idempotency_key()
+    replay = analysis_flights.peek(idem_key, timeout=0) if idem_key else None
+    if replay is not None:
+        replay_digest, replay_data = replay
+        if replay_digest != request_digest():
+            return idempotency_conflict()
+        metrics.incr('renders_avoided', endpoint='analyze')
+        return jsonify(dict(replay_data, deduplicated=True)), 200
+
+    # Reject before reading the upload when the renderer is saturated
+    try:
+        admission.admit('analyze')
+    except AdmissionRejected as rejected:
+        response = jsonify({'success': False, 'error': 'Server busy, please retry later',
+                            'retry_after': rejected.retry_after})
+        response.headers['Retry-After'] = str(rejected.retry_after)
+        return response, 429
+    started = time.time()
+    
     try:
         # Initialize AI system
         init_ai_system()
         
-        # Validate file upload
-        if 'roomPhoto' not in request.files:
-            return jsonify({'error': 'No image file uploaded'}), 400
-        
-        file = request.files['roomPhoto']
-        
-        if file.filename == '':
-            return jsonify({'error': 'No selected file'}), 400
-        
-        if not allowed_file(file.filename):
-            return jsonify({'error': 'Invalid file type. Use PNG, JPG, or JPEG'}), 400
+        # Photo from an earlier /api/uploads call, or uploaded with this request
+        upload_id = request.form.get('upload_id')
+        if upload_id:
+            filepath = find_upload(upload_id)
+            if not filepath:
+                return jsonify({'error': 'Upload not found - upload the photo again'}), 404
+        else:
+            if 'roomPhoto' not in request.files:
+                return jsonify({'error': 'No image file uploaded'}), 400
+            
+            file = request.files['roomPhoto']
+            
+            if file.filename == '':
+                return jsonify({'error': 'No selected file'}), 400
+            
+            if not allowed_file(file.filename):
+                return jsonify({'error': 'Invalid file type. Use PNG, JPG, JPEG or WebP'}), 400
+            
+            try:
+                upload_id, filepath = store_upload(file.stream)
+            except IngestError as e:
+                metrics.incr('uploads_rejected', status=e.status)
+                return jsonify({'success': False, 'error': str(e)}), e.status
         
         # GET USER PREFERENCES FROM FRONTEND
-        room_type = request.form.get('roomType', 'Living Hall').strip()
-        style = request.form.get('style', 'Modern').strip()
-        width_range = request.form.get('width', '5-8')
-        length_range = request.form.get('length', '5-8')
-        palette = request.form.get('palette', '').strip()
-        furniture_pref = request.form.get('furniture', '').strip()
-        
-        # Save uploaded file
-        timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-        filename = secure_filename(f"{timestamp}_{file.filename}")
-        filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-        file.save(filepath)
-        
-        print(f"\n🎨 Processing design request...")
-        print(f"   Room Type: {room_type}")
-        print(f"   Style: {style}")
-        print(f"   Color Palette: {palette}")
-        print(f"   Dimensions: {width_range} x {length_range}")
-        print(f"   API: Local Stable Diffusion (FREE)")
+        preferences = read_preferences()
+        room_type, style, palette = preferences['room_type'], preferences['style'], preferences['palette']
+        width_range, length_range = preferences['width'], preferences['length']
+        furniture_pref, output_format = preferences['furniture'], preferences['format']
+
+        # upload_id is the photo's content hash, so this matches request_digest()
+        digest = request_fingerprint(upload_id, preferences)
+        flight_key = idem_key or digest
+
+        def run_analysis():
+            timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
         
-        # Determine edit strength based on room type
-        edit_strength_map = {
-            'bedroom': 0.75,
-            'kitchen': 0.70,
-            'living hall': 0.80,
-            'living room': 0.80,
-            'bathroom': 0.65,
-            'pooja room': 0.75,
-            'dining room': 0.75,
-            'office': 0.75,
-            'study room': 0.75
-        }
-        edit_strength = edit_strength_map.get(room_type.lower(), 0.75)
+            print(f"\n🎨 Processing design request...")
+            print(f"   Room Type: {room_type}")
+            print(f"   Style: {style}")
+            print(f"   Color Palette: {palette}")
+            print(f"   Dimensions: {width_range} x {length_range}")
+            print(f"   API: Local Stable Diffusion (FREE)")
         
-        # RUN ANALYSIS WITH USER PREFERENCES
-        results = ai_system.analyze_room(
-            image_path=filepath,
-            budget_level='mid-range',
-            estimate_dimensions=True,
-            generate_design=False,
-            edit_image=True,
-            edit_strength=edit_strength,
-            create_comparison=True,
-            user_room_type=room_type,
-            user_style=style,
-            user_palette=palette,
-            user_furniture_prefs=furniture_pref
-        )
+            # Determine edit strength based on room type
+            edit_strength_map = {
+                'bedroom': 0.75,
+                'kitchen': 0.70,
+                'living hall': 0.80,
+                'living room': 0.80,
+                'bathroom': 0.65,
+                'pooja room': 0.75,
+                'dining room': 0.75,
+                'office': 0.75,
+                'study room': 0.75
+            }
+            edit_strength = edit_strength_map.get(room_type.lower(), 0.75)
         
-        # Prepare response
-        response_data = {
-            'success': True,
-            'timestamp': timestamp,
-            'roomType': room_type,
-            'style': style,
-            'palette': palette,
-            'api_provider': 'Local Stable Diffusion',
-            'detectedItems': results.get('detected_objects', []),
-            'suggestedItems': results['analysis']['suggestions']['add_items'][:6],
-            'estimatedCost': results['cost_breakdown']['total'] if results['cost_breakdown'] else 0,
-            'files': {}
-        }
+            # RUN ANALYSIS WITH USER PREFERENCES
+            results = ai_system.analyze_room(
+                image_path=filepath,
+                budget_level='mid-range',
+                estimate_dimensions=True,
+                generate_design=False,
+                edit_image=True,
+                edit_strength=edit_strength,
+                create_comparison=False,
+                user_room_type=room_type,
+                user_style=style,
+                user_palette=palette,
+                user_furniture_prefs=furniture_pref,
+                output_basename=os.path.join(OUTPUT_FOLDER, f"{timestamp}_{upload_id[:12]}_{uuid.uuid4().hex[:6]}"),
+                output_format=output_format
+            )
         
-        # Add dimension info
-        if results.get('dimensions'):
-            response_data['dimensions'] = {
-                'length': round(results['dimensions']['length_m'], 1),
-                'width': round(results['dimensions']['width_m'], 1),
-                'height': round(results['dimensions']['height_m'], 1),
-                'area_sqm': round(results['dimensions']['floor_area_sqm'], 1),
-                'area_sqft': round(results['dimensions']['floor_area_sqft'], 0)
+            # Prepare response
+            response_data = {
+                'success': True,
+                'timestamp': timestamp,
+                'roomType': room_type,
+                'style': style,
+                'palette': palette,
+                'api_provider': 'Local Stable Diffusion',
+                'detectedItems': results.get('detected_objects', []),
+                'suggestedItems': results['analysis']['suggestions']['add_items'][:6],
+                'estimatedCost': results['cost_breakdown']['total'] if results['cost_breakdown'] else 0,
+                'imageFormat': output_format,
+                'files': {}
             }
         
-        # Convert images to base64
-        if results.get('edited_image') and os.path.exists(results['edited_image']):
-            with open(results['edited_image'], 'rb') as f:
-                img_data = base64.b64encode(f.read()).decode('utf-8')
-                response_data['files']['edited_image'] = f"data:image/png;base64,{img_data}"
+            # Add dimension info
+            if results.get('dimensions'):
+                response_data['dimensions'] = {
+                    'length': round(results['dimensions']['length_m'], 1),
+                    'width': round(results['dimensions']['width_m'], 1),
+                    'height': round(results['dimensions']['height_m'], 1),
+                    'area_sqm': round(results['dimensions']['floor_area_sqm'], 1),
+                    'area_sqft': round(results['dimensions']['floor_area_sqft'], 0)
+                }
         
-        if results.get('comparison_image') and os.path.exists(results['comparison_image']):
-            with open(results['comparison_image'], 'rb') as f:
-                img_data = base64.b64encode(f.read()).decode('utf-8')
-                response_data['files']['comparison_image'] = f"data:image/png;base64,{img_data}"
+            # Convert images to base64
+            if results.get('edited_image') and os.path.exists(results['edited_image']):
+                response_data['files']['edited_image'] = data_url(results['edited_image'])
         
-        response_data['files']['original_path'] = filepath
-        response_data['files']['edited_path'] = results.get('edited_image', '')
-        
-        print(f"✅ Analysis complete!")
+            # keep one copy per distinct result under its content hash
+            if results.get('edited_image') and os.path.exists(results['edited_image']):
+                edited_name = output_artifacts.adopt(results['edited_image'])
+                results['edited_image'] = output_artifacts.path(edited_name)
+            else:
+                edited_name = None
+
+            response_data['files']['original_path'] = filepath
+            response_data['files']['edited_path'] = results.get('edited_image', '')
+            response_data['links'] = derived_links(upload_id, filepath, edited_name, results['analysis'])
         
-        return jsonify(response_data), 200
+            print(f"✅ Analysis complete!")
+            return digest, response_data
+
+        (result_digest, response_data), shared = analysis_flights.run(flight_key, run_analysis)
+        if shared and result_digest != digest:
+            return idempotency_conflict()
+        if not shared:
+            # only completed analyses - fast 4xx/429 answers would shorten Retry-After
+            metrics.observe('analyze_seconds', time.time() - started)
+        if shared:
+            metrics.incr('renders_avoided', endpoint='analyze')
+            print(f"♻️  Identical analysis request - reusing the result")
+        return jsonify(dict(response_data, deduplicated=shared)), 200
         
     except Exception as e:
         print(f"❌ Error: {e}")
@@ -174,6 +360,92 @@ def analyze_room():
             'success': False,
             'error': str(e)
         }), 500
+    finally:
+        admission.release('analyze')
+
+
+def derived_links(upload_id, filepath, edited_name, analysis):
+    """Stable URLs of the artifacts built on demand for an analysis"""
+    plan_query = urlencode({'room_type': analysis['room_type'],
+                            'suggested': ','.join(analysis['suggestions']['add_items'])})
+    links = {
+        'depth': f"/api/uploads/{upload_id}/depth",
+        'floor_plan': f"/api/uploads/{upload_id}/floor-plan?view=2d&{plan_query}",
+        'visualization_3d': f"/api/uploads/{upload_id}/floor-plan?view=3d&{plan_query}"
+    }
+    if edited_name:
+        links['comparison'] = f"/api/comparison/{os.path.basename(filepath)}/{edited_name}?layout=side-by-side"
+    return links
+
+
+def derived_response(name):
+    """Serve a derived artifact - its format follows the Accept header"""
+    response = send_from_directory(output_artifacts.root, name, max_age=24 * 3600)
+    response.headers['Vary'] = 'Accept'
+    return response
+
+
+def derived_format():
+    return negotiate(request.headers.get('Accept'), request.args.get('format'))
+
+
+@app.route('/api/comparison/<before>/<after>', methods=['GET'])
+def get_comparison(before, after):
+    """Before/after image: ?layout=side-by-side|slider|thumbnail (&split=0.5 for slider)"""
+    try:
+        layout, options = comparison_options(request.args)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    if not upload_artifacts.exists(before) or not output_artifacts.exists(after):
+        return jsonify({'error': 'Image not found'}), 404
+
+    try:
+        name = derived.get('comparison', [before, after], options, derived_format(),
+                           lambda path: compose_comparison(upload_artifacts.path(before), output_artifacts.path(after),
+                                                           path, layout, options.get('split', 0.5)))
+        return derived_response(name)
+    except Exception as e:
+        traceback.print_exc()
+        return jsonify({'error': str(e)}), 500
+
+
+@app.route('/api/uploads/<upload_id>/depth', methods=['GET'])
+def get_depth_visualization(upload_id):
+    filepath = find_upload(upload_id)
+    if not filepath:
+        return jsonify({'error': 'Upload not found'}), 404
+    try:
+        init_ai_system()
+        name = derived.get('depth', [os.path.basename(filepath)], {}, derived_format(),
+                           lambda path: ai_system.render_depth_visualization(filepath, path))
+        return derived_response(name)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 404
+    except Exception as e:
+        traceback.print_exc()
+        return jsonify({'error': str(e)}), 500
+
+
+@app.route('/api/uploads/<upload_id>/floor-plan', methods=['GET'])
+def get_floor_plan(upload_id):
+    """?view=2d|3d&room_type=...&suggested=sofa,rug,..."""
+    filepath = find_upload(upload_id)
+    if not filepath:
+        return jsonify({'error': 'Upload not found'}), 404
+    view = request.args.get('view', '2d')
+    if view not in ('2d', '3d'):
+        return jsonify({'error': 'view must be 2d or 3d'}), 400
+    room_type = request.args.get('room_type', 'living_room')
+    suggested = [item for item in request.args.get('suggested', '').split(',') if item]
+    options = {'view': view, 'room_type': room_type, 'suggested': suggested}
+    try:
+        init_ai_system()
+        name = derived.get('floor_plan', [os.path.basename(filepath)], options, derived_format(),
+                           lambda path: ai_system.render_floor_plan(filepath, room_type, suggested, path, view))
+        return derived_response(name)
+    except Exception as e:
+        traceback.print_exc()
+        return jsonify({'error': str(e)}), 500
 
 
 @app.route('/api/download/<filename>', methods=['GET'])
@@ -213,6 +485,9 @@ if __name__ == '__main__':
     print("📡 API Endpoints:")
     print("   GET  /api/health")
     print("   POST /api/analyze")
+    print("   GET  /api/comparison/<before>/<after>?layout=side-by-side|slider|thumbnail")
+    print("   GET  /api/uploads/<upload_id>/depth")
+    print("   GET  /api/uploads/<upload_id>/floor-plan?view=2d|3d")
     print("   GET  /api/download/<filename>")
     print("\n" + "="*70 + "\n")
     
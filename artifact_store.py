@@ -0,0 +1,168 @@
+"""
+artifact_store.py - Shared storage for uploads and render outputs
+Render workers write drafts and final renders here and the web tier
+serves them from the same place, so neither needs the other's disk.
+Point every process at the same directory (a shared volume when the
+workers run on other machines).
+Files are named by their content hash, so identical uploads and renders
+are stored once and names never collide. A background eviction pass keeps
+each store under its disk quota: expired files first (TTL), then least
+recently used, skipping anything a saved design still references.
+"""
+
+import hashlib
+import os
+import tempfile
+import threading
+import time
+import traceback
+from metrics import metrics
+
+
+CHUNK_SIZE = 64 * 1024
+
+
+class ArtifactStore:
+    """Content-addressed files under one root directory, served at url_prefix"""
+
+    def __init__(self, root, url_prefix='/output', touch_interval_s=300):
+        self.root = os.path.abspath(root)
+        self.url_prefix = url_prefix.rstrip('/')
+        self.touch_interval_s = touch_interval_s
+        os.makedirs(self.root, exist_ok=True)
+
+    def path(self, name):
+        return os.path.join(self.root, os.path.basename(name))
+
+    def url(self, name):
+        return f"{self.url_prefix}/{os.path.basename(name)}"
+
+    def name_from_url(self, url):
+        """Artifact name for one of this store's URLs, or None"""
+        if not url or not url.startswith(self.url_prefix + '/'):
+            return None
+        name = os.path.basename(url)
+        return name if self.exists(name) else None
+
+    def exists(self, name):
+        return os.path.exists(self.path(name))
+
+    def touch(self, name):
+        """
+        Mark an artifact as used now (drives LRU eviction) - at most once per
+        touch_interval_s, so serving a file does not rewrite its mtime on every GET
+        """
+        path = self.path(name)
+        try:
+            if time.time() - os.path.getmtime(path) >= self.touch_interval_s:
+                os.utime(path)
+        except OSError:
+            pass
+
+    def put_bytes(self, name, data):
+        """Write atomically - readers never see a half-written file; returns the URL"""
+        fd, tmp_path = tempfile.mkstemp(dir=self.root, prefix='.tmp_')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, self.path(name))
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        return self.url(name)
+
+    def put_file(self, name, src_path):
+        with open(src_path, 'rb') as f:
+            return self.put_bytes(name, f.read())
+
+    def put_content(self, data, ext, prefix=''):
+        """Store bytes under their content hash; returns the artifact name"""
+        name = f"{prefix}{hashlib.sha256(data).hexdigest()[:32]}.{ext}"
+        if self.exists(name):
+            self.touch(name)
+            metrics.incr('artifacts_deduplicated')
+        else:
+            self.put_bytes(name, data)
+        return name
+
+    def adopt(self, src_path, prefix=''):
+        """
+        Move a file written elsewhere (e.g. by the renderer) to its content-hash
+        name in this store; returns the artifact name
+        """
+        digest = hashlib.sha256()
+        with open(src_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+                digest.update(chunk)
+        ext = os.path.splitext(src_path)[1].lstrip('.').lower() or 'bin'
+        name = f"{prefix}{digest.hexdigest()[:32]}.{ext}"
+        if self.exists(name):
+            os.remove(src_path)
+            self.touch(name)
+            metrics.incr('artifacts_deduplicated')
+        else:
+            os.replace(src_path, self.path(name))
+        return name
+
+    def usage(self):
+        """(file count, bytes) currently stored"""
+        count = total = 0
+        for entry in os.scandir(self.root):
+            if entry.is_file():
+                count += 1
+                total += entry.stat().st_size
+        return count, total
+
+    def evict(self, quota_bytes, ttl_s=None, pinned=(), min_age_s=3600):
+        """
+        Delete expired files, then least recently used ones until the store
+        fits quota_bytes. Pinned names and files younger than min_age_s
+        (possibly still in use by a running render) are kept.
+        Returns (files removed, bytes freed).
+        """
+        now = time.time()
+        pinned = set(pinned)
+        entries = []
+        total = 0
+        for entry in os.scandir(self.root):
+            if not entry.is_file():
+                continue
+            stat = entry.stat()
+            total += stat.st_size
+            if entry.name.startswith('.') or entry.name in pinned or now - stat.st_mtime < min_age_s:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry.name))
+
+        removed = freed = 0
+        entries.sort()  # least recently used first
+        for last_used, size, name in entries:
+            expired = ttl_s is not None and now - last_used > ttl_s
+            if not expired and total - freed <= quota_bytes:
+                continue
+            try:
+                os.remove(self.path(name))
+            except OSError:
+                continue
+            removed += 1
+            freed += size
+
+        metrics.set_gauge('artifact_store_bytes', total - freed, store=self.url_prefix)
+        if removed:
+            metrics.incr('artifacts_evicted', removed, store=self.url_prefix)
+            print(f"🧹 Evicted {removed} artifact(s), {freed / 1024 / 1024:.1f} MB from {self.root}")
+        return removed, freed
+
+    def start_eviction(self, quota_bytes, ttl_s=None, pinned=None, interval_s=600, min_age_s=3600):
+        """Run evict() every interval_s in a daemon thread; pinned() returns names to keep"""
+        def loop():
+            while True:
+                time.sleep(interval_s)
+                try:
+                    self.evict(quota_bytes, ttl_s, pinned() if pinned else (), min_age_s)
+                except Exception:
+                    traceback.print_exc()
+
+        thread = threading.Thread(target=loop, name=f'evict{self.url_prefix.replace("/", "-")}', daemon=True)
+        thread.start()
+        return thread
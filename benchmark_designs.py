@@ -0,0 +1,94 @@
+"""
+benchmark_designs.py - Design history latency for heavy users
+Seeds a throwaway database with one user owning many designs and times
+loading the whole history (what the API used to do) against keyset pages,
+projected pages and the COUNT-based designs_count.
+
+Usage:
+    python benchmark_designs.py
+    python benchmark_designs.py --designs 50000 --runs 50
+"""
+
+import argparse
+import os
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+
+def percentiles(samples):
+    samples = sorted(samples)
+    return samples[len(samples) // 2], samples[min(len(samples) - 1, int(len(samples) * 0.95))]
+
+
+def timed(label, fn, runs):
+    samples = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - start) * 1000)
+    p50, p95 = percentiles(samples)
+    print(f"   {label:45s} p50 {p50:8.1f} ms   p95 {p95:8.1f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Design history latency benchmark')
+    parser.add_argument('--designs', type=int, default=10000)
+    parser.add_argument('--runs', type=int, default=20)
+    args = parser.parse_args()
+
+    # the backend reads these at import time
+    os.environ['INTERIOAI_DATABASE_URL'] = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'bench.db')
+    os.environ['RENDER_BROKER'] = 'memory://'
+    import user as backend
+    app, db, User, Design = backend.app, backend.db, backend.User, backend.Design
+
+    print(f"\n📊 Seeding 1 user with {args.designs} designs...")
+    with app.app_context():
+        db.create_all()
+        owner = User(name='Bench', email='bench@example.com', password='x')
+        db.session.add(owner)
+        db.session.commit()
+        user_id = owner.id
+        started = datetime.utcnow()
+        db.session.execute(Design.__table__.insert(), [{
+            'user_id': user_id, 'room_type': 'Bedroom', 'style': 'Modern', 'palette': 'neutral',
+            'width': '10', 'length': '12', 'estimated_cost': 50000 + i,
+            'after_artifact': f"after_{i:032x}.webp", 'thumb_artifact': f"thumb_{i:032x}.webp",
+            'created_at': started - timedelta(seconds=i)
+        } for i in range(args.designs)])
+        db.session.commit()
+
+    client = app.test_client()
+    with app.app_context():
+        def full_history():
+            db.session.remove()
+            designs = Design.query.filter_by(user_id=user_id).order_by(Design.created_at.desc()).all()
+            return [d.to_dict() for d in designs]
+
+        def relationship_count():
+            db.session.remove()
+            return len(User.query.get(user_id).designs)
+
+        print("\n⏱️  Before (whole history per request)")
+        timed('all designs: .all() + to_dict()', full_history, args.runs)
+        timed('designs_count: len(user.designs)', relationship_count, args.runs)
+
+    # cursor halfway through the history
+    cursor = None
+    for _ in range(args.designs // 2 // 100):
+        cursor = client.get(f"/api/designs/{user_id}?limit=100&fields=id"
+                            + (f"&cursor={cursor}" if cursor else '')).get_json()['next_cursor']
+
+    print("\n⏱️  After (keyset pages)")
+    timed('first page (20, all fields)', lambda: client.get(f"/api/designs/{user_id}"), args.runs)
+    timed('first page (20, id/room_type/thumbnail)',
+          lambda: client.get(f"/api/designs/{user_id}?fields=id,room_type,thumbnail_url"), args.runs)
+    timed(f"page at row {args.designs // 2}",
+          lambda: client.get(f"/api/designs/{user_id}?cursor={cursor}"), args.runs)
+    timed('GET /api/users/<id> (COUNT designs_count)', lambda: client.get(f"/api/users/{user_id}"), args.runs)
+
+
+# Test
+if __name__ == "__main__":
+    main()
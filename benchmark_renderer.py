@@ -0,0 +1,167 @@
+"""
+benchmark_renderer.py - Latency vs quality for renderer speed-ups
+Renders the same room with a fixed seed under each configuration and
+compares every output against the full-cost baseline.
+
+Usage:
+    python benchmark_renderer.py room.jpg
+    python benchmark_renderer.py room.jpg --rooms bedroom kitchen --out bench.json
+    python benchmark_renderer.py room.jpg --configs cache_2 cache_3 cache_5
+    python benchmark_renderer.py room.jpg --configs tome_0.3 tome_0.5 tome_0.6
+"""
+
+import argparse
+import json
+import os
+import cv2
+import numpy as np
+from PIL import Image
+from image_to_image_renderer import ImageToImageRenderer
+
+
+ROOM_TYPES = ['bedroom', 'kitchen', 'living_room', 'bathroom', 'dining_room', 'office']
+
+# name -> edit_room_image overrides ('baseline' is the reference render)
+CONFIGS = {
+    'baseline': {'control_window': 1.0, 'guidance_cutoff': 1.0},
+    'control_0.5': {'control_window': 0.5, 'guidance_cutoff': 1.0},
+    'control_room': {'guidance_cutoff': 1.0},
+    'cfg_0.75': {'guidance_cutoff': 0.75},
+    'cfg_0.5': {'guidance_cutoff': 0.5},
+    'cache_2': {'cache_interval': 2},
+    'cache_3': {'cache_interval': 3},
+    'cache_5': {'cache_interval': 5},
+    'tome_0.3': {'tome_ratio': 0.3},
+    'tome_0.5': {'tome_ratio': 0.5},
+    'tome_0.6': {'tome_ratio': 0.6},
+    'tier_balanced': {'quality': 'balanced'},
+    'tier_fast': {'quality': 'fast'},
+}
+
+ROOM_ITEMS = {
+    'bedroom': ['bed', 'nightstand', 'wardrobe', 'rug'],
+    'kitchen': ['dining table', 'chairs', 'pendant lights', 'kitchen island'],
+    'living_room': ['sofa', 'coffee table', 'TV stand', 'floor lamp', 'rug'],
+    'bathroom': ['vanity', 'mirror', 'towel rack', 'bath mat'],
+    'dining_room': ['dining table', 'dining chairs', 'sideboard', 'pendant light'],
+    'office': ['desk', 'office chair', 'bookshelf', 'desk lamp'],
+}
+
+
+def psnr(a, b):
+    """Peak signal-to-noise ratio in dB"""
+    mse = np.mean((a.astype(np.float64) - b.astype(np.float64)) ** 2)
+    if mse == 0:
+        return float('inf')
+    return float(10 * np.log10(255.0 ** 2 / mse))
+
+
+def ssim(a, b):
+    """Grayscale SSIM with an 11x11 Gaussian window"""
+    a = cv2.cvtColor(a, cv2.COLOR_RGB2GRAY).astype(np.float64)
+    b = cv2.cvtColor(b, cv2.COLOR_RGB2GRAY).astype(np.float64)
+    c1, c2 = (0.01 * 255) ** 2, (0.03 * 255) ** 2
+
+    mu_a = cv2.GaussianBlur(a, (11, 11), 1.5)
+    mu_b = cv2.GaussianBlur(b, (11, 11), 1.5)
+    var_a = cv2.GaussianBlur(a * a, (11, 11), 1.5) - mu_a ** 2
+    var_b = cv2.GaussianBlur(b * b, (11, 11), 1.5) - mu_b ** 2
+    cov = cv2.GaussianBlur(a * b, (11, 11), 1.5) - mu_a * mu_b
+
+    ssim_map = ((2 * mu_a * mu_b + c1) * (2 * cov + c2)) / \
+               ((mu_a ** 2 + mu_b ** 2 + c1) * (var_a + var_b + c2))
+    return float(ssim_map.mean())
+
+
+def image_similarity(path_a, path_b):
+    """PSNR/SSIM between two renders of the same size"""
+    a = np.array(Image.open(path_a).convert('RGB'))
+    b = Image.open(path_b).convert('RGB')
+    if b.size != (a.shape[1], a.shape[0]):
+        b = b.resize((a.shape[1], a.shape[0]), Image.Resampling.LANCZOS)
+    b = np.array(b)
+    return {'psnr_db': round(psnr(a, b), 2), 'ssim': round(ssim(a, b), 4)}
+
+
+def run_benchmark(renderer, image_path, room_types, configs, seed=42, output_dir='benchmark_output'):
+    """Render every (room type, config) pair and collect metrics"""
+    os.makedirs(output_dir, exist_ok=True)
+    rows = []
+
+    for room_type in room_types:
+        room_data = {
+            'room_type': room_type,
+            'style': 'modern',
+            'palette': 'warm neutral',
+            'suggested_items': ROOM_ITEMS.get(room_type, ['sofa', 'table', 'lamp']),
+            'is_empty': False
+        }
+        baseline_path = None
+
+        for name, overrides in configs.items():
+            output_path = os.path.join(output_dir, f"{room_type}_{name}.png")
+            edited = renderer.edit_room_image(
+                original_image_path=image_path,
+                room_data=room_data,
+                output_path=output_path,
+                seed=seed,
+                **overrides
+            )
+            if not edited:
+                print(f"   ❌ {room_type}/{name} failed")
+                continue
+
+            row = {'room_type': room_type, 'config': name}
+            row.update(renderer.last_metrics)
+            if name == 'baseline':
+                baseline_path = edited
+            if baseline_path:
+                row.update(image_similarity(baseline_path, edited))
+            rows.append(row)
+
+    return rows
+
+
+def print_table(rows):
+    """Print results grouped by room type"""
+    baseline = {r['room_type']: r['latency_s'] for r in rows if r['config'] == 'baseline'}
+
+    print("\n" + "="*106)
+    print(f"{'Room':<14}{'Config':<16}{'Latency':>9}{'Per step':>10}{'Speedup':>9}{'CN steps':>10}"
+          f"{'CFG steps':>11}{'Cache':>6}{'Edges':>8}{'PSNR':>8}{'SSIM':>8}")
+    print("="*106)
+    for r in rows:
+        base = baseline.get(r['room_type'])
+        speedup = f"{base / r['latency_s']:.2f}x" if base and r['latency_s'] else '-'
+        print(f"{r['room_type']:<14}{r['config']:<16}{r['latency_s']:>8.1f}s"
+              f"{r.get('step_latency_s', 0):>9.2f}s{speedup:>9}"
+              f"{r.get('controlnet_steps', 0):>10}{r.get('cfg_steps', 0):>11}{r.get('cache_interval', 1):>6}"
+              f"{r.get('edge_fidelity', 0):>8.3f}{r.get('psnr_db', 0):>8.1f}{r.get('ssim', 0):>8.3f}")
+
+
+# Test
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Renderer latency/quality benchmark')
+    parser.add_argument('image', help='Room photo to render')
+    parser.add_argument('--rooms', nargs='+', default=ROOM_TYPES)
+    parser.add_argument('--configs', nargs='+', default=list(CONFIGS))
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--out', help='Write results as JSON')
+    args = parser.parse_args()
+
+    renderer = ImageToImageRenderer()
+    if not renderer.model_loaded:
+        print("❌ Renderer not loaded")
+        exit(1)
+
+    configs = {name: CONFIGS[name] for name in args.configs}
+    if 'baseline' not in configs:
+        configs = {'baseline': CONFIGS['baseline'], **configs}
+
+    rows = run_benchmark(renderer, args.image, args.rooms, configs, seed=args.seed)
+    print_table(rows)
+
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(rows, f, indent=2)
+        print(f"\n✅ Results saved: {args.out}")
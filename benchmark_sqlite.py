@@ -0,0 +1,113 @@
+"""
+benchmark_sqlite.py - Concurrent write benchmark for the user.py database
+Hammers signup and design saves from many threads against a throwaway
+SQLite file and reports throughput, latency and "database is locked"
+failures, for the default rollback journal with synchronous saves and
+for WAL + busy timeout + write-behind design saves.
+
+Usage:
+    python benchmark_sqlite.py
+    python benchmark_sqlite.py --threads 32 --requests 200
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+CONFIGS = {
+    'rollback journal, sync saves': {'INTERIOAI_SQLITE_WAL': '0', 'INTERIOAI_DESIGN_WRITE_BEHIND': '0'},
+    'WAL, sync saves': {'INTERIOAI_SQLITE_WAL': '1', 'INTERIOAI_DESIGN_WRITE_BEHIND': '0'},
+    'WAL + write-behind saves': {'INTERIOAI_SQLITE_WAL': '1', 'INTERIOAI_DESIGN_WRITE_BEHIND': '1'},
+}
+
+
+def run_load(threads, requests_per_thread):
+    """Runs in a child process configured through the environment; prints a JSON summary"""
+    os.environ['RENDER_BROKER'] = 'memory://'
+    import user as backend
+    app, db = backend.app, backend.db
+    with app.app_context():
+        db.create_all()
+        owner = backend.User(name='Bench', email='owner@example.com', password='x')
+        db.session.add(owner)
+        db.session.commit()
+        owner_headers = {'Authorization': f"Bearer {backend.issue_token(owner)}"}
+
+    latencies, errors = [], []
+    lock = threading.Lock()
+
+    def worker(n):
+        client = app.test_client()
+        for i in range(requests_per_thread):
+            start = time.perf_counter()
+            if i % 10 == 0:
+                response = client.post('/api/auth/signup', json={
+                    'name': f"user{n}_{i}", 'email': f"user{n}_{i}@example.com", 'password': 'secret'})
+            else:
+                response = client.post('/api/designs', headers=owner_headers, json={
+                    'room_type': 'Bedroom', 'style': 'Modern', 'palette': 'neutral',
+                    'width': '10', 'length': '12', 'estimated_cost': i})
+            elapsed = (time.perf_counter() - start) * 1000
+            with lock:
+                latencies.append(elapsed)
+                if response.status_code >= 400:
+                    errors.append(response.get_json().get('error', str(response.status_code)))
+
+    started = time.perf_counter()
+    pool = [threading.Thread(target=worker, args=(n,)) for n in range(threads)]
+    for thread in pool:
+        thread.start()
+    for thread in pool:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    if backend.design_writer is not None:
+        backend.design_writer.close()
+
+    with app.app_context():
+        saved = backend.Design.query.count()
+    latencies.sort()
+    print(json.dumps({
+        'requests': len(latencies), 'seconds': elapsed, 'saved_designs': saved,
+        'p50_ms': latencies[len(latencies) // 2],
+        'p95_ms': latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))],
+        'errors': len(errors), 'locked_errors': sum('locked' in e for e in errors)
+    }))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='SQLite concurrent write benchmark')
+    parser.add_argument('--threads', type=int, default=16)
+    parser.add_argument('--requests', type=int, default=100, help='Requests per thread')
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        run_load(args.threads, args.requests)
+        return
+
+    print(f"\n📊 {args.threads} threads x {args.requests} requests (10% signups, 90% design saves)")
+    for name, env in CONFIGS.items():
+        db_url = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'bench.db')
+        child_env = dict(os.environ, INTERIOAI_DATABASE_URL=db_url, **env)
+        output = subprocess.run(
+            [sys.executable, __file__, '--child', '--threads', str(args.threads), '--requests', str(args.requests)],
+            env=child_env, capture_output=True, text=True
+        )
+        try:
+            result = json.loads(output.stdout.strip().splitlines()[-1])
+        except (IndexError, ValueError):
+            print(f"❌ {name}: benchmark process failed\n{output.stderr[-2000:]}")
+            continue
+        print(f"   {name:30s} {result['requests'] / result['seconds']:7.0f} req/s   "
+              f"p50 {result['p50_ms']:6.1f} ms   p95 {result['p95_ms']:7.1f} ms   "
+              f"errors {result['errors']} ({result['locked_errors']} locked)   saved {result['saved_designs']}")
+
+
+# Test
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,210 @@
+"""
+broker.py - Render job brokers
+The web tier publishes render jobs to a broker and render workers
+(render_worker.py, possibly on other machines) pull them from it.
+Two implementations share one interface:
+  SQLiteBroker - durable, shared through a SQLite file (the JobStore table)
+  MemoryBroker - in-process, for tests and single-process runs
+"""
+
+import copy
+import threading
+import time
+from job_store import JobStore, FINISHED_STATES
+
+
+class Broker:
+    """
+    Interface every broker implements. Job records are dicts with the
+    JobStore columns (id, status, stage, params, user_key, priority, ...).
+    """
+
+    def enqueue(self, job_id, params, user_key=None, priority='normal', quality_tier='quality',
+                created_at=None):
+        raise NotImplementedError
+
+    def claim(self, job_id, owner):
+        """Lease one specific queued job; False if it is gone or taken"""
+        raise NotImplementedError
+
+    def claim_next(self, owner):
+        """Lease the next queued job; its record or None"""
+        raise NotImplementedError
+
+    def heartbeat(self, job_id, owner, **fields):
+        """Renew a lease; False means stop (lease lost or cancel requested)"""
+        raise NotImplementedError
+
+    def finish(self, job_id, status, owner=None, **fields):
+        raise NotImplementedError
+
+    def request_cancel(self, job_id):
+        raise NotImplementedError
+
+    def requeue_expired(self):
+        raise NotImplementedError
+
+    def queued(self, limit=100):
+        raise NotImplementedError
+
+    def get(self, job_id):
+        raise NotImplementedError
+
+    def purge(self):
+        raise NotImplementedError
+
+    def depth(self, user_key=None):
+        raise NotImplementedError
+
+    def counts(self):
+        raise NotImplementedError
+
+
+class SQLiteBroker(JobStore, Broker):
+    """Durable broker: workers on any host that can open the SQLite file share the queue"""
+
+
+class MemoryBroker(Broker):
+    """Same semantics as SQLiteBroker, kept in a dict - nothing survives the process"""
+
+    PRIORITY_RANK = {'high': 0, 'normal': 1, 'low': 2}
+
+    def __init__(self, lease_s=60.0, max_attempts=3, retention_s=7 * 24 * 3600):
+        self.lease_s = lease_s
+        self.max_attempts = max_attempts
+        self.retention_s = retention_s
+        self.records = {}
+        self.lock = threading.Lock()
+
+    def enqueue(self, job_id, params, user_key=None, priority='normal', quality_tier='quality',
+                created_at=None):
+        now = time.time()
+        with self.lock:
+            self.records[job_id] = {
+                'id': job_id, 'status': 'queued', 'stage': 'queued', 'params': copy.deepcopy(params),
+                'user_key': user_key, 'priority': priority, 'quality_tier': quality_tier,
+                'preview_url': None, 'result_url': None, 'error': None, 'attempts': 0,
+                'cancel_requested': 0, 'lease_owner': None, 'lease_expires': None,
+                'created_at': created_at or now, 'started_at': None, 'finished_at': None,
+                'updated_at': now
+            }
+
+    def _lease(self, record, owner):
+        now = time.time()
+        record.update(status='running', lease_owner=owner, lease_expires=now + self.lease_s,
+                      attempts=record['attempts'] + 1, started_at=now, updated_at=now)
+
+    def claim(self, job_id, owner):
+        with self.lock:
+            record = self.records.get(job_id)
+            if record is None or record['status'] != 'queued' or record['cancel_requested']:
+                return False
+            self._lease(record, owner)
+            return True
+
+    def claim_next(self, owner):
+        with self.lock:
+            running = {}
+            for record in self.records.values():
+                if record['status'] == 'running':
+                    running[record['user_key']] = running.get(record['user_key'], 0) + 1
+            queued = [r for r in self.records.values() if r['status'] == 'queued' and not r['cancel_requested']]
+            if not queued:
+                return None
+            record = min(queued, key=lambda r: (self.PRIORITY_RANK.get(r['priority'], 1),
+                                                running.get(r['user_key'], 0), r['created_at']))
+            self._lease(record, owner)
+            return copy.deepcopy(record)
+
+    def heartbeat(self, job_id, owner, **fields):
+        now = time.time()
+        with self.lock:
+            record = self.records.get(job_id)
+            if record is None or record['status'] != 'running' or record['lease_owner'] != owner \
+                    or record['cancel_requested']:
+                return False
+            record.update(fields, lease_expires=now + self.lease_s, updated_at=now)
+            return True
+
+    def finish(self, job_id, status, owner=None, **fields):
+        assert status in FINISHED_STATES
+        now = time.time()
+        with self.lock:
+            record = self.records.get(job_id)
+            if record is None or record['status'] in FINISHED_STATES:
+                return False
+            if owner is not None and record['lease_owner'] != owner:
+                return False
+            record.update(fields, status=status, stage='done', finished_at=now, updated_at=now,
+                          lease_owner=None, lease_expires=None)
+            return True
+
+    def request_cancel(self, job_id):
+        now = time.time()
+        with self.lock:
+            record = self.records.get(job_id)
+            if record is None:
+                return
+            if record['status'] == 'queued':
+                record.update(status='cancelled', stage='done', finished_at=now, updated_at=now)
+            elif record['status'] == 'running':
+                record.update(cancel_requested=1, updated_at=now)
+
+    def requeue_expired(self):
+        now = time.time()
+        requeued = []
+        with self.lock:
+            for record in self.records.values():
+                if record['status'] != 'running' or record['lease_expires'] >= now:
+                    continue
+                release = {'lease_owner': None, 'lease_expires': None, 'updated_at': now}
+                if record['cancel_requested']:
+                    record.update(release, status='cancelled', stage='done', finished_at=now)
+                elif record['attempts'] >= self.max_attempts:
+                    record.update(release, status='failed', stage='done', finished_at=now,
+                                  error=f"Worker lost {record['attempts']} times")
+                else:
+                    record.update(release, status='queued', stage='queued')
+                    requeued.append(record['id'])
+        return requeued
+
+    def queued(self, limit=100):
+        with self.lock:
+            records = sorted((r for r in self.records.values() if r['status'] == 'queued'),
+                             key=lambda r: r['created_at'])
+            return [copy.deepcopy(r) for r in records[:limit]]
+
+    def get(self, job_id):
+        with self.lock:
+            record = self.records.get(job_id)
+            return copy.deepcopy(record) if record else None
+
+    def purge(self):
+        cutoff = time.time() - self.retention_s
+        with self.lock:
+            expired = [job_id for job_id, r in self.records.items()
+                       if r['status'] in FINISHED_STATES and r['finished_at'] < cutoff]
+            for job_id in expired:
+                del self.records[job_id]
+        return len(expired)
+
+    def depth(self, user_key=None):
+        with self.lock:
+            return sum(1 for r in self.records.values()
+                       if r['status'] == 'queued' and (user_key is None or r['user_key'] == user_key))
+
+    def counts(self):
+        with self.lock:
+            counts = {}
+            for record in self.records.values():
+                counts[record['status']] = counts.get(record['status'], 0) + 1
+            return counts
+
+
+def open_broker(url, **kwargs):
+    """'memory://' or 'sqlite:///path/to/render_jobs.db'"""
+    if url.startswith('memory://'):
+        return MemoryBroker(**kwargs)
+    if url.startswith('sqlite:///'):
+        return SQLiteBroker(url[len('sqlite:///'):], **kwargs)
+    raise ValueError(f"Unknown broker URL: {url}")
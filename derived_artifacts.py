@@ -0,0 +1,182 @@
+"""
+derived_artifacts.py - Lazily built derived images
+Before/after comparisons, depth visualizations and floor plans are only
+built when a client first GETs their URL, from source images already in
+the artifact stores. The result is memoized in the store under a name
+derived from its inputs, so later requests (and other processes sharing
+the directory) are served from disk; concurrent first requests build once.
+"""
+
+import hashlib
+import json
+import os
+import time
+import uuid
+from PIL import Image, ImageDraw, ImageFont
+from metrics import metrics
+from single_flight import SingleFlight
+from image_encoding import EXTENSIONS, save_image
+from ingest import load_working_image
+
+
+COMPARISON_LAYOUTS = ('side-by-side', 'slider', 'thumbnail')
+THUMBNAIL_HEIGHT = 160
+
+# Resolution pyramid for gallery listings: level -> (longest side, WebP quality).
+# The full level is the source image itself.
+PYRAMID_LEVELS = {'thumb': (256, 70), 'medium': (1024, 80)}
+
+
+class DerivedArtifacts:
+    """Build-once derived images memoized in an ArtifactStore"""
+
+    def __init__(self, store):
+        self.store = store
+        self.flights = SingleFlight(ttl=60, max_entries=128)
+
+    def name(self, kind, sources, options, fmt):
+        """Stable artifact name for a kind of derivation, its source artifacts and options"""
+        material = json.dumps([kind, list(sources), options, fmt], sort_keys=True)
+        return f"{kind}_{hashlib.sha256(material.encode('utf-8')).hexdigest()[:32]}.{EXTENSIONS[fmt]}"
+
+    def get(self, kind, sources, options, fmt, build):
+        """
+        Artifact name for the derivation, building it first if needed.
+        `sources` are content-addressed artifact names (so they identify the
+        inputs exactly); build(output_path) writes the image in `fmt`.
+        """
+        if fmt == 'avif':
+            fmt = 'webp'  # cv2 and matplotlib builders cannot write AVIF
+        name = self.name(kind, sources, options, fmt)
+        if self.store.exists(name):
+            self.store.touch(name)
+            metrics.incr('derived_artifacts', kind=kind, result='hit')
+            return name
+
+        def run():
+            if self.store.exists(name):
+                return name
+            started = time.time()
+            tmp_path = self.store.path(f".build_{uuid.uuid4().hex}.{EXTENSIONS[fmt]}")
+            try:
+                build(tmp_path)
+                os.replace(tmp_path, self.store.path(name))
+            finally:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+            metrics.observe('derived_build_seconds', time.time() - started, kind=kind)
+            print(f"🧩 Built {kind} {name} in {time.time() - started:.2f}s")
+            return name
+
+        result, shared = self.flights.run(name, run)
+        metrics.incr('derived_artifacts', kind=kind, result='shared' if shared else 'built')
+        return result
+
+
+def _font(size):
+    try:
+        return ImageFont.truetype("arial.ttf", size)
+    except Exception:
+        return ImageFont.load_default()
+
+
+def compose_comparison(original_path, edited_path, output_path, layout='side-by-side', split=0.5):
+    """
+    Before/after image:
+      side-by-side - both images at the same height with BEFORE / AFTER labels
+      slider       - one frame, before left of `split` (0-1), after right of it
+      thumbnail    - small unlabeled side-by-side for listings
+    """
+    original = Image.open(original_path).convert('RGB')
+    edited = Image.open(edited_path).convert('RGB')
+
+    if layout == 'slider':
+        original = original.resize(edited.size, Image.Resampling.LANCZOS)
+        x = int(edited.width * min(max(split, 0.0), 1.0))
+        frame = edited.copy()
+        frame.paste(original.crop((0, 0, x, edited.height)), (0, 0))
+        draw = ImageDraw.Draw(frame)
+        draw.rectangle([x - 2, 0, x + 1, edited.height], fill='white')
+        font = _font(20)
+        draw.text((12, 12), "BEFORE", fill='white', font=font)
+        draw.text((edited.width - 90, 12), "AFTER", fill='white', font=font)
+        return save_image(frame, output_path)
+
+    thumbnail = layout == 'thumbnail'
+    target_height = THUMBNAIL_HEIGHT if thumbnail else min(original.height, edited.height, 800)
+    original_width = int(target_height * original.width / original.height)
+    edited_width = int(target_height * edited.width / edited.height)
+    original_resized = original.resize((original_width, target_height), Image.Resampling.LANCZOS)
+    edited_resized = edited.resize((edited_width, target_height), Image.Resampling.LANCZOS)
+
+    gap = 4 if thumbnail else 20
+    label_height = 0 if thumbnail else 60
+    comparison = Image.new('RGB', (original_width + edited_width + gap, target_height + label_height), 'white')
+    comparison.paste(original_resized, (0, label_height))
+    comparison.paste(edited_resized, (original_width + gap, label_height))
+
+    if not thumbnail:
+        draw = ImageDraw.Draw(comparison)
+        font = _font(24)
+        before_x = original_width // 2 - 50
+        after_x = original_width + gap + edited_width // 2 - 90
+        draw.rectangle([before_x - 10, 10, before_x + 110, 50], fill='#333333')
+        draw.text((before_x, 15), "BEFORE", fill='white', font=font)
+        draw.rectangle([after_x - 10, 10, after_x + 200, 50], fill='#00AA00')
+        draw.text((after_x, 15), "AFTER (AI)", fill='white', font=font)
+
+    return save_image(comparison, output_path)
+
+
+def resize_image(src_path, output_path, max_dim, quality=None):
+    """Downscaled copy with its longest side at most max_dim (JPEGs decode at reduced size)"""
+    image, _ = load_working_image(src_path, max_dim)
+    image.thumbnail((max_dim, max_dim), Image.Resampling.LANCZOS)
+    return save_image(image, output_path, quality=quality)
+
+
+def build_pyramid(derived, source_name, fmt='webp'):
+    """{level: artifact name} for the downscaled levels of an image in derived.store"""
+    source_path = derived.store.path(source_name)
+    names = {}
+    for level, (max_dim, quality) in PYRAMID_LEVELS.items():
+        names[level] = derived.get(level, [source_name], {'max_dim': max_dim, 'quality': quality}, fmt,
+                                   lambda path, d=max_dim, q=quality: resize_image(source_path, path, d, q))
+    return names
+
+
+def comparison_options(args):
+    """(layout, options) from request args; raises ValueError for an unknown layout"""
+    layout = args.get('layout', 'side-by-side')
+    if layout not in COMPARISON_LAYOUTS:
+        raise ValueError(f"layout must be one of {', '.join(COMPARISON_LAYOUTS)}")
+    options = {'layout': layout}
+    if layout == 'slider':
+        options['split'] = round(min(max(float(args.get('split', 0.5)), 0.0), 1.0), 2)
+    return layout, options
+
+
+# Test
+if __name__ == "__main__":
+    import tempfile
+    from artifact_store import ArtifactStore
+
+    store = ArtifactStore(tempfile.mkdtemp(), url_prefix='/output')
+    before_path = store.path('before.png')
+    after_path = store.path('after.png')
+    Image.new('RGB', (640, 480), (120, 110, 100)).save(before_path)
+    Image.new('RGB', (640, 480), (200, 180, 150)).save(after_path)
+    derived = DerivedArtifacts(store)
+
+    for layout in COMPARISON_LAYOUTS:
+        options = {'layout': layout}
+        first = derived.get('comparison', ['before.png', 'after.png'], options, 'webp',
+                            lambda path: compose_comparison(before_path, after_path, path, layout))
+        again = derived.get('comparison', ['before.png', 'after.png'], options, 'webp',
+                            lambda path: 1 / 0)
+        assert first == again
+        print(f"   {layout}: {first} {Image.open(store.path(first)).size}")
+    pyramid = build_pyramid(derived, 'after.png')
+    for level, name in pyramid.items():
+        print(f"   {level}: {name} {Image.open(store.path(name)).size}, {os.path.getsize(store.path(name))} bytes")
+    print(f"✅ Derived artifacts memoized: {metrics.snapshot()['counters']}")
@@ -57,16 +57,7 @@ class CompleteDesignGenerator:
             dict: Paths to generated files
         """
         
-        # Default dimensions if not provided
-        if dimensions:
-            room_dims = (
-                dimensions.get('width_m', 5.0),
-                dimensions.get('length_m', 6.0),
-                dimensions.get('height_m', 3.0)
-            )
-        else:
-            room_dims = (5.0, 6.0, 3.0)
-        
+        room_dims = self.room_dims(dimensions)
         output_files = {}
         
         # Generate 2D floor plan
@@ -99,6 +90,17 @@ class CompleteDesignGenerator:
         
         return output_files
     
+    @staticmethod
+    def room_dims(dimensions=None):
+        """(width, length, height) in meters from estimated dimensions, with defaults"""
+        if dimensions:
+            return (
+                dimensions.get('width_m', 5.0),
+                dimensions.get('length_m', 6.0),
+                dimensions.get('height_m', 3.0)
+            )
+        return (5.0, 6.0, 3.0)
+    
     def generate_2d_floor_plan(self, room_type, current_items, suggested_items, 
                                room_dims, output_path='2d_floor_plan.png'):
         """Generate 2D floor plan"""
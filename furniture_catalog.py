@@ -0,0 +1,174 @@
+"""
+furniture_catalog.py - Furniture catalog loaded once into an immutable index
+The catalog lives in furniture_catalog.json (room -> category -> items).
+Loading it assigns every item a stable id, indexes items by room, category
+and id, and pre-serializes each room's /api/furniture payload - plain and
+gzipped, with an ETag - so requests only pick bytes off a dict.
+CatalogFile reloads the JSON when its mtime changes; requests in flight
+keep the catalog object they started with.
+"""
+
+import gzip
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+from types import MappingProxyType
+
+DEFAULT_ROOM = 'bedroom'
+
+
+def room_key(room_type):
+    """'Living Hall' -> 'living_hall'"""
+    return (room_type or DEFAULT_ROOM).strip().lower().replace(' ', '_')
+
+
+def _slug(text):
+    return re.sub(r'[^a-z0-9]+', '-', str(text).lower()).strip('-')
+
+
+class Payload:
+    """Pre-serialized JSON response body"""
+
+    def __init__(self, data):
+        self.body = json.dumps(data, separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+        self.gzipped = gzip.compress(self.body, compresslevel=9, mtime=0)
+        self.etag = hashlib.sha256(self.body).hexdigest()[:32]
+
+
+class FurnitureCatalog:
+    """Read-only catalog: rooms[room][category] is a tuple of read-only item mappings"""
+
+    def __init__(self, data, version=None):
+        rooms = {}
+        by_id = {}
+        for room, categories in data.items():
+            room = room_key(room)
+            indexed = {}
+            for category, items in categories.items():
+                entries = []
+                for item in items:
+                    # ids survive reordering and price edits; the file may also set them
+                    item_id = item.get('id') or f"{room}.{category}.{_slug(item.get('type'))}.{_slug(item.get('wood'))}"
+                    base_id, n = item_id, 2
+                    while item_id in by_id:
+                        item_id, n = f"{base_id}-{n}", n + 1
+                    entry = MappingProxyType(dict(item, id=item_id, room=room, category=category))
+                    by_id[item_id] = entry
+                    entries.append(entry)
+                indexed[category] = tuple(entries)
+            rooms[room] = MappingProxyType(indexed)
+        if DEFAULT_ROOM not in rooms:
+            raise ValueError(f"Catalog has no '{DEFAULT_ROOM}' room")
+
+        self.rooms = MappingProxyType(rooms)
+        self.by_id = MappingProxyType(by_id)
+        self.version = version
+        self.payloads = MappingProxyType({
+            room: Payload({'success': True, 'furniture': {
+                category: [{k: v for k, v in item.items() if k not in ('room', 'category')} for item in items]
+                for category, items in categories.items()
+            }})
+            for room, categories in rooms.items()
+        })
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'rb') as f:
+            raw = f.read()
+        return cls(json.loads(raw), version=hashlib.sha256(raw).hexdigest()[:12])
+
+    def resolve_room(self, room_type):
+        """Catalog room for a room type - unknown rooms fall back to the bedroom"""
+        key = room_key(room_type)
+        return key if key in self.rooms else DEFAULT_ROOM
+
+    def room(self, room_type):
+        return self.rooms[self.resolve_room(room_type)]
+
+    def payload(self, room_type):
+        return self.payloads[self.resolve_room(room_type)]
+
+    def item(self, room_type, category, index):
+        """Item by position (what the front end sends), or None"""
+        items = self.room(room_type).get(category)
+        if items is None or not 0 <= index < len(items):
+            return None
+        return items[index]
+
+    def item_by_id(self, item_id):
+        return self.by_id.get(item_id)
+
+
+class CatalogFile:
+    """Current catalog for a JSON file, reloaded when the file changes"""
+
+    def __init__(self, path, check_interval_s=2.0):
+        self.path = path
+        self.check_interval_s = check_interval_s
+        self.lock = threading.Lock()
+        self.mtime = os.path.getmtime(path)
+        self.catalog = FurnitureCatalog.load(path)
+        self.checked_at = time.time()
+        print(f"🪑 Furniture catalog {self.catalog.version}: {len(self.catalog.by_id)} items "
+              f"in {len(self.catalog.rooms)} rooms")
+
+    def get(self):
+        now = time.time()
+        if now - self.checked_at >= self.check_interval_s:
+            self._maybe_reload(now)
+        return self.catalog
+
+    def _maybe_reload(self, now):
+        if not self.lock.acquire(blocking=False):
+            return  # another request is already checking
+        try:
+            self.checked_at = now
+            mtime = os.path.getmtime(self.path)
+            if mtime == self.mtime:
+                return
+            catalog = FurnitureCatalog.load(self.path)
+            self.catalog, self.mtime = catalog, mtime
+            print(f"🔄 Furniture catalog reloaded: {catalog.version}, {len(catalog.by_id)} items")
+        except Exception as e:
+            # keep serving the last good catalog until the file is fixed
+            print(f"⚠️ Furniture catalog reload failed: {e}")
+        finally:
+            self.lock.release()
+
+
+# Test
+if __name__ == "__main__":
+    import shutil
+    import tempfile
+
+    path = os.path.join(tempfile.mkdtemp(), 'catalog.json')
+    shutil.copy(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'furniture_catalog.json'), path)
+    catalog_file = CatalogFile(path, check_interval_s=0)
+    catalog = catalog_file.get()
+
+    payload = catalog.payload('Living Hall')
+    print(f"   living_hall payload: {len(payload.body)} bytes, {len(payload.gzipped)} gzipped, ETag {payload.etag}")
+    king = catalog.item('Bedroom', 'bed', 4)
+    assert catalog.item_by_id(king['id']) is king
+    print(f"   bedroom/bed/4 -> {king['id']} ₹{king['total']:,}")
+    assert catalog.payload('garage') is catalog.payload('bedroom')
+
+    start = time.perf_counter()
+    for _ in range(100000):
+        catalog_file.get().payload('bedroom')
+    print(f"   payload lookup: {(time.perf_counter() - start) * 10:.2f} µs")
+
+    with open(path) as f:
+        data = json.load(f)
+    data['bedroom']['bed'][4]['total'] = 75000
+    time.sleep(0.01)
+    with open(path, 'w') as f:
+        json.dump(data, f)
+    os.utime(path, (time.time() + 1, time.time() + 1))
+    reloaded = catalog_file.get()
+    assert reloaded is not catalog and reloaded.item_by_id(king['id'])['total'] == 75000
+    assert reloaded.payload('bedroom').etag != catalog.payload('bedroom').etag
+    print("✅ Catalog index and hot reload checks passed")
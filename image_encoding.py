@@ -0,0 +1,166 @@
+"""
+image_encoding.py - Output image encoding
+Rendered rooms are photographs: as PNG they take hundreds of KB to a few MB
+and a long zlib pass. Clients that accept WebP or JPEG get those at a
+configurable quality instead; PNG stays as the lossless fallback, with a
+zlib level tuned for speed.
+Encode time and size per image are recorded in metrics.
+"""
+
+import base64
+import io
+import os
+import time
+from PIL import Image
+from metrics import metrics
+
+# Optional: AVIF encoder plugin for Pillow versions without built-in AVIF
+try:
+    import pillow_avif  # noqa: F401 - registers the AVIF codec
+except ImportError:
+    pass
+
+Image.init()
+AVIF_AVAILABLE = 'AVIF' in Image.SAVE
+
+MIME_TYPES = {'webp': 'image/webp', 'avif': 'image/avif', 'jpeg': 'image/jpeg', 'png': 'image/png'}
+EXTENSIONS = {'webp': 'webp', 'avif': 'avif', 'jpeg': 'jpg', 'png': 'png'}
+
+# Server preference when the client accepts several formats equally:
+# WebP encodes fast and small; AVIF is smaller still but much slower to encode
+PREFERRED_FORMATS = ['webp', 'avif', 'jpeg', 'png']
+
+# Clients that send no Accept header keep getting what they always got
+DEFAULT_FORMAT = 'png'
+
+QUALITY = {'webp': 82, 'avif': 60, 'jpeg': 85}
+WEBP_METHOD = 4  # 0 (fast) .. 6 (smallest); 6 costs ~2x the time for a few percent
+# Levels above 2 barely shrink photographic content but cost several times the CPU
+PNG_COMPRESS_LEVEL = 2
+
+
+def available_formats():
+    return [fmt for fmt in PREFERRED_FORMATS if fmt != 'avif' or AVIF_AVAILABLE]
+
+
+def _parse_accept(accept):
+    """{media range: q} from an Accept header"""
+    ranges = {}
+    for part in accept.split(','):
+        fields = part.strip().split(';')
+        media = fields[0].strip().lower()
+        if not media:
+            continue
+        q = 1.0
+        for param in fields[1:]:
+            name, _, value = param.strip().partition('=')
+            if name.strip() == 'q':
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        ranges[media] = max(q, ranges.get(media, 0.0))
+    return ranges
+
+
+def negotiate(accept, requested=None):
+    """
+    Output format for a request: an explicit `requested` format name wins,
+    then the highest-q image type in the Accept header (server preference
+    breaks ties), then DEFAULT_FORMAT.
+    """
+    formats = available_formats()
+    requested = (requested or '').strip().lower()
+    if requested == 'jpg':
+        requested = 'jpeg'
+    if requested in formats:
+        return requested
+    if not accept:
+        return DEFAULT_FORMAT
+
+    ranges = _parse_accept(accept)
+    best, best_q = None, 0.0
+    for fmt in formats:
+        mime = MIME_TYPES[fmt]
+        q = ranges.get(mime, ranges.get('image/*', ranges.get('*/*', 0.0)))
+        if q > best_q:
+            best, best_q = fmt, q
+    return best or DEFAULT_FORMAT
+
+
+def format_for_path(path):
+    """Format implied by a file extension (PNG for anything unknown)"""
+    ext = os.path.splitext(path)[1].lstrip('.').lower()
+    for fmt, fmt_ext in EXTENSIONS.items():
+        if ext == fmt_ext or ext == fmt:
+            return fmt
+    return 'png'
+
+
+def encode(image, fmt='png', quality=None):
+    """Encode a PIL image; returns the bytes"""
+    if fmt == 'avif' and not AVIF_AVAILABLE:
+        fmt = 'webp'
+    if fmt in ('jpeg', 'webp', 'avif') and image.mode not in ('RGB', 'L'):
+        image = image.convert('RGB')
+    quality = quality or QUALITY.get(fmt)
+
+    if fmt == 'webp':
+        options = {'format': 'WEBP', 'quality': quality, 'method': WEBP_METHOD}
+    elif fmt == 'avif':
+        options = {'format': 'AVIF', 'quality': quality}
+    elif fmt == 'jpeg':
+        options = {'format': 'JPEG', 'quality': quality, 'optimize': True, 'progressive': True}
+    else:
+        fmt = 'png'
+        options = {'format': 'PNG', 'compress_level': PNG_COMPRESS_LEVEL}
+
+    start = time.perf_counter()
+    buffer = io.BytesIO()
+    image.save(buffer, **options)
+    data = buffer.getvalue()
+    metrics.observe('image_encode_seconds', time.perf_counter() - start, format=fmt)
+    metrics.observe('image_encoded_bytes', len(data), format=fmt)
+    return data
+
+
+def save_image(image, output_path, fmt=None, quality=None):
+    """Encode in the format of output_path's extension (or `fmt`) and write it"""
+    data = encode(image, fmt or format_for_path(output_path), quality)
+    with open(output_path, 'wb') as f:
+        f.write(data)
+    return output_path
+
+
+def data_url(path):
+    """base64 data: URL for an encoded image file"""
+    with open(path, 'rb') as f:
+        encoded = base64.b64encode(f.read()).decode('utf-8')
+    return f"data:{MIME_TYPES[format_for_path(path)]};base64,{encoded}"
+
+
+# Test
+if __name__ == "__main__":
+    import numpy as np
+
+    print("\n🧪 Output encoding comparison (1024x768 photo-like image)")
+    rng = np.random.default_rng(0)
+    gradient = np.linspace(0, 255, 1024, dtype=np.float32)[None, :, None]
+    pixels = np.clip(gradient + rng.normal(0, 12, (768, 1024, 3)), 0, 255).astype(np.uint8)
+    image = Image.fromarray(pixels)
+
+    for fmt in available_formats():
+        start = time.perf_counter()
+        size = len(encode(image, fmt))
+        print(f"   {fmt:5s} {size / 1024:7.0f} KB  {(time.perf_counter() - start) * 1000:6.0f} ms")
+    start = time.perf_counter()
+    buffer = io.BytesIO()
+    image.save(buffer, format='PNG')
+    print(f"   png (Pillow defaults) {len(buffer.getvalue()) / 1024:.0f} KB  "
+          f"{(time.perf_counter() - start) * 1000:.0f} ms")
+
+    for accept, expected in [(None, 'png'), ('*/*', 'webp'), ('image/jpeg', 'jpeg'),
+                             ('image/webp;q=0.5, image/jpeg', 'jpeg'), ('application/json', 'png')]:
+        assert negotiate(accept) == expected, (accept, negotiate(accept))
+    assert negotiate('image/webp', requested='jpg') == 'jpeg'
+    print("✅ Negotiation checks passed")
@@ -6,18 +6,161 @@ image_to_image_renderer.py - OPTIMIZED CONTROLNET
 """
 
 import os
+import math
+import time
+import threading
 import torch
-from PIL import Image, ImageDraw, ImageFont
+from PIL import Image
 from diffusers import (
     StableDiffusionControlNetPipeline, 
     ControlNetModel,
-    DPMSolverMultistepScheduler
+    DPMSolverMultistepScheduler,
+    AutoencoderTiny
 )
 import numpy as np
 import cv2
 import warnings
+from render_jobs import RenderCancelled
+from single_flight import SingleFlight, file_key
+from ingest import load_working_image
+from image_encoding import save_image
+from derived_artifacts import compose_comparison
 warnings.filterwarnings('ignore')
 
+# Optional: DeepCache reuses deep UNet features between steps
+try:
+    from DeepCache import DeepCacheSDHelper
+    DEEPCACHE_AVAILABLE = True
+except Exception:
+    DeepCacheSDHelper = None
+    DEEPCACHE_AVAILABLE = False
+
+# Optional: token merging for UNet self-attention
+try:
+    import tomesd
+    TOME_AVAILABLE = True
+except Exception:
+    tomesd = None
+    TOME_AVAILABLE = False
+
+
+# ✅ Working-size image + Canny map per (photo, size): computed once and shared
+# by drafts, refines and uploads warmed up before the user clicks Generate
+_control_flights = SingleFlight(ttl=1800, max_entries=32)
+
+
+def prepare_control(image_path, max_dim):
+    """
+    Decoded working-size RGB image, original size, Canny edge map and
+    ControlNet control image for a photo (cached per file and size)
+    """
+    key = (file_key(image_path), max_dim)
+    result, _ = _control_flights.run(key, lambda: _compute_control(image_path, max_dim))
+    return result
+
+
+def _compute_control(image_path, max_dim):
+    # JPEGs decode straight at reduced DCT scale; EXIF rotation is applied
+    # (browsers and the client-side downscaler apply it, so the render must too)
+    init_image, original_size = load_working_image(image_path, max_dim)
+
+    # One resize straight to the working size (longest side <= max_dim,
+    # multiples of 8) - none at all when the client already sent that size
+    ratio = min(1.0, max_dim / init_image.width, max_dim / init_image.height)
+    width = (int(init_image.width * ratio) // 8) * 8
+    height = (int(init_image.height * ratio) // 8) * 8
+    if (width, height) != init_image.size:
+        init_image = init_image.resize((width, height), Image.Resampling.LANCZOS)
+
+    # ✅ OPTIMIZED: Adjusted thresholds for better detection
+    gray = cv2.cvtColor(np.array(init_image), cv2.COLOR_RGB2GRAY)
+    edge_map = cv2.Canny(gray, 100, 200)  # Higher = more details preserved
+    control_image = Image.fromarray(cv2.cvtColor(edge_map, cv2.COLOR_GRAY2RGB))
+    return init_image, original_size, edge_map, control_image
+
+
+class ControlNetWindow:
+    """
+    Runs the ControlNet only for the first part of the denoising loop.
+    Room structure is locked in during the early steps, so after the cutoff
+    the residuals are dropped ('drop') or the last ones reused ('cache')
+    and each step costs a single UNet pass.
+    """
+
+    def __init__(self, controlnet):
+        self._forward = controlnet.forward
+        controlnet.forward = self._gated_forward
+        self.reset(num_steps=0, window=1.0)
+
+    def reset(self, num_steps, window, mode='drop'):
+        """Arm the window for a new generation"""
+        if window >= 1.0:
+            self.cutoff_step = num_steps
+        else:
+            self.cutoff_step = int(math.ceil(num_steps * max(window, 0.0)))
+        self.mode = mode
+        self.active = self.cutoff_step > 0
+        self.cached = None
+        self.calls = 0
+        self.skipped = 0
+
+    def on_step_end(self, pipe, step_index, timestep, callback_kwargs):
+        """diffusers step callback - closes the window after the cutoff step"""
+        if self.active and step_index + 1 >= self.cutoff_step:
+            self.active = False
+        return callback_kwargs
+
+    def _gated_forward(self, *args, **kwargs):
+        if self.active:
+            self.calls += 1
+            residuals = self._forward(*args, **kwargs)
+            if self.mode == 'cache':
+                self.cached = residuals
+            return residuals
+
+        self.skipped += 1
+        if self.mode == 'cache' and self.cached is not None:
+            down_samples, mid_sample = self.cached
+            batch = args[0].shape[0] if args else kwargs['sample'].shape[0]
+            if mid_sample.shape[0] > batch:
+                # CFG was truncated: keep the conditional half only
+                down_samples = [d[-batch:] for d in down_samples]
+                mid_sample = mid_sample[-batch:]
+            return down_samples, mid_sample
+        # UNet skips ControlNet residuals when both are None
+        return None, None
+
+
+class GuidanceSchedule:
+    """
+    Classifier-free guidance for the early and middle steps only.
+    At the cutoff the negative-prompt half of the batch is dropped and
+    the remaining steps run the UNet (and ControlNet) on the
+    conditional batch alone - roughly half the compute per late step.
+    """
+
+    # Tensors the pipeline has to hand to the step callback
+    TENSOR_INPUTS = ['prompt_embeds', 'image']
+
+    def __init__(self):
+        self.reset(num_steps=0, cutoff=1.0)
+
+    def reset(self, num_steps, cutoff):
+        """Arm the schedule for a new generation"""
+        if cutoff >= 1.0:
+            self.cutoff_step = num_steps
+        else:
+            self.cutoff_step = max(1, int(math.ceil(num_steps * cutoff)))
+        self.cfg_steps = self.cutoff_step
+
+    def on_step_end(self, pipe, step_index, timestep, callback_kwargs):
+        """diffusers step callback - switches to conditional-only at the cutoff"""
+        if step_index + 1 == self.cutoff_step and pipe.do_classifier_free_guidance:
+            callback_kwargs['prompt_embeds'] = callback_kwargs['prompt_embeds'].chunk(2)[-1]
+            callback_kwargs['image'] = callback_kwargs['image'].chunk(2)[-1]
+            pipe._guidance_scale = 0.0
+        return callback_kwargs
+
 
 class ImageToImageRenderer:
     """
@@ -25,6 +168,56 @@ class ImageToImageRenderer:
     100% FREE - runs on your computer
     """
     
+    # ✅ Per-room ControlNet tuning
+    # conditioning_scale: how strictly to follow edges
+    # control_window: fraction of steps the ControlNet runs for
+    ROOM_CONTROL_SETTINGS = {
+        'default': {'conditioning_scale': 0.75, 'control_window': 0.6},
+        'bedroom': {'conditioning_scale': 0.75, 'control_window': 0.6},
+        'kitchen': {'conditioning_scale': 0.80, 'control_window': 0.7},  # cabinets need straight lines
+        'bathroom': {'conditioning_scale': 0.80, 'control_window': 0.7},
+        'living_room': {'conditioning_scale': 0.75, 'control_window': 0.5},
+        'living_hall': {'conditioning_scale': 0.75, 'control_window': 0.5},
+        'dining_room': {'conditioning_scale': 0.75, 'control_window': 0.6},
+        'office': {'conditioning_scale': 0.75, 'control_window': 0.6},
+        'study_room': {'conditioning_scale': 0.75, 'control_window': 0.6},
+        'pooja_room': {'conditioning_scale': 0.75, 'control_window': 0.6},
+    }
+    
+    # ✅ Quality tiers - trade steps and resolution for throughput
+    # num_steps: per device, max_dim: longest side used for generation
+    # guidance_cutoff: fraction of steps using CFG
+    # control_window: fraction of steps using ControlNet (None = per room)
+    # tome_ratio: fraction of self-attention tokens merged (0 = off)
+    QUALITY_TIERS = {
+        'fast': {'num_steps': {'cpu': 8, 'cuda': 12}, 'max_dim': 384,
+                 'guidance_cutoff': 0.5, 'control_window': 0.4, 'tome_ratio': 0.5},
+        'balanced': {'num_steps': {'cpu': 12, 'cuda': 16}, 'max_dim': 448,
+                     'guidance_cutoff': 0.75, 'control_window': None, 'tome_ratio': 0.3},
+        'quality': {'num_steps': {'cpu': 15, 'cuda': 20}, 'max_dim': 512,
+                    'guidance_cutoff': 1.0, 'control_window': None, 'tome_ratio': 0.0},
+    }
+    
+    # Approximate SD 1.5 latent -> RGB projection for live previews
+    LATENT_RGB_FACTORS = [
+        [0.3512, 0.2297, 0.3227],
+        [0.3250, 0.4974, 0.2350],
+        [-0.2829, 0.1762, 0.2721],
+        [-0.2120, -0.2616, -0.7177],
+    ]
+    
+    # ✅ Draft preview: small, few steps, approximate VAE decode
+    DRAFT_SETTINGS = {'max_dim': 256, 'num_steps': 8, 'guidance_cutoff': 0.5, 'quality': 'fast'}
+    TINY_VAE_MODEL = "madebyollin/taesd"
+    
+    @classmethod
+    def warm_up(cls, image_path):
+        """Precompute the control inputs for the draft and every quality tier"""
+        sizes = {cls.DRAFT_SETTINGS['max_dim']} | {tier['max_dim'] for tier in cls.QUALITY_TIERS.values()}
+        for max_dim in sorted(sizes):
+            prepare_control(image_path, max_dim)
+        return sorted(sizes)
+    
     def __init__(self):
         """Initialize ControlNet pipeline"""
         print("🚀 Initializing ControlNet...")
@@ -65,6 +258,33 @@ class ImageToImageRenderer:
             
             self.pipe = self.pipe.to(self.device)
             
+            # ✅ ControlNet only runs for the early steps
+            self.control_window = ControlNetWindow(self.pipe.controlnet)
+            
+            # ✅ CFG truncation needs the control image in the step callback
+            self.guidance_schedule = GuidanceSchedule()
+            callback_inputs = getattr(self.pipe, '_callback_tensor_inputs', [])
+            self.supports_guidance_cutoff = all(
+                name in callback_inputs for name in GuidanceSchedule.TENSOR_INPUTS
+            )
+            if not self.supports_guidance_cutoff:
+                print("   ⚠️  diffusers too old for guidance truncation (full CFG only)")
+            
+            # ✅ Step-to-step UNet feature caching (opt-in per render)
+            self.feature_cache = None
+            if DEEPCACHE_AVAILABLE:
+                self.feature_cache = DeepCacheSDHelper(pipe=self.pipe)
+                print("   ✅ DeepCache available (feature caching)")
+            
+            if TOME_AVAILABLE:
+                print("   ✅ tomesd available (token merging)")
+            self.last_metrics = {}
+            
+            # One render at a time - the pipeline hooks are per-renderer state
+            self.render_lock = threading.Lock()
+            self.full_vae = self.pipe.vae
+            self.draft_vae = None
+            
             # ✅ Memory optimizations
             self.pipe.enable_attention_slicing()
             
@@ -85,7 +305,12 @@ class ImageToImageRenderer:
             self.model_loaded = False
     
     def edit_room_image(self, original_image_path, room_data, 
-                        output_path='edited_room.png', strength=0.75):
+                        output_path='edited_room.png', strength=0.75,
+                        conditioning_scale=None, control_window=None,
+                        control_mode='drop', guidance_cutoff=None, cache_interval=1,
+                        quality='quality', tome_ratio=None, seed=None,
+                        max_dim=None, num_steps=None, draft=False,
+                        progress_callback=None, cancel_token=None):
         """
         Add furniture using ControlNet - preserves room perfectly
         
@@ -94,6 +319,20 @@ class ImageToImageRenderer:
             room_data: Dict with 'room_type', 'style', 'suggested_items'
             output_path: Where to save
             strength: Not used (ControlNet uses conditioning_scale)
+            conditioning_scale: Override the per-room edge strictness
+            control_window: Override the fraction of steps ControlNet runs (0-1)
+            control_mode: 'drop' or 'cache' ControlNet residuals after the window
+            guidance_cutoff: Fraction of steps using CFG (1.0 = all steps)
+            cache_interval: Recompute deep UNet blocks every N steps (1 = off)
+            quality: Quality tier from QUALITY_TIERS ('fast', 'balanced', 'quality')
+                     - fills in every setting not passed explicitly
+            tome_ratio: Override the tier's token-merging ratio (0 = off)
+            seed: Fixed seed for reproducible renders (None = random)
+            max_dim: Override the tier's longest side used for generation
+            num_steps: Override the tier's step count
+            draft: Decode with the tiny VAE and keep the low-res output
+            progress_callback: Called as (step, total_steps, latents) after each step
+            cancel_token: threading.Event - render stops at the next step once set
         
         Returns:
             str: Path to edited image, or None if failed
@@ -113,86 +352,252 @@ class ImageToImageRenderer:
         if suggested:
             print(f"   Adding: {', '.join(suggested)}")
         
+        tier = self.QUALITY_TIERS.get(quality, self.QUALITY_TIERS['quality'])
+        if num_steps is None:
+            num_steps = tier['num_steps']['cpu' if self.device == 'cpu' else 'cuda']
+        if max_dim is None:
+            max_dim = tier['max_dim']
+        if guidance_cutoff is None:
+            guidance_cutoff = tier['guidance_cutoff']
+        if control_window is None:
+            control_window = tier['control_window']
+        if tome_ratio is None:
+            tome_ratio = tier['tome_ratio']
+        
         try:
-            # Load image
-            init_image = Image.open(original_image_path).convert('RGB')
-            original_size = init_image.size
+            # Load image, resize and detect room structure (cached per photo and size)
+            init_image, original_size, edge_map, control_image = prepare_control(original_image_path, max_dim)
+            width, height = init_image.size
             
             print(f"   📏 Original size: {original_size[0]}x{original_size[1]}")
-            
-            # Resize for processing
-            max_dim = 512
-            if init_image.width > max_dim or init_image.height > max_dim:
-                ratio = min(max_dim / init_image.width, max_dim / init_image.height)
-                new_size = (int(init_image.width * ratio), int(init_image.height * ratio))
-                init_image = init_image.resize(new_size, Image.Resampling.LANCZOS)
-            
-            # Ensure dimensions are multiples of 8
-            width = (init_image.width // 8) * 8
-            height = (init_image.height // 8) * 8
-            init_image = init_image.resize((width, height), Image.Resampling.LANCZOS)
-            
             print(f"   ✅ Processing: {width}x{height}")
             
-            # ✅ CRITICAL: Generate Canny edge map
-            print("   🎯 Detecting room structure...")
-            image_np = np.array(init_image)
-            gray = cv2.cvtColor(image_np, cv2.COLOR_RGB2GRAY)
-            
-            # ✅ OPTIMIZED: Adjusted thresholds for better detection
-            edges = cv2.Canny(gray, 100, 200)  # Higher = more details preserved
-            edges = cv2.cvtColor(edges, cv2.COLOR_GRAY2RGB)
-            control_image = Image.fromarray(edges)
-            
             print(f"   📝 Prompt: {prompt[:80]}...")
             
             # ✅ CRITICAL: Optimized settings for speed + quality
+            guidance = 7.5
             if self.device == "cpu":
-                print(f"   ⏳ Generating (1-2 minutes on CPU)...")
-                num_steps = 15  # Reduced from 20
-                guidance = 7.5
-                conditioning_scale = 0.75  # How strictly to follow edges
+                print(f"   ⏳ Generating {num_steps} steps ({quality}, 1-2 minutes on CPU)...")
             else:
-                print(f"   ⏳ Generating (30-60 seconds on GPU)...")
-                num_steps = 20  # Reduced from 30
-                guidance = 7.5
-                conditioning_scale = 0.75
+                print(f"   ⏳ Generating {num_steps} steps ({quality}, 30-60 seconds on GPU)...")
+            
+            settings = self._control_settings(room_data.get('room_type', ''))
+            if conditioning_scale is None:
+                conditioning_scale = settings['conditioning_scale']
+            if control_window is None:
+                control_window = settings['control_window']
             
             # ✅ Check if room is empty - adjust conditioning
             is_empty = room_data.get('is_empty', False)
             if is_empty:
                 # Empty room: follow edges less strictly so furniture can appear
-                conditioning_scale = 0.65
+                conditioning_scale = round(conditioning_scale - 0.10, 2)
                 guidance = 8.0  # Higher guidance = stronger furniture addition
                 print(f"   Empty room detected - adjusted settings")
             
-            # Generate with ControlNet
-            result = self.pipe(
-                prompt=prompt,
-                image=control_image,  # Canny edges preserve structure
-                negative_prompt=negative_prompt,
-                num_inference_steps=num_steps,
-                guidance_scale=guidance,
-                controlnet_conditioning_scale=conditioning_scale,
-            ).images[0]
-            
-            # Resize back to original
-            if result.size != original_size:
+            with self.render_lock:
+                if cancel_token is not None and cancel_token.is_set():
+                    raise RenderCancelled("Cancelled before start")
+                
+                self.control_window.reset(num_steps, control_window, control_mode)
+                print(f"   ControlNet: scale {conditioning_scale}, "
+                      f"first {self.control_window.cutoff_step}/{num_steps} steps ({control_mode})")
+            
+                step_hooks = [self.control_window.on_step_end]
+                tensor_inputs = []
+                if not self.supports_guidance_cutoff:
+                    guidance_cutoff = 1.0
+            
+                if cache_interval > 1 and self.feature_cache is None:
+                    print("   ⚠️  Feature caching needs: pip install DeepCache")
+                    cache_interval = 1
+            
+                self.guidance_schedule.reset(num_steps, guidance_cutoff)
+                if cache_interval > 1:
+                    # Cached features hold the CFG batch - switch on a refresh step
+                    cutoff_step = self.guidance_schedule.cutoff_step
+                    self.guidance_schedule.cutoff_step = min(
+                        num_steps, int(math.ceil(cutoff_step / cache_interval)) * cache_interval
+                    )
+                    self.guidance_schedule.cfg_steps = self.guidance_schedule.cutoff_step
+                if guidance_cutoff < 1.0:
+                    step_hooks.append(self.guidance_schedule.on_step_end)
+                    tensor_inputs = GuidanceSchedule.TENSOR_INPUTS
+                    print(f"   CFG: first {self.guidance_schedule.cutoff_step}/{num_steps} steps")
+            
+                if progress_callback is not None:
+                    def report_progress(pipe, step_index, timestep, callback_kwargs):
+                        progress_callback(step_index + 1, num_steps, callback_kwargs.get('latents'))
+                        return callback_kwargs
+                    step_hooks.append(report_progress)
+                    tensor_inputs = tensor_inputs + ['latents']
+            
+                if cancel_token is not None:
+                    # last hook, so the step that just finished is reported first
+                    def check_cancel(pipe, step_index, timestep, callback_kwargs):
+                        if cancel_token.is_set():
+                            raise RenderCancelled(f"Cancelled at step {step_index + 1}/{num_steps}")
+                        return callback_kwargs
+                    step_hooks.append(check_cancel)
+            
+                generator = None
+                if seed is not None:
+                    generator = torch.Generator(device='cpu').manual_seed(int(seed))
+            
+                if cache_interval > 1:
+                    self.feature_cache.set_params(cache_interval=cache_interval, cache_branch_id=0)
+                    self.feature_cache.enable()
+                    print(f"   Feature cache: deep UNet blocks every {cache_interval} steps")
+            
+                if tome_ratio > 0 and not TOME_AVAILABLE:
+                    print("   ⚠️  Token merging needs: pip install tomesd")
+                    tome_ratio = 0.0
+                if tome_ratio > 0:
+                    # Only the highest-resolution blocks (4096 tokens at 512px)
+                    tomesd.apply_patch(self.pipe, ratio=tome_ratio, max_downsample=1)
+                    print(f"   Token merging: {tome_ratio:.0%} of self-attention tokens")
+            
+                if draft:
+                    self.pipe.vae = self._get_draft_vae()
+                
+                # Generate with ControlNet
+                start = time.perf_counter()
+                try:
+                    result = self.pipe(
+                        prompt=prompt,
+                        image=control_image,  # Canny edges preserve structure
+                        negative_prompt=negative_prompt,
+                        num_inference_steps=num_steps,
+                        guidance_scale=guidance,
+                        controlnet_conditioning_scale=conditioning_scale,
+                        generator=generator,
+                        callback_on_step_end=self._chain_step_hooks(step_hooks),
+                        callback_on_step_end_tensor_inputs=tensor_inputs,
+                    ).images[0]
+                finally:
+                    if cache_interval > 1:
+                        self.feature_cache.disable()
+                    if tome_ratio > 0:
+                        tomesd.remove_patch(self.pipe)
+                    if draft:
+                        self.pipe.vae = self.full_vae
+                latency = time.perf_counter() - start
+            
+                metrics = {
+                    'latency_s': round(latency, 2),
+                    'step_latency_s': round(latency / num_steps, 3),
+                    'steps': num_steps,
+                    'controlnet_steps': self.control_window.calls,
+                    'controlnet_skipped': self.control_window.skipped,
+                    'conditioning_scale': conditioning_scale,
+                    'control_window': control_window,
+                    'cfg_steps': self.guidance_schedule.cfg_steps,
+                    'guidance_cutoff': guidance_cutoff,
+                    'cache_interval': cache_interval,
+                    'quality': quality,
+                    'tome_ratio': tome_ratio,
+                    'draft': draft,
+                    'edge_fidelity': round(self._edge_fidelity(edge_map, result), 3)
+                }
+                self.last_metrics = metrics
+            print(f"   ⏱️  {latency:.1f}s ({latency / num_steps:.2f}s/step), "
+                  f"edge fidelity {metrics['edge_fidelity']:.3f}")
+            
+            # Resize back to original (drafts stay small)
+            if result.size != original_size and not draft:
                 result = result.resize(original_size, Image.Resampling.LANCZOS)
                 print(f"   ✅ Resized to: {result.width}x{result.height}")
             
-            # Save
-            result.save(output_path)
+            # Save (format from the extension: WebP/JPEG/AVIF, or tuned PNG)
+            save_image(result, output_path)
             print(f"   ✅ Furnished room saved: {output_path}")
             print(f"   💡 Room structure preserved, furniture added!")
             return output_path
             
+        except RenderCancelled as e:
+            print(f"   🛑 {e}")
+            raise
         except Exception as e:
             print(f"   ❌ Failed: {e}")
             import traceback
             traceback.print_exc()
             return None
     
+    def render_draft(self, original_image_path, room_data, output_path='draft_room.png', seed=None,
+                     progress_callback=None, cancel_token=None):
+        """
+        Fast low-res preview of the design (seconds, not minutes)
+        Refine it later with edit_room_image and the same seed
+        """
+        print(f"\n⚡ Draft preview...")
+        return self.edit_room_image(
+            original_image_path=original_image_path,
+            room_data=room_data,
+            output_path=output_path,
+            seed=seed,
+            draft=True,
+            progress_callback=progress_callback,
+            cancel_token=cancel_token,
+            **self.DRAFT_SETTINGS
+        )
+    
+    def latents_to_preview(self, latents):
+        """Cheap low-res RGB preview of in-progress latents (no VAE decode)"""
+        factors = torch.tensor(self.LATENT_RGB_FACTORS, dtype=torch.float32)
+        latent = latents[0].detach().to('cpu', torch.float32)
+        rgb = torch.einsum('chw,cr->hwr', latent, factors)
+        rgb = ((rgb + 1.0) * 127.5).clamp(0, 255).to(torch.uint8).numpy()
+        return Image.fromarray(rgb)
+    
+    def _get_draft_vae(self):
+        """Load the tiny approximate VAE on first use (falls back to the full VAE)"""
+        if self.draft_vae is None:
+            try:
+                print(f"   📥 Loading tiny VAE ({self.TINY_VAE_MODEL})...")
+                self.draft_vae = AutoencoderTiny.from_pretrained(
+                    self.TINY_VAE_MODEL,
+                    torch_dtype=self.full_vae.dtype
+                ).to(self.device)
+            except Exception as e:
+                print(f"   ⚠️  Tiny VAE unavailable, using full VAE: {e}")
+                self.draft_vae = self.full_vae
+        return self.draft_vae
+    
+    def _chain_step_hooks(self, hooks):
+        """Combine several step callbacks into the single one diffusers accepts"""
+        def callback(pipe, step_index, timestep, callback_kwargs):
+            for hook in hooks:
+                callback_kwargs = hook(pipe, step_index, timestep, callback_kwargs)
+            return callback_kwargs
+        return callback
+    
+    def _control_settings(self, room_type):
+        """Look up ControlNet tuning for a room type"""
+        room_key = (room_type or '').lower().replace(' ', '_')
+        return self.ROOM_CONTROL_SETTINGS.get(room_key, self.ROOM_CONTROL_SETTINGS['default'])
+    
+    def _edge_fidelity(self, edge_map, result):
+        """
+        How well the render kept the room structure: F1 overlap between the
+        input Canny map and the Canny map of the render (2px tolerance)
+        """
+        result_gray = cv2.cvtColor(np.array(result.convert('RGB')), cv2.COLOR_RGB2GRAY)
+        result_edges = cv2.Canny(result_gray, 100, 200)
+        if result_edges.shape != edge_map.shape:
+            result_edges = cv2.resize(result_edges, edge_map.shape[::-1], interpolation=cv2.INTER_NEAREST)
+        
+        source = edge_map > 0
+        rendered = result_edges > 0
+        if not source.any() or not rendered.any():
+            return 0.0
+        
+        kernel = np.ones((5, 5), np.uint8)
+        precision = (rendered & (cv2.dilate(edge_map, kernel) > 0)).sum() / rendered.sum()
+        recall = (source & (cv2.dilate(result_edges, kernel) > 0)).sum() / source.sum()
+        if precision + recall == 0:
+            return 0.0
+        return float(2 * precision * recall / (precision + recall))
+    
     def _build_edit_prompt(self, room_data):
         """Build prompt - EMPHASIZE furniture"""
         
@@ -247,50 +652,10 @@ class ImageToImageRenderer:
             "cluttered, messy, damaged"
         )
     
-    def create_comparison(self, original_path, edited_path, output_path='comparison.png'):
-        """Create before/after comparison"""
+    def create_comparison(self, original_path, edited_path, output_path='comparison.png', layout='side-by-side'):
+        """Create before/after comparison (layouts: side-by-side, slider, thumbnail)"""
         try:
-            original = Image.open(original_path)
-            edited = Image.open(edited_path)
-            
-            target_height = min(original.height, edited.height, 800)
-            
-            original_aspect = original.width / original.height
-            edited_aspect = edited.width / edited.height
-            
-            original_width = int(target_height * original_aspect)
-            edited_width = int(target_height * edited_aspect)
-            
-            original_resized = original.resize((original_width, target_height), Image.Resampling.LANCZOS)
-            edited_resized = edited.resize((edited_width, target_height), Image.Resampling.LANCZOS)
-            
-            gap = 20
-            label_height = 60
-            total_width = original_width + edited_width + gap
-            total_height = target_height + label_height
-            
-            comparison = Image.new('RGB', (total_width, total_height), 'white')
-            
-            comparison.paste(original_resized, (0, label_height))
-            comparison.paste(edited_resized, (original_width + gap, label_height))
-            
-            draw = ImageDraw.Draw(comparison)
-            
-            try:
-                font = ImageFont.truetype("arial.ttf", 24)
-            except:
-                font = ImageFont.load_default()
-            
-            before_x = original_width // 2 - 50
-            after_x = original_width + gap + edited_width // 2 - 90
-            
-            draw.rectangle([before_x - 10, 10, before_x + 110, 50], fill='#333333')
-            draw.text((before_x, 15), "BEFORE", fill='white', font=font)
-            
-            draw.rectangle([after_x - 10, 10, after_x + 200, 50], fill='#00AA00')
-            draw.text((after_x, 15), "AFTER (AI)", fill='white', font=font)
-            
-            comparison.save(output_path)
+            compose_comparison(original_path, edited_path, output_path, layout)
             print(f"   ✅ Comparison saved: {output_path}")
             return output_path
             
@@ -358,6 +723,7 @@ if __name__ == "__main__":
         print("\n🔧 TIPS:")
         print("   • If furniture is faint: Lower conditioning_scale to 0.60")
         print("   • If room changes too much: Raise conditioning_scale to 0.80")
-        print("   • Current: 0.65 (empty) or 0.75 (furnished)")
+        print("   • Current: per-room settings in ROOM_CONTROL_SETTINGS (-0.10 when empty)")
+        print(f"   • Last run: {renderer.last_metrics}")
     else:
         print("\n❌ Failed")
\ No newline at end of file
@@ -0,0 +1,170 @@
+"""
+ingest.py - Upload ingestion
+Streams an uploaded photo to disk in chunks while hashing it, so the
+request is never buffered whole and the content hash (the upload id) is
+ready when the last byte lands. Oversize or undecodable images are
+rejected here, before any model sees them.
+JPEGs are decoded with reduced-size DCT (Image.draft), which produces
+1/2, 1/4 or 1/8 scale pixels directly instead of decoding the full
+12-megapixel photo and shrinking it afterwards.
+"""
+
+import hashlib
+import math
+import os
+import tempfile
+from PIL import Image, ImageOps
+
+
+MAX_UPLOAD_BYTES = 16 * 1024 * 1024
+MAX_PIXELS = 40_000_000
+MIN_SIDE = 64
+CHUNK_SIZE = 64 * 1024
+
+# PIL format -> stored extension
+FORMAT_EXTENSIONS = {'JPEG': 'jpg', 'PNG': 'png', 'WEBP': 'webp'}
+
+# EXIF orientations that swap width and height
+TRANSPOSED_ORIENTATIONS = (5, 6, 7, 8)
+
+
+class IngestError(Exception):
+    """Upload rejected - `status` is the HTTP status to answer with"""
+
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+
+class IngestedImage:
+    def __init__(self, upload_id, path, size_bytes, image_format, width, height, created):
+        self.upload_id = upload_id
+        self.path = path
+        self.size_bytes = size_bytes
+        self.format = image_format
+        self.width = width
+        self.height = height
+        self.created = created  # False when identical content was already stored
+
+
+def ingest_upload(stream, upload_dir, max_bytes=MAX_UPLOAD_BYTES, max_pixels=MAX_PIXELS):
+    """
+    Stream `stream` into upload_dir as upload_<sha256>.<ext>
+
+    Raises:
+        IngestError: too large (413), not an image / unsupported (415), corrupt (400)
+    """
+    os.makedirs(upload_dir, exist_ok=True)
+    digest = hashlib.sha256()
+    size = 0
+    fd, tmp_path = tempfile.mkstemp(dir=upload_dir, prefix='.ingest_')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            while True:
+                chunk = stream.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                size += len(chunk)
+                if size > max_bytes:
+                    raise IngestError(f"Photo is larger than {max_bytes // (1024 * 1024)} MB", 413)
+                digest.update(chunk)
+                f.write(chunk)
+        if size == 0:
+            raise IngestError("Empty upload")
+
+        image_format, width, height = validate_image(tmp_path, max_pixels)
+        upload_id = digest.hexdigest()[:32]
+        path = os.path.join(upload_dir, f"upload_{upload_id}.{FORMAT_EXTENSIONS[image_format]}")
+        created = not os.path.exists(path)
+        if created:
+            os.replace(tmp_path, path)
+        return IngestedImage(upload_id, path, size, image_format, width, height, created)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def validate_image(path, max_pixels=MAX_PIXELS):
+    """Check format and size from the header, then prove it decodes (cheaply); returns (format, w, h)"""
+    try:
+        with Image.open(path) as img:
+            image_format = img.format
+            width, height = img.size
+            if image_format not in FORMAT_EXTENSIONS:
+                raise IngestError(f"Unsupported image format: {image_format}", 415)
+            if width * height > max_pixels:
+                raise IngestError(f"Photo is {width}x{height} - at most {max_pixels // 1_000_000} megapixels", 413)
+            if min(width, height) < MIN_SIDE:
+                raise IngestError(f"Photo is {width}x{height} - too small to design from")
+            # decoding at 1/8 scale is enough to catch truncated or corrupt files
+            if image_format == 'JPEG':
+                img.draft('RGB', (max(1, width // 8), max(1, height // 8)))
+            img.load()
+    except IngestError:
+        raise
+    except Image.DecompressionBombError:
+        raise IngestError("Photo has too many pixels", 413)
+    except Exception as e:
+        raise IngestError(f"Could not decode image: {e}", 415 if 'identify' in str(e) else 400)
+    return image_format, width, height
+
+
+def load_working_image(path, max_dim):
+    """
+    RGB image, EXIF-oriented, with its longest side at least max_dim where
+    possible - JPEGs decode straight to the smallest DCT scale that is big
+    enough. Returns (image, original_size) where original_size is the
+    oriented full-resolution size.
+    """
+    img = Image.open(path)
+    width, height = img.size
+    orientation = img.getexif().get(0x0112, 1)
+    if orientation in TRANSPOSED_ORIENTATIONS:
+        original_size = (height, width)
+    else:
+        original_size = (width, height)
+
+    if img.format == 'JPEG':
+        ratio = min(1.0, max_dim / max(width, height))
+        img.draft('RGB', (math.ceil(width * ratio), math.ceil(height * ratio)))
+
+    img = ImageOps.exif_transpose(img).convert('RGB')
+    return img, original_size
+
+
+# Test
+if __name__ == "__main__":
+    import io
+    import time
+
+    upload_dir = tempfile.mkdtemp()
+    photo = Image.new('RGB', (4000, 3000), (180, 150, 120))
+    buffer = io.BytesIO()
+    photo.save(buffer, format='JPEG', quality=90)
+    data = buffer.getvalue()
+
+    ingested = ingest_upload(io.BytesIO(data), upload_dir)
+    print(f"✅ Ingested {ingested.size_bytes / 1024:.0f} KB {ingested.format} "
+          f"{ingested.width}x{ingested.height} as {os.path.basename(ingested.path)}")
+    assert not ingest_upload(io.BytesIO(data), upload_dir).created, "duplicate stored twice"
+
+    start = time.perf_counter()
+    full = Image.open(ingested.path).convert('RGB')
+    full.thumbnail((512, 512), Image.Resampling.LANCZOS)
+    full_s = time.perf_counter() - start
+    start = time.perf_counter()
+    image, original_size = load_working_image(ingested.path, 512)
+    draft_s = time.perf_counter() - start
+    print(f"   Full decode + resize: {full_s * 1000:.0f} ms")
+    print(f"   Draft decode: {draft_s * 1000:.0f} ms -> {image.size} (original {original_size})")
+
+    for bad, expected in [(b'not an image', 415), (data[:len(data) // 3], 400)]:
+        try:
+            ingest_upload(io.BytesIO(bad), upload_dir)
+            print("❌ accepted a bad upload")
+        except IngestError as e:
+            print(f"   Rejected ({e.status}): {e}")
+    try:
+        ingest_upload(io.BytesIO(data), upload_dir, max_bytes=100_000)
+    except IngestError as e:
+        print(f"   Rejected ({e.status}): {e}")
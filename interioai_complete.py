@@ -11,6 +11,8 @@ from cost_estimator import CostEstimator
 from dimension_estimator import DimensionEstimator
 from design_generator import CompleteDesignGenerator
 from image_to_image_renderer import ImageToImageRenderer
+from single_flight import SingleFlight, file_key
+from image_encoding import EXTENSIONS
 import os
 import sys
 from PIL import Image
@@ -53,14 +55,67 @@ class InterioAI:
             except Exception as e:
                 print(f"⚠️ Could not load dimension estimator: {e}")
         
+        # Style-independent results per photo, shared by uploads and analyses
+        self.perception_flights = SingleFlight(ttl=1800, max_entries=64)
+        
         print("✅ All components initialized!")
         print("="*60)
     
+    def perceive(self, image_path, estimate_dimensions=True):
+        """
+        Detection, depth-based dimensions and the ControlNet edge maps -
+        everything that does not depend on the user's preferences.
+        Cached per file, and concurrent calls for the same photo share one run.
+        """
+        key = (file_key(image_path), estimate_dimensions)
+        perception, _ = self.perception_flights.run(
+            key, lambda: self._perceive(image_path, estimate_dimensions)
+        )
+        return perception
+    
+    def _perceive(self, image_path, estimate_dimensions):
+        print("\n📸 Step 1: Detecting existing furniture...")
+        detected_objects = self._detect_furniture(image_path)
+        
+        dimensions = None
+        if estimate_dimensions and self.dimension_estimator:
+            print("\n📐 Step 2: Estimating room dimensions...")
+            try:
+                dimensions = self.dimension_estimator.estimate_dimensions(image_path)
+            except Exception as e:
+                print(f"⚠️ Dimension estimation failed: {e}")
+        
+        if self.image_editor.model_loaded:
+            self.image_editor.warm_up(image_path)
+        return {'detected_objects': detected_objects, 'dimensions': dimensions}
+    
+    def render_depth_visualization(self, image_path, output_path):
+        """Colorized depth map with the estimated dimensions, from the cached perception"""
+        dimensions = self.perceive(image_path)['dimensions']
+        if not dimensions or not self.dimension_estimator:
+            raise ValueError("No depth estimate for this photo")
+        if not self.dimension_estimator.save_depth_visualization(dimensions, output_path):
+            raise ValueError("Depth visualization failed")
+        return output_path
+    
+    def render_floor_plan(self, image_path, room_type, suggested_items, output_path, view='2d'):
+        """2D floor plan or 3D diagram for the photo's room, from the cached perception"""
+        perception = self.perceive(image_path)
+        generate = (self.design_generator.generate_2d_floor_plan if view == '2d'
+                    else self.design_generator.generate_3d_visualization)
+        return generate(
+            room_type=room_type,
+            current_items=list(perception['detected_objects']),
+            suggested_items=suggested_items,
+            room_dims=self.design_generator.room_dims(perception['dimensions']),
+            output_path=output_path
+        )
+    
     def analyze_room(self, image_path, budget_level='mid-range', 
                      estimate_dimensions=True, generate_design=False,
-                     edit_image=True, edit_strength=0.75, create_comparison=True,
+                     edit_image=True, edit_strength=0.75, create_comparison=False,
                      user_room_type=None, user_style=None, user_palette=None, 
-                     user_furniture_prefs=None):
+                     user_furniture_prefs=None, output_basename=None, output_format='png'):
         """
         Complete room analysis with USER preferences
         
@@ -76,6 +131,8 @@ class InterioAI:
             user_style: User's style
             user_palette: User's color preference
             user_furniture_prefs: User's furniture preferences
+            output_basename: Prefix for output files (default: image file name)
+            output_format: 'png', 'webp', 'jpeg' or 'avif' for the edited image and comparison
             
         Returns:
             dict: Complete analysis results with costs in INR
@@ -83,26 +140,19 @@ class InterioAI:
         print(f"\n🔍 Analyzing: {os.path.basename(image_path)}")
         print("="*60)
         
-        # Step 1: Detect furniture
-        print("\n📸 Step 1: Detecting existing furniture...")
-        detected_objects = self._detect_furniture(image_path)
+        # Steps 1-2: Detection and dimensions (reused if the upload was pre-analyzed)
+        perception = self.perceive(image_path, estimate_dimensions)
+        detected_objects = list(perception['detected_objects'])
+        dimensions = perception['dimensions']
         
         if not detected_objects:
             print("⚠️  No furniture detected - will furnish room")
         else:
             print(f"✅ Detected {len(detected_objects)} items: {', '.join(detected_objects)}")
         
-        # Step 2: Estimate dimensions
-        dimensions = None
-        if estimate_dimensions and self.dimension_estimator:
-            print("\n📐 Step 2: Estimating room dimensions...")
-            try:
-                dimensions = self.dimension_estimator.estimate_dimensions(image_path)
-                if dimensions:
-                    print(f"✅ Dimensions: {dimensions['length_m']:.1f}m × {dimensions['width_m']:.1f}m × {dimensions['height_m']:.1f}m")
-                    print(f"   Area: {dimensions['floor_area_sqft']:.0f} sq ft")
-            except Exception as e:
-                print(f"⚠️ Dimension estimation failed: {e}")
+        if dimensions:
+            print(f"✅ Dimensions: {dimensions['length_m']:.1f}m × {dimensions['width_m']:.1f}m × {dimensions['height_m']:.1f}m")
+            print(f"   Area: {dimensions['floor_area_sqft']:.0f} sq ft")
         
         # Step 3: Generate suggestions
         step_num = 3 if dimensions else 2
@@ -157,7 +207,7 @@ class InterioAI:
         if generate_design:
             print(f"\n🎨 Step {step_num}: Creating diagrams...")
             try:
-                base_filename = os.path.splitext(os.path.basename(image_path))[0]
+                base_filename = output_basename or os.path.splitext(os.path.basename(image_path))[0]
                 design_files = self.design_generator.generate_all_designs(
                     room_type=analysis['room_type'],
                     current_items=detected_objects,
@@ -181,8 +231,9 @@ class InterioAI:
                 print(f"   Using {user_palette} color scheme")
             
             try:
-                base_filename = os.path.splitext(os.path.basename(image_path))[0]
-                edited_filename = f"{base_filename}_designed.png"
+                base_filename = output_basename or os.path.splitext(os.path.basename(image_path))[0]
+                ext = EXTENSIONS.get(output_format, 'png')
+                edited_filename = f"{base_filename}_designed.{ext}"
                 
                 room_data = {
                     'room_type': user_room_type or analysis['room_type'],
@@ -201,7 +252,7 @@ class InterioAI:
                 )
                 
                 if edited_image and create_comparison:
-                    comparison_filename = f"{base_filename}_before_after.png"
+                    comparison_filename = f"{base_filename}_before_after.{ext}"
                     comparison_image = self.image_editor.create_comparison(
                         original_path=image_path,
                         edited_path=edited_image,
@@ -0,0 +1,86 @@
+"""
+metrics.py - In-process service metrics
+Counters, gauges and timing summaries shared by the API and render
+workers, exposed as JSON by /api/metrics.
+"""
+
+import threading
+import time
+from collections import defaultdict, deque
+
+
+class Metrics:
+    """
+    Thread-safe counters, gauges and timing summaries.
+    Timings keep at most `window` samples and none older than max_age_s,
+    so a burst stops skewing percentiles once it is over, however quiet
+    traffic is afterwards.
+    """
+
+    def __init__(self, window=500, max_age_s=900):
+        self.window = window
+        self.max_age_s = max_age_s
+        self.lock = threading.Lock()
+        self.counters = defaultdict(float)
+        self.gauges = {}
+        self.timings = defaultdict(lambda: deque(maxlen=self.window))
+
+    @staticmethod
+    def _key(name, labels):
+        if not labels:
+            return name
+        label_str = ','.join(f"{k}={v}" for k, v in sorted(labels.items()))
+        return f"{name}{{{label_str}}}"
+
+    def incr(self, name, value=1, **labels):
+        with self.lock:
+            self.counters[self._key(name, labels)] += value
+
+    def set_gauge(self, name, value, **labels):
+        with self.lock:
+            self.gauges[self._key(name, labels)] = value
+
+    def observe(self, name, value, **labels):
+        """Record one sample (seconds, bytes, ...) - only the recent window is kept"""
+        with self.lock:
+            self.timings[self._key(name, labels)].append((time.time(), value))
+
+    def _recent(self, samples, now):
+        """Drop samples older than max_age_s (oldest are on the left); returns the values"""
+        if self.max_age_s is not None:
+            while samples and now - samples[0][0] > self.max_age_s:
+                samples.popleft()
+        return [value for _, value in samples]
+
+    def percentile(self, name, pct, **labels):
+        """Percentile of the recent samples, or None without data"""
+        with self.lock:
+            samples = self.timings.get(self._key(name, labels))
+            samples = sorted(self._recent(samples, time.time())) if samples else []
+        if not samples:
+            return None
+        index = min(len(samples) - 1, int(round(pct / 100.0 * (len(samples) - 1))))
+        return samples[index]
+
+    def snapshot(self):
+        now = time.time()
+        with self.lock:
+            timings = {name: sorted(self._recent(samples, now)) for name, samples in self.timings.items()}
+            timings = {name: samples for name, samples in timings.items() if samples}
+            result = {
+                'counters': dict(self.counters),
+                'gauges': dict(self.gauges),
+                'timings': {}
+            }
+        for name, samples in timings.items():
+            result['timings'][name] = {
+                'count': len(samples),
+                'mean': round(sum(samples) / len(samples), 3),
+                'p50': round(samples[len(samples) // 2], 3),
+                'p95': round(samples[min(len(samples) - 1, int(len(samples) * 0.95))], 3),
+                'max': round(samples[-1], 3)
+            }
+        return result
+
+
+metrics = Metrics()
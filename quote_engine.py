@@ -0,0 +1,263 @@
+"""
+quote_engine.py - Vectorized furniture quotes
+Compiles a FurnitureCatalog into NumPy arrays - a unit price and budget
+tier per item row, plus id and (room, category) -> rows lookups - so many
+selection sets are priced at once: a batch becomes flat (quote, row,
+quantity) arrays and its totals and budget breakdowns are a few bincounts.
+Tier combinations (every choice per category) are priced straight from the
+arrays without building selection lists. Engines are compiled once per
+catalog object, so a hot-reloaded catalog is recompiled on first use.
+Quantities are clamped to 1-MAX_QUANTITY and totals are summed in int64,
+so batch quotes stay exact and equal to /calculate-cost.
+"""
+
+import threading
+import time
+import numpy as np
+from metrics import metrics
+
+BUDGET_TIERS = ('Budget', 'Middle', 'Premium')
+CHUNK_SIZE = 4096
+MAX_COMBINATIONS = 1_000_000
+MAX_QUANTITY = 10_000
+
+
+def clamp_quantity(value):
+    """Integer quantity in 1-MAX_QUANTITY (0 is priced as 1); raises ValueError/TypeError if not a number"""
+    return min(max(1, int(value)), MAX_QUANTITY)
+
+
+class QuoteEngine:
+    """Price arrays for one catalog"""
+
+    def __init__(self, catalog):
+        self.catalog = catalog
+        items = list(catalog.by_id.values())
+        self.ids = tuple(item['id'] for item in items)
+        self.row_by_id = {item_id: row for row, item_id in enumerate(self.ids)}
+
+        tiers = list(BUDGET_TIERS)
+        for item in items:
+            if item.get('budget', 'Budget') not in tiers:
+                tiers.append(item.get('budget', 'Budget'))
+        self.tiers = tuple(tiers)
+
+        self.prices = np.array([int(item.get('total', 0)) for item in items], dtype=np.int64)
+        self.tier_codes = np.array([tiers.index(item.get('budget', 'Budget')) for item in items], dtype=np.intp)
+        self.rows = {
+            (room, category): np.array([self.row_by_id[item['id']] for item in category_items], dtype=np.intp)
+            for room, categories in catalog.rooms.items()
+            for category, category_items in categories.items()
+        }
+
+    def row(self, selection, rooms):
+        """Item row for one selection (item_id, or room_type/category/itemIndex), or None"""
+        if selection.get('item_id'):
+            return self.row_by_id.get(selection['item_id'])
+        room_type = selection.get('room_type', 'bedroom')
+        room = rooms.get(room_type)
+        if room is None:
+            room = rooms[room_type] = self.catalog.resolve_room(room_type)
+        rows = self.rows.get((room, selection.get('category')))
+        index = int(selection.get('itemIndex', 0))
+        if rows is None or not 0 <= index < len(rows):
+            return None
+        return int(rows[index])
+
+    def encode(self, selection_sets):
+        """Flat (quote, row, quantity) arrays; unknown items are dropped like the single quote does"""
+        quotes, rows, quantities = [], [], []
+        rooms, lookup = {}, {}
+        for quote, selections in enumerate(selection_sets):
+            for selection in selections:
+                # batches repeat the same few items, so resolve each distinct one once
+                key = selection.get('item_id') or (
+                    selection.get('room_type', 'bedroom'), selection.get('category'), selection.get('itemIndex', 0))
+                row = lookup.get(key)
+                if row is None:
+                    row = self.row(selection, rooms)
+                    row = lookup[key] = -1 if row is None else row
+                quotes.append(quote)
+                rows.append(row)
+                quantities.append(clamp_quantity(selection.get('quantity', 1)))
+        rows = np.array(rows, dtype=np.intp)
+        known = rows >= 0
+        return (np.array(quotes, dtype=np.intp)[known], rows[known],
+                np.array(quantities, dtype=np.int64)[known])
+
+    def price(self, quotes, rows, quantities, count):
+        """(totals, breakdown[count, tiers], items_count) for encoded selections"""
+        line_totals = self.prices[rows] * quantities
+        # summed in int64 (bincount weights would go through float64)
+        totals = np.zeros(count, dtype=np.int64)
+        np.add.at(totals, quotes, line_totals)
+        breakdown = np.zeros((count, len(self.tiers)), dtype=np.int64)
+        np.add.at(breakdown, (quotes, self.tier_codes[rows]), line_totals)
+        items_count = np.bincount(quotes, minlength=count)
+        return totals, breakdown, items_count
+
+    def _results(self, start, totals, breakdown, items_count):
+        tiers = self.tiers
+        for i, (total, tier_totals, n) in enumerate(zip(totals.tolist(), breakdown.tolist(), items_count.tolist())):
+            yield {
+                'index': start + i,
+                'total_cost': total,
+                'budget_breakdown': dict(zip(tiers, tier_totals)),
+                'items_count': n
+            }
+
+    def quote_sets(self, selection_sets, chunk_size=CHUNK_SIZE):
+        """
+        One quote dict per selection set (a generator), priced chunk_size sets
+        per pass. Every set is encoded here, so a malformed selection raises
+        now instead of partway through a streamed response.
+        """
+        quotes, rows, quantities = self.encode(selection_sets)
+        return self._quote_chunks(quotes, rows, quantities, len(selection_sets), chunk_size)
+
+    def _quote_chunks(self, quotes, rows, quantities, count, chunk_size):
+        # quotes is sorted, so each chunk of sets is one slice of the flat arrays
+        bounds = np.searchsorted(quotes, np.arange(0, count + chunk_size, chunk_size)).tolist()
+        for n, start in enumerate(range(0, count, chunk_size)):
+            size = min(chunk_size, count - start)
+            lo, hi = bounds[n], bounds[n + 1]
+            started = time.time()
+            priced = self.price(quotes[lo:hi] - start, rows[lo:hi], quantities[lo:hi], size)
+            metrics.observe('quote_batch_seconds', time.time() - started, mode='sets')
+            yield from self._results(start, *priced)
+
+    def combination_count(self, room_type, choices):
+        """Number of combinations; raises ValueError for unknown categories or indices"""
+        chosen = self._choice_rows(room_type, choices)
+        return int(np.prod([len(indices) for indices, _ in chosen.values()], dtype=np.int64))
+
+    def _choice_rows(self, room_type, choices):
+        room = self.catalog.resolve_room(room_type)
+        chosen = {}
+        for category, indices in choices.items():
+            rows = self.rows.get((room, category))
+            if rows is None:
+                raise ValueError(f"Unknown category '{category}' for {room}")
+            if indices is None or indices == 'all':
+                indices = range(len(rows))
+            indices = np.array([int(i) for i in indices], dtype=np.intp)
+            if len(indices) == 0 or indices.min() < 0 or indices.max() >= len(rows):
+                raise ValueError(f"'{category}' indices must be within 0-{len(rows) - 1}")
+            chosen[category] = (indices, rows[indices])
+        if not chosen:
+            raise ValueError('No categories to combine')
+        return chosen
+
+    def quote_combinations(self, room_type, choices, quantities=None, chunk_size=CHUNK_SIZE):
+        """
+        Yield a quote for every combination of one item per category.
+        choices maps category -> item indices (None or 'all' for every item);
+        quantities maps category -> quantity (default 1). Each quote carries
+        its `selection` as category -> itemIndex.
+        """
+        chosen = self._choice_rows(room_type, choices)
+        categories = list(chosen)
+        sizes = [len(chosen[c][0]) for c in categories]
+        count = int(np.prod(sizes, dtype=np.int64))
+        if count > MAX_COMBINATIONS:
+            raise ValueError(f"{count} combinations exceeds the limit of {MAX_COMBINATIONS}")
+        quantities = quantities or {}
+        multipliers = [clamp_quantity(quantities.get(c, 1)) for c in categories]
+
+        for start in range(0, count, chunk_size):
+            started = time.time()
+            flat = np.arange(start, min(start + chunk_size, count))
+            digits = np.unravel_index(flat, sizes)
+            totals = np.zeros(len(flat), dtype=np.int64)
+            breakdown = np.zeros((len(flat), len(self.tiers)), dtype=np.int64)
+            positions = np.arange(len(flat))
+            for category, digit, multiplier in zip(categories, digits, multipliers):
+                rows = chosen[category][1][digit]
+                line_totals = self.prices[rows] * multiplier
+                totals += line_totals
+                # one item per category per quote, so (quote, tier) pairs are unique here
+                breakdown[positions, self.tier_codes[rows]] += line_totals
+            metrics.observe('quote_batch_seconds', time.time() - started, mode='combinations')
+
+            selected = [chosen[c][0][digit].tolist() for c, digit in zip(categories, digits)]
+            items_count = np.full(len(flat), len(categories))
+            for quote, picks in zip(self._results(start, totals, breakdown, items_count), zip(*selected)):
+                quote['selection'] = dict(zip(categories, picks))
+                yield quote
+
+
+_engine = None
+_engine_lock = threading.Lock()
+
+
+def engine_for(catalog):
+    """Compiled engine for a catalog, recompiled when the catalog object changes"""
+    global _engine
+    engine = _engine
+    if engine is not None and engine.catalog is catalog:
+        return engine
+    with _engine_lock:
+        if _engine is None or _engine.catalog is not catalog:
+            started = time.time()
+            _engine = QuoteEngine(catalog)
+            metrics.observe('quote_engine_compile_seconds', time.time() - started)
+            print(f"🧮 Quote engine compiled for catalog {catalog.version}: {len(_engine.ids)} items")
+        return _engine
+
+
+# Test
+if __name__ == "__main__":
+    import os
+    import random
+    from furniture_catalog import FurnitureCatalog
+
+    catalog = FurnitureCatalog.load(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'furniture_catalog.json'))
+    engine = engine_for(catalog)
+    assert engine_for(catalog) is engine
+
+    def loop_quote(selections):
+        """Reference: what /api/furniture/calculate-cost does per request"""
+        total, breakdown, n = 0, {'Budget': 0, 'Middle': 0, 'Premium': 0}, 0
+        for selection in selections:
+            item = catalog.item(selection.get('room_type', 'bedroom'), selection.get('category'),
+                                selection.get('itemIndex', 0))
+            if item is not None:
+                item_total = int(item.get('total', 0)) * clamp_quantity(selection.get('quantity', 1))
+                total += item_total
+                breakdown[item.get('budget', 'Budget')] += item_total
+                n += 1
+        return total, breakdown, n
+
+    rng = random.Random(7)
+    bedroom = catalog.room('bedroom')
+    sets = [[{'room_type': 'Bedroom', 'category': category, 'itemIndex': rng.randrange(len(items) + 1),
+              'quantity': rng.randint(0, 3)} for category, items in bedroom.items()] for _ in range(20000)]
+
+    start = time.perf_counter()
+    expected = [loop_quote(s) for s in sets]
+    loop_s = time.perf_counter() - start
+    start = time.perf_counter()
+    quotes = list(engine.quote_sets(sets))
+    batch_s = time.perf_counter() - start
+    for quote, (total, breakdown, n) in zip(quotes, expected):
+        assert (quote['total_cost'], quote['budget_breakdown'], quote['items_count']) == (total, breakdown, n)
+    print(f"   {len(sets)} selection sets: loop {loop_s * 1000:.0f} ms, engine {batch_s * 1000:.0f} ms (incl. result dicts)")
+
+    start = time.perf_counter()
+    combos = list(engine.quote_combinations('Bedroom', {c: None for c in bedroom}, {'nightstand': 2}))
+    combo_s = time.perf_counter() - start
+    assert len(combos) == engine.combination_count('Bedroom', {c: None for c in bedroom})
+    sample = combos[len(combos) // 2]
+    selections = [{'category': c, 'itemIndex': i, 'quantity': 2 if c == 'nightstand' else 1}
+                  for c, i in sample['selection'].items()]
+    assert loop_quote(selections)[0] == sample['total_cost']
+    print(f"   {len(combos)} bedroom combinations in {combo_s * 1000:.1f} ms, e.g. {sample}")
+
+    huge = [[{'category': 'bed', 'itemIndex': 0, 'quantity': 10 ** 30}, {'category': 'bed', 'itemIndex': 1}]]
+    assert next(engine.quote_sets(huge))['total_cost'] == loop_quote(huge[0])[0]
+    try:
+        engine.quote_sets(sets[:5000] + [[{'category': 'bed', 'quantity': 'two'}]])
+        raise AssertionError('a non-numeric quantity must fail before the first quote')
+    except ValueError:
+        pass
+    print("✅ Vectorized quotes match the per-request loop")
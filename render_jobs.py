@@ -0,0 +1,631 @@
+"""
+render_jobs.py - Background render jobs
+Renders run in a worker pool instead of the request thread.
+Each job moves through stages (draft preview, then full-quality refine)
+so the front end can show the preview while the final design renders.
+Stage changes and step progress are published as job events, which the
+API streams to the browser with Server-Sent Events.
+Jobs can be cancelled cooperatively: the renderer checks the job's
+cancel token after every denoising step.
+Under queue pressure new jobs are moved down a quality tier so latency
+degrades gracefully instead of growing with the backlog.
+Queued jobs are dispatched fair-share across users, so one user
+batch-submitting rooms cannot starve everyone else.
+Identical requests can attach to a job already in flight; it is only
+cancelled once every client holding it has let go of its own share.
+With a JobStore every job is also persisted, so queued and interrupted
+renders are picked up again after a restart. With a broker the renders
+can run in separate worker processes (render_worker.py).
+"""
+
+import threading
+import time
+import traceback
+import uuid
+from collections import OrderedDict, deque
+from metrics import metrics
+from job_store import worker_id
+
+
+class RenderCancelled(Exception):
+    """Raised inside a render when its job has been cancelled"""
+
+
+class QualityController:
+    """
+    Picks the quality tier for new jobs from queue pressure.
+    Each pressure level crossed (queue depth or p95 queue wait) moves the
+    job one tier down from the one requested.
+    """
+
+    TIERS = ['quality', 'balanced', 'fast']
+
+    # pressure level -> thresholds that trigger it
+    THRESHOLDS = [
+        {'queue_depth': 2, 'p95_wait_s': 60},
+        {'queue_depth': 5, 'p95_wait_s': 180},
+    ]
+
+    def __init__(self, thresholds=None):
+        self.thresholds = thresholds or self.THRESHOLDS
+
+    def pressure(self, queue_depth, p95_wait_s):
+        level = 0
+        for threshold in self.thresholds:
+            if queue_depth >= threshold['queue_depth'] or \
+                    (p95_wait_s is not None and p95_wait_s >= threshold['p95_wait_s']):
+                level += 1
+        return level
+
+    def choose(self, queue_depth, p95_wait_s, requested='quality'):
+        if requested not in self.TIERS:
+            requested = 'quality'
+        index = self.TIERS.index(requested) + self.pressure(queue_depth, p95_wait_s)
+        return self.TIERS[min(index, len(self.TIERS) - 1)]
+
+
+class FairScheduler:
+    """
+    Per-user job queues dispatched weighted-fair across users.
+    Higher priority classes are always served first. Within a class users
+    take turns in proportion to their weight (smooth weighted round-robin),
+    and no user has more than max_per_user jobs running at once.
+    """
+
+    PRIORITIES = ['high', 'normal', 'low']
+
+    def __init__(self, max_per_user=1, weights=None):
+        self.max_per_user = max_per_user
+        self.weights = weights or {}
+        self.queues = {priority: OrderedDict() for priority in self.PRIORITIES}
+        self.credits = {priority: {} for priority in self.PRIORITIES}
+        self.running = {}
+        self.changed = threading.Condition()
+
+    def put(self, job):
+        with self.changed:
+            users = self.queues[job.priority]
+            users.setdefault(job.user_key, deque()).append(job)
+            self._report_depth(job.user_key)
+            self.changed.notify()
+
+    def get(self):
+        """Block until a job is eligible and return it"""
+        with self.changed:
+            while True:
+                job = self._pick()
+                if job is not None:
+                    self.running[job.user_key] = self.running.get(job.user_key, 0) + 1
+                    self._report_depth(job.user_key)
+                    return job
+                self.changed.wait()
+
+    def done(self, job):
+        """A job left its worker - its user may run another"""
+        with self.changed:
+            self.running[job.user_key] = max(0, self.running.get(job.user_key, 0) - 1)
+            if not self.running[job.user_key]:
+                del self.running[job.user_key]
+            self.changed.notify_all()
+
+    def depth(self, user_key=None):
+        with self.changed:
+            return sum(len(queue) for users in self.queues.values()
+                       for user, queue in users.items()
+                       if user_key is None or user == user_key)
+
+    def user_depths(self):
+        with self.changed:
+            depths = {}
+            for users in self.queues.values():
+                for user, queue in users.items():
+                    depths[user] = depths.get(user, 0) + len(queue)
+            return depths
+
+    def _pick(self):
+        for priority in self.PRIORITIES:
+            users = self.queues[priority]
+            eligible = [user for user, queue in users.items()
+                        if queue and self.running.get(user, 0) < self.max_per_user]
+            if not eligible:
+                continue
+
+            # smooth weighted round-robin: everyone earns credit, the richest runs
+            credits = self.credits[priority]
+            total = 0
+            for user in eligible:
+                weight = self.weights.get(user, 1)
+                credits[user] = credits.get(user, 0) + weight
+                total += weight
+            chosen = max(eligible, key=lambda user: credits[user])
+            credits[chosen] -= total
+
+            job = users[chosen].popleft()
+            if not users[chosen]:
+                del users[chosen]
+                credits.pop(chosen, None)
+            return job
+        return None
+
+    def _report_depth(self, user_key):
+        depth = sum(len(users.get(user_key, ())) for users in self.queues.values())
+        metrics.set_gauge('user_queue_depth', depth, user=user_key)
+
+
+class RenderJob:
+    """One render request and its progress through the stages"""
+
+    STAGES = ['queued', 'draft', 'refine', 'done']
+
+    def __init__(self, params, job_id=None):
+        self.id = job_id or uuid.uuid4().hex[:16]
+        self.params = params
+        self.status = 'queued'  # queued / running / done / failed / cancelled
+        self.stage = 'queued'
+        self.quality_tier = params.get('quality', 'quality')
+        self.user_key = str(params.get('user_key') or 'anonymous')
+        # granted by the API from the account (never the client's form), see RENDER_PRIORITIES
+        self.priority = params.get('priority') if params.get('priority') in FairScheduler.PRIORITIES else 'normal'
+        self.preview_url = None
+        self.result_url = None
+        self.error = None
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.stage_times = {}
+        self._stage_started = None
+        self.events = []
+        self.steps_completed = 0
+        self.subscribers = 0  # open event streams
+        self.waiters = 0  # requests blocked in wait() for the result
+        self.holders = {self.user_key}  # clients (scheduling keys) sharing this job
+        self.cancel_event = threading.Event()
+        self.done_callbacks = []
+        self.lock = threading.RLock()
+        self.changed = threading.Condition(self.lock)
+
+    @classmethod
+    def from_record(cls, record):
+        """Rebuild a job from its JobStore row"""
+        job = cls(record['params'], job_id=record['id'])
+        for field in ('status', 'stage', 'quality_tier', 'preview_url', 'result_url', 'error',
+                      'created_at', 'started_at', 'finished_at'):
+            setattr(job, field, record[field])
+        job.user_key = record['user_key'] or job.user_key
+        job.priority = record['priority'] or job.priority
+        return job
+
+    @property
+    def finished(self):
+        return self.status in ('done', 'failed', 'cancelled')
+
+    def cancel(self):
+        """Ask the render to stop at its next step"""
+        self.cancel_event.set()
+
+    def attach(self, counter):
+        """
+        Someone started watching ('subscribers': an event stream opened,
+        'waiters': a request blocked in wait()); returns the new count
+        """
+        with self.lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+            return getattr(self, counter)
+
+    def detach(self, counter):
+        """A stream closed or a waiting request returned; returns how many are left"""
+        with self.lock:
+            setattr(self, counter, max(0, getattr(self, counter) - 1))
+            return getattr(self, counter)
+
+    @property
+    def watched(self):
+        """An event stream or a blocked request is still waiting for the result"""
+        with self.lock:
+            return bool(self.subscribers or self.waiters)
+
+    def hold(self, client):
+        """client shares this job's result; returns how many clients hold it"""
+        with self.lock:
+            self.holders.add(client)
+            return len(self.holders)
+
+    def release(self, client):
+        """client gives up its share - repeats change nothing; returns how many still hold it"""
+        with self.lock:
+            self.holders.discard(client)
+            return len(self.holders)
+
+    def held_by(self, client):
+        with self.lock:
+            return client in self.holders
+
+    def add_done_callback(self, fn):
+        """Call fn(job) once the job is done, failed or cancelled"""
+        with self.lock:
+            if not self.finished:
+                self.done_callbacks.append(fn)
+                return
+        fn(self)
+
+    def run_done_callbacks(self):
+        with self.lock:
+            callbacks, self.done_callbacks = self.done_callbacks, []
+        for fn in callbacks:
+            try:
+                fn(self)
+            except Exception:
+                traceback.print_exc()
+
+    def enter_stage(self, stage):
+        """Close the timer of the current stage and start the next one"""
+        now = time.time()
+        with self.lock:
+            if self._stage_started is not None:
+                self.stage_times[self.stage] = round(now - self._stage_started, 2)
+                metrics.observe('stage_seconds', now - self._stage_started, stage=self.stage)
+            self.stage = stage
+            self._stage_started = now
+            self.publish('stage', {'stage': stage, 'stage_times': dict(self.stage_times)})
+
+    def update(self, **fields):
+        with self.lock:
+            for key, value in fields.items():
+                setattr(self, key, value)
+
+    def report_progress(self, step, total_steps, preview=None):
+        """Publish denoising progress for the current stage with an ETA"""
+        with self.lock:
+            self.steps_completed += 1
+            elapsed = time.time() - (self._stage_started or time.time())
+            eta = elapsed / step * (total_steps - step) if step else None
+            data = {
+                'stage': self.stage,
+                'step': step,
+                'total_steps': total_steps,
+                'eta_s': round(eta, 1) if eta is not None else None
+            }
+            if preview:
+                data['preview'] = preview
+            self.publish('progress', data)
+
+    def publish(self, event, data):
+        """Append an event and wake up any streaming clients"""
+        with self.changed:
+            self.events.append((len(self.events) + 1, event, data))
+            self.changed.notify_all()
+
+    def events_since(self, last_id, timeout=15.0):
+        """Events after last_id, waiting up to timeout for new ones"""
+        with self.changed:
+            if len(self.events) <= last_id and not self.finished:
+                self.changed.wait(timeout)
+            return self.events[last_id:]
+
+    def wait(self, timeout=None):
+        """Block until the job finishes; returns True if it did"""
+        deadline = None if timeout is None else time.time() + timeout
+        with self.changed:
+            while not self.finished:
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self.changed.wait(remaining)
+            return True
+
+    def to_dict(self):
+        with self.lock:
+            return {
+                'job_id': self.id,
+                'status': self.status,
+                'stage': self.stage,
+                'quality_tier': self.quality_tier,
+                'priority': self.priority,
+                'clients': len(self.holders),
+                'preview_url': self.preview_url,
+                'result_url': self.result_url,
+                'error': self.error,
+                'stage_times': dict(self.stage_times),
+                'created_at': self.created_at,
+                'started_at': self.started_at,
+                'finished_at': self.finished_at
+            }
+
+
+class JobManager:
+    """
+    Runs render jobs in a small worker pool and keeps recent jobs for polling.
+    One worker by default - a single render already uses every CPU core.
+
+    dispatch='local' runs jobs from the in-process fair scheduler.
+    dispatch='broker' has workers pull jobs from the store (a Broker) -
+    render_worker.py processes do that, and a web tier with max_workers=0
+    only publishes jobs and mirrors their state from the broker.
+    """
+
+    def __init__(self, run_job, max_workers=1, max_jobs=200, quality_controller=None,
+                 max_per_user=1, user_weights=None, store=None, heartbeat_s=15.0,
+                 dispatch='local', poll_s=1.0):
+        """
+        Args:
+            store: Optional JobStore/Broker - jobs are persisted and recovered after a restart
+            heartbeat_s: How often running jobs renew their store lease
+            dispatch: 'local' or 'broker' (needs a store)
+            poll_s: How often idle pulling workers and the job mirror check the broker
+        """
+        if dispatch not in ('local', 'broker'):
+            raise ValueError(f"Unknown dispatch mode: {dispatch}")
+        if dispatch == 'broker' and store is None:
+            raise ValueError("dispatch='broker' needs a store")
+        self.run_job = run_job
+        self.max_jobs = max_jobs
+        self.quality_controller = quality_controller or QualityController()
+        self.scheduler = FairScheduler(max_per_user=max_per_user, weights=user_weights)
+        self.jobs = OrderedDict()
+        self.lock = threading.Lock()
+        self.store = store
+        self.heartbeat_s = heartbeat_s
+        self.dispatch = dispatch
+        self.poll_s = poll_s
+        self.leases = {}  # job id -> lease owner, for running jobs
+        self.workers = []
+        loop = self._worker_loop if dispatch == 'local' else self._pull_loop
+        for i in range(max_workers):
+            worker = threading.Thread(target=loop, name=f'render-{i}', daemon=True)
+            worker.start()
+            self.workers.append(worker)
+        if store is not None:
+            threading.Thread(target=self._store_loop, name='render-leases', daemon=True).start()
+
+    def submit(self, params):
+        """Queue a new job and return it immediately"""
+        job = RenderJob(params)
+        queue_depth = self.queue_depth()
+        p95_wait = metrics.percentile('queue_wait_s', 95)
+        job.quality_tier = self.quality_controller.choose(
+            queue_depth, p95_wait, params.get('quality', 'quality')
+        )
+        if job.quality_tier != params.get('quality', 'quality'):
+            metrics.incr('jobs_downgraded', tier=job.quality_tier)
+            print(f" Queue pressure (depth {queue_depth}) - job {job.id} runs as '{job.quality_tier}'")
+
+        if self.store is not None:
+            self.store.enqueue(job.id, params, user_key=job.user_key, priority=job.priority,
+                               quality_tier=job.quality_tier, created_at=job.created_at)
+        self._track(job)
+        if self.dispatch == 'local':
+            self.scheduler.put(job)
+        metrics.incr('jobs_submitted', priority=job.priority)
+        metrics.set_gauge('queue_depth', queue_depth + 1)
+        return job
+
+    def _track(self, job):
+        with self.lock:
+            self.jobs[job.id] = job
+            excess = len(self.jobs) - self.max_jobs
+            if excess > 0:
+                # oldest finished jobs first; queued and running ones must stay reachable
+                finished = [job_id for job_id, tracked in self.jobs.items() if tracked.finished]
+                for job_id in finished[:excess]:
+                    del self.jobs[job_id]
+
+    def recover(self):
+        """Queue persisted jobs this process does not know about (after a restart or a lost lease)"""
+        requeued = self.store.requeue_expired()
+        if requeued:
+            metrics.incr('jobs_requeued', len(requeued))
+            print(f" Requeued {len(requeued)} render job(s) whose worker stopped: {requeued}")
+        if self.dispatch != 'local' or not self.workers:
+            # pulling workers find requeued jobs on their own
+            return 0
+        adopted = 0
+        for record in self.store.queued():
+            with self.lock:
+                known = record['id'] in self.jobs and not self.jobs[record['id']].finished
+            if known:
+                continue
+            job = RenderJob.from_record(record)
+            self._track(job)
+            self.scheduler.put(job)
+            adopted += 1
+        if adopted:
+            metrics.incr('jobs_recovered', adopted)
+            print(f" Recovered {adopted} queued render job(s) from the job store")
+        return adopted
+
+    def _store_loop(self):
+        """Renew leases of running jobs, requeue expired ones, drop expired results"""
+        last_heartbeat = 0
+        while True:
+            if time.time() - last_heartbeat >= self.heartbeat_s:
+                last_heartbeat = time.time()
+                try:
+                    self.recover()
+                    self.store.purge()
+                except Exception:
+                    traceback.print_exc()
+                self._heartbeat()
+            if self.dispatch == 'broker':
+                try:
+                    self._mirror_remote()
+                except Exception:
+                    traceback.print_exc()
+            time.sleep(self.poll_s if self.dispatch == 'broker' else self.heartbeat_s)
+
+    def _heartbeat(self):
+        with self.lock:
+            leases = list(self.leases.items())
+        for job_id, owner in leases:
+            job = self.get(job_id)
+            if job is None or job.finished:
+                continue
+            try:
+                alive = self.store.heartbeat(job_id, owner, stage=job.stage, preview_url=job.preview_url)
+            except Exception:
+                traceback.print_exc()
+                continue
+            if not alive:
+                # cancelled from another process, or our lease went to someone else
+                print(f" Job {job_id} lost its lease or was cancelled elsewhere - stopping")
+                job.cancel()
+
+    def _mirror_remote(self):
+        """Copy the state of jobs running elsewhere into their local RenderJob (and its event stream)"""
+        with self.lock:
+            remote = [job for job_id, job in self.jobs.items()
+                      if not job.finished and job_id not in self.leases]
+        for job in remote:
+            record = self.store.get(job.id)
+            if record is None:
+                continue
+            if record['status'] == 'running' and job.status == 'queued':
+                job.update(status='running', started_at=record['started_at'],
+                           quality_tier=record['quality_tier'])
+                metrics.observe('queue_wait_s', job.started_at - job.created_at)
+            if record['stage'] not in (job.stage, 'done'):
+                job.enter_stage(record['stage'])
+            if record['preview_url'] and record['preview_url'] != job.preview_url:
+                job.update(preview_url=record['preview_url'])
+                job.publish('preview', {'preview_url': job.preview_url})
+            if record['status'] in ('done', 'failed', 'cancelled'):
+                job.enter_stage('done')
+                job.update(status=record['status'], result_url=record['result_url'], error=record['error'],
+                           started_at=record['started_at'], finished_at=record['finished_at'])
+                job.publish(job.status, job.to_dict())
+                if job.status == 'done' and job.started_at:
+                    metrics.observe('job_seconds', job.finished_at - job.started_at)
+                metrics.incr(f"jobs_{'completed' if job.status == 'done' else job.status}")
+                job.run_done_callbacks()
+
+    def queue_depth(self, user_key=None):
+        """Jobs waiting for a worker (optionally for one user)"""
+        if self.dispatch == 'broker':
+            return self.store.depth(user_key)
+        return self.scheduler.depth(user_key)
+
+    def _worker_loop(self):
+        while True:
+            job = self.scheduler.get()
+            try:
+                self._run(job)
+            except Exception:
+                traceback.print_exc()
+            finally:
+                self.scheduler.done(job)
+
+    def _pull_loop(self):
+        """Worker that leases the next job from the broker"""
+        owner = worker_id(threading.current_thread().name)
+        while True:
+            try:
+                record = self.store.claim_next(owner)
+            except Exception:
+                traceback.print_exc()
+                record = None
+            if record is None:
+                time.sleep(self.poll_s)
+                continue
+            job = RenderJob.from_record(record)
+            job.update(status='queued')
+            self._track(job)
+            print(f" Worker {owner} picked up job {job.id} ({job.quality_tier})")
+            try:
+                self._run(job, owner=owner)
+            except Exception:
+                traceback.print_exc()
+
+    def get(self, job_id):
+        with self.lock:
+            job = self.jobs.get(job_id)
+        if job is None and self.store is not None:
+            # finished before a restart, or running in another process
+            record = self.store.get(job_id)
+            if record is not None:
+                job = RenderJob.from_record(record)
+        return job
+
+    def cancel(self, job_id, client=None, force=False):
+        """
+        Release client's share of a queued or running job and cancel it once
+        no other client holds it (force: regardless of clients); returns the job or None
+        """
+        with self.lock:
+            local = job_id in self.jobs
+        job = self.get(job_id)
+        if job and not job.finished and (force or job.release(client) == 0):
+            job.cancel()
+            if self.store is not None:
+                self.store.request_cancel(job_id)
+                if not local:
+                    job = self.get(job_id)
+        return job
+
+    def _run(self, job, owner=None):
+        try:
+            if owner is None:
+                self._run_stages(job)
+            else:
+                self._run_leased(job, owner)
+        finally:
+            job.run_done_callbacks()
+
+    def _run_stages(self, job):
+        if job.cancel_event.is_set():
+            # cancelled while queued - free the worker right away
+            self._finish_cancelled(job)
+            return
+        if self.store is None:
+            self._run_claimed(job)
+            return
+        owner = worker_id(threading.current_thread().name)
+        if not self.store.claim(job.id, owner):
+            record = self.store.get(job.id)
+            if record and record['status'] == 'cancelled':
+                self._finish_cancelled(job)
+            # otherwise another process is already running it
+            return
+        self._run_leased(job, owner)
+
+    def _run_leased(self, job, owner):
+        """Run a job this worker holds the store lease for, then record the outcome"""
+        with self.lock:
+            self.leases[job.id] = owner
+        try:
+            self._run_claimed(job)
+        finally:
+            with self.lock:
+                self.leases.pop(job.id, None)
+            self.store.finish(job.id, job.status if job.finished else 'failed', owner=owner,
+                              preview_url=job.preview_url, result_url=job.result_url,
+                              error=job.error, quality_tier=job.quality_tier)
+
+    def _run_claimed(self, job):
+        job.update(status='running', started_at=time.time())
+        metrics.observe('queue_wait_s', job.started_at - job.created_at)
+        metrics.set_gauge('queue_depth', self.queue_depth())
+        try:
+            self.run_job(job)
+            job.enter_stage('done')
+            job.update(status='done', finished_at=time.time())
+            job.publish('done', job.to_dict())
+            metrics.incr('jobs_completed')
+            metrics.observe('job_seconds', job.finished_at - job.started_at)
+        except RenderCancelled:
+            self._finish_cancelled(job)
+        except Exception as e:
+            traceback.print_exc()
+            job.enter_stage('done')
+            job.update(status='failed', error=str(e), finished_at=time.time())
+            job.publish('failed', job.to_dict())
+            metrics.incr('jobs_failed')
+
+    def _finish_cancelled(self, job):
+        if self.store is not None and job.id not in self.leases:
+            self.store.finish(job.id, 'cancelled')
+        job.enter_stage('done')
+        job.update(status='cancelled', finished_at=time.time())
+        job.publish('cancelled', job.to_dict())
+        metrics.incr('jobs_cancelled')
+        # denoising steps that ran for a result nobody will see
+        metrics.incr('wasted_steps', job.steps_completed)
+        print(f" Job {job.id} cancelled after {job.steps_completed} steps")
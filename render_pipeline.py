@@ -0,0 +1,190 @@
+"""
+render_pipeline.py - The render job itself
+Shared by the web process (local workers) and render_worker.py, so it
+imports nothing from Flask or the database.
+"""
+
+import os
+import io
+import base64
+import threading
+import traceback
+from PIL import Image, ImageOps
+from render_jobs import RenderCancelled
+from image_encoding import EXTENSIONS, save_image
+
+# Try to import AI renderer
+try:
+    from image_to_image_renderer import ImageToImageRenderer
+    print("ImageToImageRenderer imported successfully")
+    AI_RENDERER_AVAILABLE = True
+except Exception as e:
+    print(f"ImageToImageRenderer import failed: {e}")
+    ImageToImageRenderer = None
+    AI_RENDERER_AVAILABLE = False
+
+_renderer = None
+_renderer_lock = threading.Lock()
+
+
+def get_renderer():
+    """Load the AI renderer once and share it between requests"""
+    global _renderer
+    if not AI_RENDERER_AVAILABLE or ImageToImageRenderer is None:
+        return None
+    with _renderer_lock:
+        if _renderer is None:
+            print("Initializing AI renderer...")
+            _renderer = ImageToImageRenderer()
+    return _renderer if _renderer.model_loaded else None
+
+
+def warm_up(image_path):
+    """Precompute the renderer's control inputs for a photo (no model needed)"""
+    if not AI_RENDERER_AVAILABLE or ImageToImageRenderer is None:
+        return
+    sizes = ImageToImageRenderer.warm_up(image_path)
+    print(f" Control inputs ready for {os.path.basename(image_path)} at {sizes}")
+
+
+def build_room_data(room_type, style, palette):
+    """Renderer input for the chosen room type, style and palette"""
+    furniture_by_room = {
+        'bedroom': ['bed', 'nightstand', 'dresser', 'wardrobe', 'bedside lamp', 'rug'],
+        'kitchen': ['dining table', 'chairs', 'bar stools', 'pendant lights', 'kitchen island', 'cabinets'],
+        'living hall': ['sofa', 'coffee table', 'TV stand', 'armchair', 'floor lamp', 'rug', 'side table'],
+        'living room': ['sofa', 'coffee table', 'TV stand', 'armchair', 'floor lamp', 'rug', 'side table'],
+        'bathroom': ['vanity', 'mirror', 'storage cabinet', 'towel rack', 'bath mat', 'shelf']
+    }
+    
+    suggested_items = furniture_by_room.get(room_type.lower(), ['sofa', 'coffee table', 'chair', 'lamp', 'rug'])
+
+    room_descriptions = {
+        'bedroom': f"A {style} bedroom with {palette} tones, cozy bed, nightstands, and warm lighting",
+        'kitchen': f"A {style} kitchen with {palette} colors, dining table, chairs, and modern appliances",
+        'living hall': f"A {style} living room with {palette} tones, comfortable sofa, coffee table, and modern furniture",
+        'living room': f"A {style} living room with {palette} tones, comfortable sofa, coffee table, and modern furniture",
+        'bathroom': f"A {style} bathroom with {palette} colors, elegant vanity, mirror, and modern fixtures"
+    }
+    
+    description = room_descriptions.get(room_type.lower(), f"A {style} interior with {palette} tones and modern furniture")
+
+    return {
+        'room_type': room_type.lower().replace(' ', '_'),
+        'style': style,
+        'palette': palette,
+        'description': description,
+        'suggested_items': suggested_items,
+        'is_empty': True
+    }
+
+
+def write_as(src_path, after_path):
+    """Re-encode an image into after_path's format - a plain copy would not match its extension"""
+    with Image.open(src_path) as image:
+        save_image(ImageOps.exif_transpose(image), after_path)
+
+
+def render_design(before_path, after_path, room_data, **render_options):
+    """Render the furnished room to after_path, falling back to the original on any failure"""
+    print(f"\n🤖 AI Available: {AI_RENDERER_AVAILABLE}")
+    
+    if AI_RENDERER_AVAILABLE and ImageToImageRenderer is not None:
+        try:
+            renderer = get_renderer()
+            if renderer is None:
+                raise RuntimeError("AI renderer failed to load")
+            
+            print("Generating furnished design...")
+            # defensive call: renderer may return a path or write file directly
+            result = renderer.edit_room_image(
+                original_image_path=before_path,
+                room_data=room_data,
+                output_path=after_path,
+                strength=0.75,
+                **render_options
+            )
+            
+            # if renderer wrote to a different path, try to handle it
+            if os.path.exists(after_path):
+                print(f"AI generation successful to {after_path}")
+            else:
+                # if result is a path and exists, copy it
+                if isinstance(result, str) and os.path.exists(result):
+                    write_as(result, after_path)
+                    print("AI generation successful (from result path)")
+                else:
+                    # fallback: copy original
+                    print(" AI returned nothing usable; using the original image as fallback")
+                    write_as(before_path, after_path)
+                
+        except RenderCancelled:
+            raise
+        except Exception as e:
+            print(f"AI error: {e}")
+            traceback.print_exc()
+            try:
+                write_as(before_path, after_path)
+            except Exception as e2:
+                print(" Failed to write fallback image:", e2)
+    else:
+        print(" AI not available, using the original")
+        write_as(before_path, after_path)
+
+
+PREVIEW_EVERY_N_STEPS = 3
+
+
+def progress_reporter(job, renderer):
+    """Renderer step callback that publishes progress (and latent previews) to the job"""
+    def report(step, total_steps, latents):
+        preview = None
+        if job.params.get('previews') and latents is not None and \
+                (step % PREVIEW_EVERY_N_STEPS == 0 or step == total_steps):
+            try:
+                buffer = io.BytesIO()
+                renderer.latents_to_preview(latents).save(buffer, format='JPEG', quality=70)
+                preview = "data:image/jpeg;base64," + base64.b64encode(buffer.getvalue()).decode('utf-8')
+            except Exception as e:
+                print(f" Latent preview failed: {e}")
+        job.report_progress(step, total_steps, preview)
+    return report
+
+
+def run_render_job(job, artifacts, uploads):
+    """
+    Job stages: fast draft preview, then the final render with the same seed
+    at the quality tier chosen for the job. The photo is read from the upload
+    store by name and outputs go to the artifact store, so any worker that
+    mounts both can run the job.
+    """
+    params = job.params
+    room_data = build_room_data(params['room_type'], params['style'], params['palette'])
+    if params.get('before_artifact'):
+        before_path = uploads.path(params['before_artifact'])
+    else:
+        before_path = params['before_path']  # queued before uploads were passed by name
+    if not os.path.exists(before_path):
+        raise FileNotFoundError(f"Input photo {os.path.basename(before_path)} is not in the upload store")
+    original_filename = params['original_filename']
+    base_name = os.path.splitext(original_filename)[0]
+    ext = EXTENSIONS.get(params.get('output_format'), 'png')
+
+    renderer = get_renderer()
+    render_options = {'seed': params['seed'], 'cancel_token': job.cancel_event}
+    if renderer is not None:
+        render_options['progress_callback'] = progress_reporter(job, renderer)
+
+    if renderer is not None and params.get('draft', True):
+        job.enter_stage('draft')
+        draft_path = artifacts.path(f"draft_{base_name}.{ext}")
+        if renderer.render_draft(before_path, room_data, output_path=draft_path, **render_options):
+            job.update(preview_url=artifacts.url(artifacts.adopt(draft_path, prefix='draft_')))
+            job.publish('preview', {'preview_url': job.preview_url})
+
+    if job.cancel_event.is_set():
+        raise RenderCancelled("Cancelled after draft")
+    job.enter_stage('refine')
+    after_path = artifacts.path(f"after_{base_name}.{ext}")
+    render_design(before_path, after_path, room_data, quality=job.quality_tier, **render_options)
+    job.update(result_url=artifacts.url(artifacts.adopt(after_path, prefix='after_')))
@@ -0,0 +1,125 @@
+"""
+render_worker.py - Render worker process
+Pulls render jobs from the broker the web tier publishes to, reads each
+job's photo from the shared upload store, renders it and writes the
+outputs to the shared artifact store. Run as many as the hardware allows -
+on one machine or on several sharing the broker file and the upload and
+output directories. Start the web tier with RENDER_DISPATCH=broker so it
+only queues jobs, and RENDER_WORKERS set to the total processes so its
+wait estimates and Retry-After match.
+
+Usage:
+    python render_worker.py
+    python render_worker.py --processes 4 --threads 2
+    python render_worker.py --processes 4 --demo room.jpg --jobs 8
+"""
+
+import argparse
+import multiprocessing
+import os
+import time
+from functools import partial
+from broker import open_broker
+from artifact_store import ArtifactStore
+
+basedir = os.path.abspath(os.path.dirname(__file__))
+DEFAULT_BROKER = 'sqlite:///' + os.path.join(basedir, 'render_jobs.db')
+DEFAULT_OUTPUT = os.path.join(basedir, 'output')
+DEFAULT_UPLOADS = os.path.join(basedir, 'uploads')
+
+
+def limit_threads(threads):
+    """Split the CPU between worker processes instead of oversubscribing it"""
+    if not threads:
+        return
+    os.environ['OMP_NUM_THREADS'] = str(threads)
+    try:
+        import torch
+        torch.set_num_threads(threads)
+    except ImportError:
+        pass
+
+
+def run_worker(broker_url, output_dir, upload_dir=DEFAULT_UPLOADS, workers=1, threads=None, heartbeat_s=5.0):
+    """Process entry point: pull and render jobs until killed"""
+    limit_threads(threads)
+    # imported here so the renderer loads in each worker process, not the parent
+    from render_jobs import JobManager
+    from render_pipeline import run_render_job
+
+    broker = open_broker(broker_url)
+    artifacts = ArtifactStore(output_dir, url_prefix='/output')
+    uploads = ArtifactStore(upload_dir, url_prefix='/uploads')
+    JobManager(partial(run_render_job, artifacts=artifacts, uploads=uploads), max_workers=workers,
+               store=broker, heartbeat_s=heartbeat_s, dispatch='broker')
+    print(f"🛠️  Render worker {os.getpid()} pulling from {broker_url}")
+    while True:
+        time.sleep(3600)
+
+
+def start_workers(broker_url, output_dir, upload_dir, processes, threads=None):
+    procs = []
+    for _ in range(processes):
+        proc = multiprocessing.Process(target=run_worker, args=(broker_url, output_dir, upload_dir),
+                                       kwargs={'threads': threads}, daemon=True)
+        proc.start()
+        procs.append(proc)
+    return procs
+
+
+def demo(broker_url, output_dir, upload_dir, image_path, jobs, processes, threads=None):
+    """Queue `jobs` renders of one photo and time how fast `processes` workers drain them"""
+    broker = open_broker(broker_url)
+    with open(image_path, 'rb') as f:
+        ext = os.path.splitext(image_path)[1].lstrip('.').lower() or 'jpg'
+        before_artifact = ArtifactStore(upload_dir, url_prefix='/uploads').put_content(f.read(), ext, prefix='upload_')
+    job_ids = []
+    for i in range(jobs):
+        job_id = f"demo{int(time.time())}_{i}"
+        broker.enqueue(job_id, {
+            'room_type': 'Living Hall', 'style': 'Modern', 'palette': 'neutral',
+            'before_artifact': before_artifact, 'original_filename': f"{job_id}.png",
+            'seed': 42 + i, 'draft': False, 'quality': 'fast'
+        }, user_key=f"demo:{i}", quality_tier='fast')
+        job_ids.append(job_id)
+
+    started = time.time()
+    procs = start_workers(broker_url, output_dir, upload_dir, processes, threads)
+    while True:
+        records = [broker.get(job_id) for job_id in job_ids]
+        finished = [r for r in records if r['status'] in ('done', 'failed', 'cancelled')]
+        if len(finished) == len(job_ids):
+            break
+        time.sleep(1.0)
+    elapsed = time.time() - started
+    for proc in procs:
+        proc.terminate()
+
+    failed = sum(1 for r in finished if r['status'] != 'done')
+    print(f"\n📊 {jobs} renders, {processes} worker process(es): {elapsed:.1f}s total, "
+          f"{jobs / elapsed * 60:.2f} renders/min, {failed} failed")
+
+
+# Test
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='InterioAI render worker')
+    parser.add_argument('--broker', default=os.environ.get('RENDER_BROKER', DEFAULT_BROKER))
+    parser.add_argument('--output', default=DEFAULT_OUTPUT, help='Shared artifact directory')
+    parser.add_argument('--uploads', default=DEFAULT_UPLOADS, help='Shared upload directory')
+    parser.add_argument('--processes', type=int, default=1)
+    parser.add_argument('--threads', type=int, help='Torch threads per process')
+    parser.add_argument('--demo', metavar='IMAGE', help='Throughput demo: render IMAGE --jobs times')
+    parser.add_argument('--jobs', type=int, default=8)
+    args = parser.parse_args()
+
+    if args.broker.startswith('memory://'):
+        print("❌ memory:// brokers live inside one process - use a sqlite:/// broker for workers")
+        exit(1)
+
+    if args.demo:
+        demo(args.broker, args.output, args.uploads, args.demo, args.jobs, args.processes, args.threads)
+    elif args.processes == 1:
+        run_worker(args.broker, args.output, args.uploads, threads=args.threads)
+    else:
+        for proc in start_workers(args.broker, args.output, args.uploads, args.processes, args.threads):
+            proc.join()
@@ -0,0 +1,167 @@
+"""
+single_flight.py - Deduplicate identical concurrent requests
+Double-clicks and client retries send the same image and preferences
+again. Identical requests attach to the one call already in flight, and
+repeats within a TTL get its stored result instead of a new render.
+StatusTable does the same bookkeeping for background work that is started
+once per key and only polled for its status.
+"""
+
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+
+
+def content_id(data):
+    """Content hash of an image - doubles as its upload id"""
+    return hashlib.sha256(data).hexdigest()[:32]
+
+
+CONTENT_NAME = re.compile(r'[0-9a-f]{32}\.\w+$')
+
+
+def file_key(path):
+    """
+    Cache identity of an image file. Content-hash names (uploads, outputs)
+    change with the content, and the stores' LRU touch() rewrites the mtime,
+    so they are keyed by name alone; other paths by path and mtime.
+    """
+    name = os.path.basename(path)
+    if CONTENT_NAME.search(name):
+        return name
+    return (os.path.abspath(path), os.path.getmtime(path))
+
+
+def request_fingerprint(image, fields):
+    """Stable key over the image (raw bytes or its content_id) and normalized form fields"""
+    image_id = image if isinstance(image, str) else content_id(image)
+    normalized = {
+        key: str(value).strip().lower()
+        for key, value in fields.items()
+        if value is not None and str(value).strip() != ''
+    }
+    digest = hashlib.sha256(image_id.encode('utf-8'))
+    digest.update(json.dumps(normalized, sort_keys=True).encode('utf-8'))
+    return digest.hexdigest()
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.finished_at = None
+
+
+class SingleFlight:
+    """
+    Runs fn once per key. Concurrent callers with the same key wait for
+    that call; callers within ttl seconds after it finished get its result.
+    Failed calls are not cached, so a retry runs again.
+    """
+
+    def __init__(self, ttl=600, max_entries=1000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.calls = OrderedDict()
+        self.lock = threading.Lock()
+
+    def peek(self, key, timeout=None):
+        """
+        Result (or in-flight call result) for key without starting work, else None.
+        With a timeout, a call still running after timeout seconds also gives None.
+        """
+        with self.lock:
+            call = self._fresh(key)
+        if call is None or not call.done.wait(timeout):
+            return None
+        return call.result if call.error is None else None
+
+    def run(self, key, fn):
+        """Returns (result, shared) - shared is True when another call's result was reused"""
+        with self.lock:
+            call = self._fresh(key)
+            owner = call is None
+            if owner:
+                call = _Call()
+                self.calls[key] = call
+                while len(self.calls) > self.max_entries:
+                    self.calls.popitem(last=False)
+
+        if not owner:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result, True
+
+        try:
+            call.result = fn()
+        except Exception as e:
+            call.error = e
+            self.forget(key)
+            raise
+        finally:
+            call.finished_at = time.time()
+            call.done.set()
+        return call.result, False
+
+    def forget(self, key):
+        """Drop a key so the next request runs fresh (e.g. its render failed)"""
+        with self.lock:
+            self.calls.pop(key, None)
+
+    def _fresh(self, key):
+        call = self.calls.get(key)
+        if call is None:
+            return None
+        if call.finished_at is not None and time.time() - call.finished_at > self.ttl:
+            del self.calls[key]
+            return None
+        return call
+
+
+class StatusTable:
+    """
+    Thread-safe key -> status for background work started once per key
+    (e.g. per upload). Entries expire after ttl seconds and the oldest go
+    first beyond max_entries, so the table does not grow with traffic.
+    """
+
+    def __init__(self, ttl=3600, max_entries=1000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.entries = OrderedDict()  # key -> (set_at, status)
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return default
+            if time.time() - entry[0] > self.ttl:
+                del self.entries[key]
+                return default
+            return entry[1]
+
+    def set(self, key, status):
+        with self.lock:
+            self._set(key, status)
+
+    def start(self, key, status='running', unless=('running', 'ready')):
+        """Set status unless the key is already in one of `unless`; True if the caller should start the work"""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and time.time() - entry[0] <= self.ttl and entry[1] in unless:
+                return False
+            self._set(key, status)
+            return True
+
+    def _set(self, key, status):
+        self.entries[key] = (time.time(), status)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
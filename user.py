@@ -1,100 +1,62 @@
-from flask import Flask, request, jsonify, send_from_directory, send_file
+from flask import Flask, request, jsonify, send_from_directory, send_file, Response, stream_with_context, g
 from flask_sqlalchemy import SQLAlchemy
 from flask_cors import CORS
 from werkzeug.security import generate_password_hash, check_password_hash
+from itsdangerous import URLSafeSerializer, URLSafeTimedSerializer, BadSignature
 from datetime import datetime
-from werkzeug.utils import secure_filename
-import os, time, shutil, traceback, random
-
-# Try to import AI renderer
-try:
-    from image_to_image_renderer import ImageToImageRenderer
-    print("ImageToImageRenderer imported successfully")
-    AI_RENDERER_AVAILABLE = True
-except Exception as e:
-    print(f"ImageToImageRenderer import failed: {e}")
-    ImageToImageRenderer = None
-    AI_RENDERER_AVAILABLE = False
-
-# Import furniture configuration
-FURNITURE_DATABASE = {
-    'bedroom': {
-        'bed': [
-            {'type': 'Single (90x200cm)', 'wood': 'Plywood', 'thickness': 18, 'grade': 'BWR', 'rs_sqft': 100, 'area_sqft': 36, 'total': 3600, 'lifetime': '5-8', 'budget': 'Budget', 'multiplyable': True},
-            {'type': 'Double (120x200cm)', 'wood': 'MDF', 'thickness': 12, 'grade': 'MR', 'rs_sqft': 70, 'area_sqft': 48, 'total': 3360, 'lifetime': '4-7', 'budget': 'Budget', 'multiplyable': True},
-            {'type': 'Queen (160x200cm)', 'wood': 'Engineered', 'thickness': 18, 'grade': 'BWP', 'rs_sqft': 450, 'area_sqft': 64, 'total': 28800, 'lifetime': '8-12', 'budget': 'Middle', 'multiplyable': True},
-            {'type': 'King (180x200cm)', 'wood': 'Pine', 'thickness': 25, 'grade': 'Solid A', 'rs_sqft': 600, 'area_sqft': 72, 'total': 43200, 'lifetime': '12-20', 'budget': 'Middle', 'multiplyable': True},
-            {'type': 'King (180x200cm)', 'wood': 'Sheesham', 'thickness': 25, 'grade': 'Solid A', 'rs_sqft': 1000, 'area_sqft': 72, 'total': 72000, 'lifetime': '15-25', 'budget': 'Premium', 'multiplyable': True},
-            {'type': 'Extra Large (200x200cm)', 'wood': 'Teak', 'thickness': 25, 'grade': 'Solid AA', 'rs_sqft': 2000, 'area_sqft': 80, 'total': 160000, 'lifetime': '50+', 'budget': 'Premium', 'multiplyable': True}
-        ],
-        'wardrobe': [
-            {'type': '3-door (6x7ft)', 'wood': 'Plywood', 'thickness': 12, 'grade': 'BWR', 'rs_sqft': 90, 'area_sqft': 120, 'total': 10800, 'lifetime': '5-8', 'budget': 'Budget', 'multiplyable': False},
-            {'type': '4-door (7x7ft)', 'wood': 'MDF', 'thickness': 18, 'grade': 'MR', 'rs_sqft': 100, 'area_sqft': 140, 'total': 14000, 'lifetime': '6-10', 'budget': 'Budget', 'multiplyable': False},
-            {'type': '4-door w/drawers (8x7ft)', 'wood': 'Pine', 'thickness': 25, 'grade': 'Solid A', 'rs_sqft': 650, 'area_sqft': 160, 'total': 104000, 'lifetime': '15-20', 'budget': 'Middle', 'multiplyable': False},
-            {'type': 'Designer (8x8ft)', 'wood': 'Teak', 'thickness': 25, 'grade': 'Solid AA', 'rs_sqft': 2200, 'area_sqft': 180, 'total': 396000, 'lifetime': '50+', 'budget': 'Premium', 'multiplyable': False}
-        ],
-        'nightstand': [
-            {'type': '2ft Basic', 'wood': 'Plywood', 'thickness': 18, 'grade': 'BWP', 'rs_sqft': 160, 'area_sqft': 20, 'total': 3200, 'lifetime': '8-12', 'budget': 'Budget', 'multiplyable': True},
-            {'type': '3ft Standard', 'wood': 'Engineered', 'thickness': 18, 'grade': 'BWP', 'rs_sqft': 500, 'area_sqft': 30, 'total': 15000, 'lifetime': '10-15', 'budget': 'Middle', 'multiplyable': True},
-            {'type': '4ft Drawers', 'wood': 'Pine', 'thickness': 25, 'grade': 'Solid A', 'rs_sqft': 700, 'area_sqft': 40, 'total': 28000, 'lifetime': '12-20', 'budget': 'Middle', 'multiplyable': True},
-            {'type': '5ft Premium', 'wood': 'Teak', 'thickness': 25, 'grade': 'Solid AA', 'rs_sqft': 2500, 'area_sqft': 50, 'total': 125000, 'lifetime': '50+', 'budget': 'Premium', 'multiplyable': True}
-        ]
-    },
-    'bathroom': {
-        'vanity': [
-            {'type': '4ft Single Sink', 'wood': 'Plywood', 'thickness': 18, 'grade': 'Marine BWP', 'rs_sqft': 200, 'area_sqft': 36, 'total': 7200, 'lifetime': '8-12', 'budget': 'Budget', 'multiplyable': False},
-            {'type': '5ft Double Sink', 'wood': 'Pine', 'thickness': 25, 'grade': 'Marine Solid', 'rs_sqft': 800, 'area_sqft': 50, 'total': 40000, 'lifetime': '12-20', 'budget': 'Middle', 'multiplyable': False},
-            {'type': '6ft Luxury', 'wood': 'Teak', 'thickness': 25, 'grade': 'Sealed AA', 'rs_sqft': 2500, 'area_sqft': 72, 'total': 180000, 'lifetime': '50+', 'budget': 'Premium', 'multiplyable': False}
-        ],
-        'mirror_cabinet': [
-            {'type': 'Wall 3ft', 'wood': 'MDF', 'thickness': 12, 'grade': 'Waterproof', 'rs_sqft': 70, 'area_sqft': 18, 'total': 1260, 'lifetime': '3-6', 'budget': 'Budget', 'multiplyable': True},
-            {'type': 'Floor 4ft', 'wood': 'Plywood', 'thickness': 18, 'grade': 'BWP', 'rs_sqft': 180, 'area_sqft': 32, 'total': 5760, 'lifetime': '7-12', 'budget': 'Budget', 'multiplyable': True},
-            {'type': 'Tall 6ft', 'wood': 'Sheesham', 'thickness': 25, 'grade': 'Sealed', 'rs_sqft': 1200, 'area_sqft': 60, 'total': 72000, 'lifetime': '15-25', 'budget': 'Premium', 'multiplyable': True}
-        ]
-    },
-    'kitchen': {
-        'counter': [
-            {'type': '6ft Basic', 'wood': 'Plywood', 'thickness': 18, 'grade': 'BWP', 'rs_sqft': 150, 'area_sqft': 36, 'total': 5400, 'lifetime': '8-12', 'budget': 'Budget', 'multiplyable': False},
-            {'type': '8ft Standard', 'wood': 'MDF', 'thickness': 18, 'grade': 'MR', 'rs_sqft': 90, 'area_sqft': 48, 'total': 4320, 'lifetime': '6-10', 'budget': 'Budget', 'multiplyable': False},
-            {'type': '10ft L-Shape', 'wood': 'Pine', 'thickness': 25, 'grade': 'Solid A', 'rs_sqft': 650, 'area_sqft': 80, 'total': 52000, 'lifetime': '15-20', 'budget': 'Middle', 'multiplyable': False},
-            {'type': '12ft Island', 'wood': 'Teak', 'thickness': 25, 'grade': 'Solid AA', 'rs_sqft': 2200, 'area_sqft': 120, 'total': 264000, 'lifetime': '50+', 'budget': 'Premium', 'multiplyable': False}
-        ],
-        'wall_cabinet': [
-            {'type': '4ft Single', 'wood': 'MDF', 'thickness': 12, 'grade': 'MR', 'rs_sqft': 70, 'area_sqft': 24, 'total': 1680, 'lifetime': '4-8', 'budget': 'Budget', 'multiplyable': True},
-            {'type': '6ft Double', 'wood': 'Plywood', 'thickness': 18, 'grade': 'BWR', 'rs_sqft': 100, 'area_sqft': 36, 'total': 3600, 'lifetime': '5-10', 'budget': 'Budget', 'multiplyable': True},
-            {'type': '8ft Tall', 'wood': 'Sheesham', 'thickness': 25, 'grade': 'Solid A', 'rs_sqft': 1000, 'area_sqft': 60, 'total': 60000, 'lifetime': '15-25', 'budget': 'Premium', 'multiplyable': True}
-        ]
-    },
-    'living_hall': {
-        'sofa': [
-            {'type': '2-Seater (5ft)', 'wood': 'Plywood', 'thickness': 18, 'grade': 'BWR', 'rs_sqft': 110, 'area_sqft': 50, 'total': 5500, 'lifetime': '5-10', 'budget': 'Budget', 'multiplyable': True},
-            {'type': '3-Seater (7ft)', 'wood': 'MDF', 'thickness': 18, 'grade': 'MR', 'rs_sqft': 90, 'area_sqft': 70, 'total': 6300, 'lifetime': '6-12', 'budget': 'Budget', 'multiplyable': True},
-            {'type': 'L-Shape (10ft)', 'wood': 'Pine', 'thickness': 25, 'grade': 'Solid A', 'rs_sqft': 650, 'area_sqft': 120, 'total': 78000, 'lifetime': '15-25', 'budget': 'Middle', 'multiplyable': True},
-            {'type': 'Sectional (12ft)', 'wood': 'Teak', 'thickness': 25, 'grade': 'Solid AA', 'rs_sqft': 2200, 'area_sqft': 160, 'total': 352000, 'lifetime': '50+', 'budget': 'Premium', 'multiplyable': True}
-        ],
-        'tv_unit': [
-            {'type': '4ft Basic', 'wood': 'MDF', 'thickness': 12, 'grade': 'MR', 'rs_sqft': 60, 'area_sqft': 24, 'total': 1440, 'lifetime': '4-8', 'budget': 'Budget', 'multiplyable': False},
-            {'type': '5ft Standard', 'wood': 'Plywood', 'thickness': 18, 'grade': 'BWR', 'rs_sqft': 100, 'area_sqft': 36, 'total': 3600, 'lifetime': '6-12', 'budget': 'Budget', 'multiplyable': False},
-            {'type': '6ft w/Shelves', 'wood': 'Sheesham', 'thickness': 25, 'grade': 'Solid A', 'rs_sqft': 1000, 'area_sqft': 54, 'total': 54000, 'lifetime': '15-25', 'budget': 'Premium', 'multiplyable': False}
-        ],
-        'coffee_table': [
-            {'type': '3x2ft Basic', 'wood': 'Plywood', 'thickness': 18, 'grade': 'BWR', 'rs_sqft': 90, 'area_sqft': 18, 'total': 1620, 'lifetime': '5-8', 'budget': 'Budget', 'multiplyable': True},
-            {'type': '4x2ft Glass Top', 'wood': 'Engineered', 'thickness': 18, 'grade': 'BWP', 'rs_sqft': 500, 'area_sqft': 24, 'total': 12000, 'lifetime': '10-15', 'budget': 'Middle', 'multiplyable': True}
-        ]
-    }
-}
+import os, time, traceback, random, threading, json, base64, atexit, sqlite3, itertools, hashlib
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import DataError, IntegrityError
+from functools import partial
+from render_jobs import JobManager
+from broker import open_broker
+from artifact_store import ArtifactStore
+from render_pipeline import AI_RENDERER_AVAILABLE, run_render_job, warm_up
+from metrics import metrics
+from admission import AdmissionController, AdmissionRejected
+from single_flight import SingleFlight, StatusTable, request_fingerprint
+from ingest import ingest_upload, IngestError, MAX_UPLOAD_BYTES
+from image_encoding import negotiate
+from derived_artifacts import DerivedArtifacts, build_pyramid, compose_comparison, comparison_options
+from concurrent.futures import ThreadPoolExecutor
+from write_behind import WriteBehindQueue
+from furniture_catalog import CatalogFile
+from quote_engine import engine_for, clamp_quantity, MAX_COMBINATIONS
 
 
 app = Flask(__name__)
 CORS(app, resources={r"/*": {"origins": "*"}})
 
 basedir = os.path.abspath(os.path.dirname(__file__))
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.join(basedir, 'interioai.db')
+app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('INTERIOAI_DATABASE_URL',
+                                                  'sqlite:///' + os.path.join(basedir, 'interioai.db'))
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-app.config['SECRET_KEY'] = 'interioai-secret-key-change-in-production'
+app.config['SECRET_KEY'] = os.environ.get('INTERIOAI_SECRET_KEY', 'interioai-secret-key-change-in-production')
+# Photo limit plus room for the other form fields
+app.config['MAX_CONTENT_LENGTH'] = MAX_UPLOAD_BYTES + 1024 * 1024
 
 db = SQLAlchemy(app)
 
+# WAL lets readers run alongside the single writer; writers that find the
+# file locked wait up to busy_timeout instead of failing with "database is locked"
+SQLITE_WAL = os.environ.get('INTERIOAI_SQLITE_WAL', '1') != '0'
+SQLITE_BUSY_TIMEOUT_MS = 5000
+
+
+@event.listens_for(Engine, 'connect')
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    if not isinstance(dbapi_connection, sqlite3.Connection):
+        return
+    cursor = dbapi_connection.cursor()
+    cursor.execute(f"PRAGMA busy_timeout = {SQLITE_BUSY_TIMEOUT_MS}")
+    if SQLITE_WAL:
+        cursor.execute("PRAGMA journal_mode = WAL")
+        cursor.execute("PRAGMA synchronous = NORMAL")  # durable at checkpoints, no fsync per commit
+        cursor.execute("PRAGMA cache_size = -16000")  # 16 MB page cache
+        cursor.execute("PRAGMA temp_store = MEMORY")
+    cursor.close()
+
 UPLOAD_DIR = os.path.join(basedir, 'uploads')
 OUTPUT_DIR = os.path.join(basedir, 'output')
 os.makedirs(UPLOAD_DIR, exist_ok=True)
@@ -116,12 +78,15 @@ class User(db.Model):
             'name': self.name,
             'email': self.email,
             'created_at': self.created_at.isoformat() if self.created_at else None,
-            'designs_count': len(self.designs) if self.designs else 0
+            # COUNT over the (user_id, created_at, id) index instead of loading every design
+            'designs_count': db.session.query(db.func.count(Design.id)).filter(Design.user_id == self.id).scalar()
         }
 
 
 class Design(db.Model):
     __tablename__ = 'design'
+    # history pages walk this index newest-first (keyset pagination)
+    __table_args__ = (db.Index('ix_design_user_created', 'user_id', 'created_at', 'id'),)
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     room_type = db.Column(db.String(50), nullable=False)
@@ -131,27 +96,124 @@ class Design(db.Model):
     length = db.Column(db.String(20), nullable=False)
     estimated_cost = db.Column(db.Integer, nullable=True)
     created_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+    # content-addressed artifact names - referenced files are never evicted
+    before_artifact = db.Column(db.String(80), nullable=True)
+    after_artifact = db.Column(db.String(80), nullable=True)
+    # downscaled copies of the render for galleries, filled in by a background job
+    thumb_artifact = db.Column(db.String(80), nullable=True)
+    medium_artifact = db.Column(db.String(80), nullable=True)
+
+    def to_dict(self, fields=None):
+        return design_dict(self, fields or DESIGN_FIELDS)
+
+
+# Design API field -> the column it is read from
+DESIGN_FIELDS = {
+    'id': 'id',
+    'user_id': 'user_id',
+    'room_type': 'room_type',
+    'style': 'style',
+    'palette': 'palette',
+    'width': 'width',
+    'length': 'length',
+    'estimated_cost': 'estimated_cost',
+    'before_url': 'before_artifact',
+    'after_url': 'after_artifact',
+    'thumbnail_url': 'thumb_artifact',
+    'medium_url': 'medium_artifact',
+    'created_at': 'created_at'
+}
+
+
+def design_dict(row, fields):
+    """API dict for a Design or a projected row holding the fields' columns"""
+    result = {}
+    for field in fields:
+        value = getattr(row, DESIGN_FIELDS[field])
+        if field == 'created_at':
+            value = value.isoformat() if value else None
+        elif field == 'before_url':
+            value = upload_artifacts.url(value) if value else None
+        elif field.endswith('_url'):
+            value = output_artifacts.url(value) if value else None
+        result[field] = value
+    return result
 
-    def to_dict(self):
-        return {
-            'id': self.id,
-            'user_id': self.user_id,
-            'room_type': self.room_type,
-            'style': self.style,
-            'palette': self.palette,
-            'width': self.width,
-            'length': self.length,
-            'estimated_cost': self.estimated_cost,
-            'created_at': self.created_at.isoformat() if self.created_at else None
-        }
+
+def add_missing_columns(table, columns):
+    """create_all() does not alter existing tables - add columns introduced since"""
+    existing = {row[1] for row in db.session.execute(db.text(f"PRAGMA table_info({table})"))}
+    for name, ddl in columns.items():
+        if name not in existing:
+            db.session.execute(db.text(f"ALTER TABLE {table} ADD COLUMN {name} {ddl}"))
+            print(f" Added column {table}.{name}")
+    db.session.commit()
 
 
 def init_db():
     with app.app_context():
         db.create_all()
+        add_missing_columns('design', {'before_artifact': 'VARCHAR(80)', 'after_artifact': 'VARCHAR(80)',
+                                       'thumb_artifact': 'VARCHAR(80)', 'medium_artifact': 'VARCHAR(80)'})
+        for index in Design.__table__.indexes:
+            index.create(db.engine, checkfirst=True)
         print("Database initialized")
 
 
+# Password hashing is deliberately CPU-heavy: it runs on a small pool so a burst
+# of logins uses at most AUTH_HASH_WORKERS cores and never starves rendering.
+# Beyond AUTH_HASH_MAX_PENDING waiting requests, auth answers 429.
+AUTH_HASH_WORKERS = 2
+AUTH_HASH_MAX_PENDING = 32
+AUTH_HASH_WAIT_S = 2.0
+auth_pool = ThreadPoolExecutor(max_workers=AUTH_HASH_WORKERS, thread_name_prefix='auth')
+auth_slots = threading.BoundedSemaphore(AUTH_HASH_MAX_PENDING)
+
+
+def run_password_hash(fn, *args):
+    """generate_password_hash / check_password_hash on the auth pool"""
+    if not auth_slots.acquire(timeout=AUTH_HASH_WAIT_S):
+        metrics.incr('auth_rejected')
+        raise AdmissionRejected('auth', 1, AUTH_HASH_MAX_PENDING)
+    started = time.time()
+    try:
+        return auth_pool.submit(fn, *args).result()
+    finally:
+        auth_slots.release()
+        metrics.observe('password_hash_seconds', time.time() - started)
+
+
+# Signed session tokens: issued at login/signup, sent back as
+# "Authorization: Bearer <token>" and checked with one HMAC - no database hit
+SESSION_TOKEN_MAX_AGE_S = 7 * 24 * 3600
+session_tokens = URLSafeTimedSerializer(app.config['SECRET_KEY'], salt='interioai-session')
+
+
+def issue_token(user):
+    return session_tokens.dumps({'uid': user.id})
+
+
+@app.before_request
+def authenticate():
+    """Set g.user_id from a Bearer token; a bad or expired token is a 401"""
+    header = request.headers.get('Authorization', '')
+    if not header.startswith('Bearer '):
+        return None
+    try:
+        g.user_id = int(session_tokens.loads(header[len('Bearer '):].strip(), max_age=SESSION_TOKEN_MAX_AGE_S)['uid'])
+    except (BadSignature, KeyError, TypeError, ValueError):
+        metrics.incr('auth_invalid_tokens')
+        return jsonify({'success': False, 'error': 'Invalid or expired session token'}), 401
+    return None
+
+
+def forbidden_user(user_id):
+    """403 response when a token holder asks for another user's data, else None"""
+    if g.get('user_id') is not None and g.user_id != user_id:
+        return jsonify({'success': False, 'error': 'Not allowed'}), 403
+    return None
+
+
 @app.route('/api/auth/signup', methods=['POST'])
 def signup():
     try:
@@ -160,10 +222,14 @@ def signup():
             return jsonify({'success': False, 'error': 'Missing required fields'}), 400
         if User.query.filter_by(email=data['email']).first():
             return jsonify({'success': False, 'error': 'Email already registered'}), 409
-        new_user = User(name=data['name'], email=data['email'], password=generate_password_hash(data['password']))
+        password = run_password_hash(generate_password_hash, data['password'])
+        new_user = User(name=data['name'], email=data['email'], password=password)
         db.session.add(new_user)
         db.session.commit()
-        return jsonify({'success': True, 'message': 'User registered successfully', 'user': new_user.to_dict()}), 201
+        return jsonify({'success': True, 'message': 'User registered successfully', 'user': new_user.to_dict(),
+                        'token': issue_token(new_user), 'expires_in': SESSION_TOKEN_MAX_AGE_S}), 201
+    except AdmissionRejected as rejected:
+        return busy_response(rejected)
     except Exception as e:
         db.session.rollback()
         traceback.print_exc()
@@ -177,22 +243,42 @@ def login():
         if not data or not data.get('email') or not data.get('password'):
             return jsonify({'success': False, 'error': 'Email and password required'}), 400
         user = User.query.filter_by(email=data['email']).first()
-        if not user or not check_password_hash(user.password, data['password']):
+        if not user or not run_password_hash(check_password_hash, user.password, data['password']):
             return jsonify({'success': False, 'error': 'Invalid email or password'}), 401
-        return jsonify({'success': True, 'message': 'Login successful', 'user': user.to_dict(), 'user_id': user.id}), 200
+        return jsonify({'success': True, 'message': 'Login successful', 'user': user.to_dict(), 'user_id': user.id,
+                        'token': issue_token(user), 'expires_in': SESSION_TOKEN_MAX_AGE_S}), 200
+    except AdmissionRejected as rejected:
+        return busy_response(rejected)
     except Exception as e:
         traceback.print_exc()
         return jsonify({'success': False, 'error': str(e)}), 500
 
 
+# Furniture catalog: indexed and pre-serialized once, reloaded when the file changes
+FURNITURE_CATALOG_PATH = os.environ.get('INTERIOAI_FURNITURE_CATALOG', os.path.join(basedir, 'furniture_catalog.json'))
+furniture_catalog = CatalogFile(FURNITURE_CATALOG_PATH)
+
+
 # NEW FURNITURE ENDPOINTS
 @app.route('/api/furniture/<room_type>', methods=['GET'])
 def get_furniture(room_type):
-    """Get furniture options for a specific room type"""
+    """Get furniture options for a specific room type (ETag / gzip, body built at load time)"""
     try:
-        room_key = room_type.lower().replace(' ', '_')
-        furniture = FURNITURE_DATABASE.get(room_key, FURNITURE_DATABASE['bedroom'])
-        return jsonify({'success': True, 'furniture': furniture}), 200
+        payload = furniture_catalog.get().payload(room_type)
+        # q-values parsed, so "gzip;q=0" means no gzip; each encoding gets its own strong ETag
+        gzipped = request.accept_encodings['gzip'] > 0
+        etag = f"{payload.etag}-gz" if gzipped else payload.etag
+        if request.if_none_match.contains(etag):
+            response = Response(status=304)
+        elif gzipped:
+            response = Response(payload.gzipped, mimetype='application/json')
+            response.headers['Content-Encoding'] = 'gzip'
+        else:
+            response = Response(payload.body, mimetype='application/json')
+        response.set_etag(etag)
+        response.headers['Cache-Control'] = 'no-cache'  # revalidate - the catalog can be reloaded
+        response.headers['Vary'] = 'Accept-Encoding'
+        return response
     except Exception as e:
         traceback.print_exc()
         return jsonify({'success': False, 'error': str(e)}), 500
@@ -204,6 +290,7 @@ def calculate_furniture_cost():
     try:
         data = request.get_json() or {}
         selections = data.get('selections', [])
+        catalog = furniture_catalog.get()
         
         total = 0
         items_breakdown = []
@@ -211,16 +298,15 @@ def calculate_furniture_cost():
         
         for selection in selections:
             category = selection.get('category')
-            item_index = selection.get('itemIndex', 0)
-            quantity = int(selection.get('quantity', 1))
-            room_type = selection.get('room_type', 'bedroom')
+            quantity = clamp_quantity(selection.get('quantity', 1))
+            if selection.get('item_id'):
+                item = catalog.item_by_id(selection['item_id'])
+            else:
+                item = catalog.item(selection.get('room_type', 'bedroom'), category, selection.get('itemIndex', 0))
             
-            room_key = room_type.lower().replace(' ', '_')
-            furniture = FURNITURE_DATABASE.get(room_key, FURNITURE_DATABASE['bedroom'])
-            
-            if category in furniture and 0 <= item_index < len(furniture[category]):
-                item = furniture[category][item_index]
-                item_total = int(item.get('total', 0)) * max(1, quantity)
+            if item is not None:
+                category = item['category']
+                item_total = int(item.get('total', 0)) * quantity
                 total += item_total
                 budget = item.get('budget', 'Budget')
                 if budget not in budget_breakdown:
@@ -228,6 +314,7 @@ def calculate_furniture_cost():
                 budget_breakdown[budget] += item_total
                 
                 items_breakdown.append({
+                    'item_id': item['id'],
                     'category': category,
                     'type': item.get('type'),
                     'wood': item.get('wood'),
@@ -250,8 +337,73 @@ def calculate_furniture_cost():
         return jsonify({'success': False, 'error': str(e)}), 500
 
 
+# Batch quotes: above QUOTE_STREAM_THRESHOLD (or on Accept: application/x-ndjson) results stream as NDJSON
+MAX_QUOTE_SETS = 100000
+QUOTE_STREAM_THRESHOLD = 1000
+
+
+@app.route('/api/furniture/calculate-cost/batch', methods=['POST'])
+def calculate_furniture_cost_batch():
+    """
+    Price many selection sets at once. Body is either
+      {"selection_sets": [[selection, ...], ...]}  - selections as for /calculate-cost
+      {"room_type": ..., "combinations": {category: [itemIndex, ...] | "all"}, "quantities": {category: n}}
+    and each result has index, total_cost, budget_breakdown and items_count
+    (plus `selection` for combinations). Items breakdowns are left to /calculate-cost.
+    """
+    try:
+        data = request.get_json() or {}
+        engine = engine_for(furniture_catalog.get())
+        try:
+            if 'combinations' in data:
+                room_type = data.get('room_type', 'bedroom')
+                choices, quantities = data['combinations'], data.get('quantities') or {}
+                count = engine.combination_count(room_type, choices)
+                if count > MAX_COMBINATIONS:
+                    raise ValueError(f"{count} combinations exceeds the limit of {MAX_COMBINATIONS}")
+                quotes = engine.quote_combinations(room_type, choices, quantities)
+            else:
+                selection_sets = data.get('selection_sets')
+                if not isinstance(selection_sets, list):
+                    raise ValueError('selection_sets must be a list of selection lists')
+                if len(selection_sets) > MAX_QUOTE_SETS:
+                    raise ValueError(f"At most {MAX_QUOTE_SETS} selection sets per batch")
+                count = len(selection_sets)
+                quotes = engine.quote_sets(selection_sets)
+            # price the first chunk now so a malformed request is a 400, not a broken stream
+            first = next(quotes, None)
+            if first is not None:
+                quotes = itertools.chain([first], quotes)
+        except (ValueError, TypeError, AttributeError) as e:
+            return jsonify({'success': False, 'error': str(e)}), 400
+        metrics.incr('quote_batches', mode='combinations' if 'combinations' in data else 'sets')
+        metrics.observe('quote_batch_size', count)
+
+        headers = {'X-Quote-Count': str(count), 'X-Catalog-Version': str(engine.catalog.version)}
+        if count > QUOTE_STREAM_THRESHOLD or 'application/x-ndjson' in request.headers.get('Accept', ''):
+            def stream():
+                try:
+                    for quote in quotes:
+                        yield json.dumps(quote, separators=(',', ':')) + '\n'
+                except Exception as e:
+                    # a later chunk failed - the status is already sent, so end with an error line
+                    traceback.print_exc()
+                    yield json.dumps({'success': False, 'error': str(e)}) + '\n'
+            return Response(stream_with_context(stream()), mimetype='application/x-ndjson', headers=headers)
+
+        response = jsonify({'success': True, 'count': count, 'quotes': list(quotes)})
+        response.headers.extend(headers)
+        return response, 200
+    except Exception as e:
+        traceback.print_exc()
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+
 @app.route('/api/users/<int:user_id>', methods=['GET'])
 def get_user(user_id):
+    denied = forbidden_user(user_id)
+    if denied:
+        return denied
     try:
         user = User.query.get(user_id)
         if not user:
@@ -266,27 +418,35 @@ def get_user(user_id):
 def save_design():
     try:
         data = request.get_json() or {}
-        user_id = data.get('user_id')
-        user = None
-        if user_id is not None:
-            try:
-                user_id = int(user_id)
-                user = User.query.get(user_id)
-            except:
-                user = None
-
+        # the owner comes from the session token only - a body user_id could name anyone
+        user_id = g.get('user_id')
+        if user_id is None:
+            return jsonify({'success': False, 'error': 'Login required'}), 401
+        user = User.query.get(user_id)
         if not user:
             return jsonify({'success': False, 'error': 'User not found'}), 404
 
         required_fields = ['room_type', 'style', 'palette', 'width', 'length']
         for field in required_fields:
-            if field not in data:
+            # null would only fail NOT NULL at commit - too late for a queued save
+            if data.get(field) is None:
                 return jsonify({'success': False, 'error': f'Missing field: {field}'}), 400
-        new_design = Design(user_id=user_id, room_type=data['room_type'], style=data['style'],
-                           palette=data['palette'], width=data['width'], length=data['length'],
-                           estimated_cost=data.get('estimated_cost'))
+        before_artifact, after_artifact = design_artifacts(data)
+        row = {'user_id': user_id, 'room_type': data['room_type'], 'style': data['style'],
+               'palette': data['palette'], 'width': data['width'], 'length': data['length'],
+               'estimated_cost': data.get('estimated_cost'), 'created_at': datetime.utcnow(),
+               'before_artifact': before_artifact, 'after_artifact': after_artifact}
+        if design_writer is not None:
+            # committed with the next batch - listed within DESIGN_WRITE_DELAY_S; no id until then
+            design_writer.put(row)
+            design = design_dict(Design(**row), [field for field in DESIGN_FIELDS if field != 'id'])
+            return jsonify({'success': True, 'message': 'Design queued for saving', 'queued': True,
+                            'design': design}), 202
+        new_design = Design(**row)
         db.session.add(new_design)
         db.session.commit()
+        if new_design.after_artifact:
+            schedule_pyramid(new_design.id)
         return jsonify({'success': True, 'message': 'Design saved successfully', 'design': new_design.to_dict()}), 201
     except Exception as e:
         db.session.rollback()
@@ -294,14 +454,107 @@ def save_design():
         return jsonify({'success': False, 'error': str(e)}), 500
 
 
+# Design saves are batched: one transaction per DESIGN_WRITE_BATCH rows or
+# DESIGN_WRITE_DELAY_S, whichever comes first. Queued rows are flushed at exit.
+DESIGN_WRITE_BEHIND = os.environ.get('INTERIOAI_DESIGN_WRITE_BEHIND', '1') != '0'
+DESIGN_WRITE_BATCH = 200
+DESIGN_WRITE_DELAY_S = 0.5
+
+
+def write_designs(rows):
+    with app.app_context():
+        designs = [Design(**row) for row in rows]
+        try:
+            db.session.add_all(designs)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        for design in designs:
+            if design.after_artifact:
+                schedule_pyramid(design.id)
+
+
+design_writer = None
+if DESIGN_WRITE_BEHIND:
+    # only rows the database rejects are dropped; "database is locked" and the like are retried
+    design_writer = WriteBehindQueue(write_designs, name='design_saves', max_batch=DESIGN_WRITE_BATCH,
+                                     max_delay_s=DESIGN_WRITE_DELAY_S, permanent=(IntegrityError, DataError))
+    atexit.register(design_writer.close)
+
+
+DESIGN_PAGE_SIZE = 20
+MAX_DESIGN_PAGE_SIZE = 100
+
+
+def encode_cursor(created_at, design_id):
+    return base64.urlsafe_b64encode(f"{created_at.isoformat()}|{design_id}".encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(cursor):
+    """(created_at, id) of the last row of the previous page; ValueError if malformed"""
+    try:
+        created_at, design_id = base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8').split('|')
+        return datetime.fromisoformat(created_at), int(design_id)
+    except Exception:
+        raise ValueError('Invalid cursor')
+
+
 @app.route('/api/designs/<int:user_id>', methods=['GET'])
 def get_user_designs(user_id):
+    """
+    Newest designs first, one page at a time.
+    ?limit=20 (max 100), ?cursor=<next_cursor of the previous page>,
+    ?fields=id,room_type,thumbnail_url (default: all fields)
+    """
+    denied = forbidden_user(user_id)
+    if denied:
+        return denied
     try:
-        user = User.query.get(user_id)
-        if not user:
+        if not db.session.query(User.id).filter_by(id=user_id).first():
             return jsonify({'success': False, 'error': 'User not found'}), 404
-        designs = Design.query.filter_by(user_id=user_id).order_by(Design.created_at.desc()).all()
-        return jsonify({'success': True, 'designs': [d.to_dict() for d in designs], 'total': len(designs)}), 200
+
+        fields = [f for f in request.args.get('fields', '').split(',') if f] or list(DESIGN_FIELDS)
+        unknown = [f for f in fields if f not in DESIGN_FIELDS]
+        if unknown:
+            return jsonify({'success': False, 'error': f"Unknown fields: {', '.join(unknown)}"}), 400
+        try:
+            limit = min(max(int(request.args.get('limit', DESIGN_PAGE_SIZE)), 1), MAX_DESIGN_PAGE_SIZE)
+        except ValueError:
+            return jsonify({'success': False, 'error': 'limit must be a number'}), 400
+
+        # only the requested columns, plus what paging and thumbnail backfill need
+        column_names = {DESIGN_FIELDS[f] for f in fields} | {'id', 'created_at'}
+        if 'thumbnail_url' in fields:
+            column_names |= {'after_artifact', 'thumb_artifact'}
+        query = db.session.query(*[getattr(Design, name) for name in sorted(column_names)]) \
+            .filter(Design.user_id == user_id)
+        cursor = request.args.get('cursor')
+        if cursor:
+            try:
+                created_at, design_id = decode_cursor(cursor)
+            except ValueError as e:
+                return jsonify({'success': False, 'error': str(e)}), 400
+            query = query.filter(db.or_(Design.created_at < created_at,
+                                        db.and_(Design.created_at == created_at, Design.id < design_id)))
+        rows = query.order_by(Design.created_at.desc(), Design.id.desc()).limit(limit + 1).all()
+
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+        if 'thumbnail_url' in fields:
+            for row in rows:
+                if row.after_artifact and not row.thumb_artifact:
+                    schedule_pyramid(row.id)  # saved before thumbnails existed, or the job failed
+
+        response = {
+            'success': True,
+            'designs': [design_dict(row, fields) for row in rows],
+            'next_cursor': encode_cursor(rows[-1].created_at, rows[-1].id) if has_more else None,
+            'has_more': has_more
+        }
+        if not cursor:
+            response['total'] = db.session.query(db.func.count(Design.id)).filter(Design.user_id == user_id).scalar()
+        return jsonify(response), 200
     except Exception as e:
         traceback.print_exc()
         return jsonify({'success': False, 'error': str(e)}), 500
@@ -319,28 +572,443 @@ def home():
 
 @app.route('/uploads/<path:filename>')
 def serve_uploads(filename):
+    upload_artifacts.touch(filename)
     return send_from_directory(UPLOAD_DIR, filename)
 
 
 @app.route('/output/<path:filename>')
 def serve_output(filename):
+    output_artifacts.touch(filename)
     return send_from_directory(OUTPUT_DIR, filename)
 
 
+def read_design_form(form):
+    """Design preferences posted by the front end"""
+    return {
+        'room_type': form.get('roomType') or 'Living Hall',
+        'style': form.get('style') or 'Modern',
+        'palette': form.get('palette') or form.get('customColor') or 'neutral',
+        'width': form.get('width', '10'),
+        'length': form.get('length', '12'),
+        # from the session token only; anonymous renders carry no user
+        'user_id': g.get('user_id'),
+        'quality': form.get('quality', 'quality'),
+        # WebP/JPEG for clients that accept them (format= overrides), PNG otherwise
+        'output_format': negotiate(request.headers.get('Accept'), form.get('format'))
+    }
+
+
+def scheduling_key():
+    """
+    Fair-share queue key: the User id from the session token, or the client
+    address - never a form field, or rotating user_id values would buy extra queues
+    """
+    if g.get('user_id') is not None:
+        return f"user:{g.user_id}"
+    return f"anon:{request.remote_addr}"
+
+
+# EventSource cannot send the Authorization header, so events_url carries the
+# client's scheduling key for its job, signed
+job_clients = URLSafeSerializer(app.config['SECRET_KEY'], salt='interioai-job-client')
+
+
+def job_client(job):
+    """Client holding a share of job: the signed ?client= from its events_url, else scheduling_key()"""
+    token = request.args.get('client')
+    if token:
+        try:
+            job_id, client = job_clients.loads(token)
+            if job_id == job.id:
+                return client
+        except (BadSignature, TypeError, ValueError):
+            pass
+    return scheduling_key()
+
+
+ALLOWED_UPLOAD_EXTENSIONS = {'png', 'jpg', 'jpeg', 'webp'}
+
+
+def save_upload(stream):
+    """Stream an uploaded photo into the upload store under its content hash; returns (upload_id, before_path)"""
+    ingested = ingest_upload(stream, upload_artifacts.root, max_bytes=MAX_UPLOAD_BYTES)
+    if ingested.created:
+        print(f" Stored upload {ingested.upload_id}: {ingested.format} {ingested.width}x{ingested.height}, "
+              f"{ingested.size_bytes / 1024:.0f} KB")
+    return ingested.upload_id, ingested.path
+
+
+def find_upload(upload_id):
+    """Path of a photo stored by save_upload, or None"""
+    if not upload_id or not upload_id.isalnum():
+        return None
+    for ext in ALLOWED_UPLOAD_EXTENSIONS:
+        name = f"upload_{upload_id}.{ext}"
+        if upload_artifacts.exists(name):
+            return upload_artifacts.path(name)
+    return None
+
+
+def resolve_photo(form):
+    """(upload_id, before_path) for an earlier /api/uploads id or the posted photo; (None, None) if neither"""
+    upload_id = form.get('upload_id')
+    if upload_id:
+        before_path = find_upload(upload_id)
+        return (upload_id, before_path) if before_path else (None, None)
+    photo = request.files.get('photo')
+    if not photo:
+        return None, None
+    return save_upload(photo.stream)
+
+
+def output_name(upload_id):
+    """Base name for a render's outputs - unique even for repeat renders of one photo"""
+    return f"{int(time.time())}_{upload_id[:12]}_{random.getrandbits(24):06x}.png"
+
+
+# Style-independent perception (decode, resize, Canny) runs while the user
+# is still choosing preferences, so the render starts from cached inputs
+perception_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix='perception')
+perception_status = StatusTable(ttl=3600, max_entries=1000)  # upload_id -> 'running' / 'ready' / 'failed'
+
+
+def start_perception(upload_id, before_path):
+    if not perception_status.start(upload_id):
+        return  # already running or ready
+
+    def run():
+        started = time.time()
+        try:
+            warm_up(before_path)
+            perception_status.set(upload_id, 'ready')
+            metrics.observe('perception_seconds', time.time() - started)
+        except Exception as e:
+            perception_status.set(upload_id, 'failed')
+            print(f" Pre-analysis failed for upload {upload_id}: {e}")
+
+    perception_pool.submit(run)
+
+
+# Fair-share across users: one running render per user, equal weights
+# (RENDER_USER_WEIGHTS = {'user:7': 2} gives user 7 twice the turns)
+RENDER_USER_WEIGHTS = {}
+
+# Priority classes are granted here, never taken from the request - 'high'
+# is always served first, so a client choosing it could starve everyone
+# (RENDER_PRIORITIES = {'user:7': 'high'} for an account on a priority plan)
+RENDER_PRIORITIES = {}
+
+
+def render_priority(user_key):
+    return RENDER_PRIORITIES.get(user_key, 'normal')
+
+# Jobs are persisted so a restart picks up queued and interrupted renders;
+# finished jobs stay fetchable for RENDER_JOB_RETENTION_S
+RENDER_JOB_RETENTION_S = 7 * 24 * 3600
+RENDER_BROKER_URL = os.environ.get('RENDER_BROKER', 'sqlite:///' + os.path.join(basedir, 'render_jobs.db'))
+job_store = open_broker(RENDER_BROKER_URL, lease_s=60, retention_s=RENDER_JOB_RETENTION_S)
+
+# Uploads and render outputs live in stores render_worker.py processes share:
+# jobs name their input photo, workers read it from the upload store
+output_artifacts = ArtifactStore(OUTPUT_DIR, url_prefix='/output')
+upload_artifacts = ArtifactStore(UPLOAD_DIR, url_prefix='/uploads')
+# Comparisons are built on first GET and then served from the output store
+derived = DerivedArtifacts(output_artifacts)
+
+# Disk quotas: expired files go first, then least recently served ones.
+# Photos and renders referenced by a saved Design are never evicted.
+OUTPUT_QUOTA_BYTES = 2 * 1024 * 1024 * 1024
+UPLOAD_QUOTA_BYTES = 1024 * 1024 * 1024
+ARTIFACT_TTL_S = 30 * 24 * 3600
+EVICTION_INTERVAL_S = 600
+
+
+def design_artifacts(data):
+    """(before, after) artifact names for a design - from its render job or the posted URLs"""
+    before, after = data.get('before_url'), data.get('after_url')
+    job = job_manager.get(data['job_id']) if data.get('job_id') else None
+    if job is not None and job.status == 'done':
+        before, after = before_url(job), job.result_url
+    return upload_artifacts.name_from_url(before), output_artifacts.name_from_url(after)
+
+
+def pinned_artifacts(*columns):
+    def names():
+        with app.app_context():
+            pinned = set()
+            for column in columns:
+                pinned.update(name for (name,) in db.session.query(column).filter(column.isnot(None)))
+            return pinned
+    return names
+
+
+output_artifacts.start_eviction(OUTPUT_QUOTA_BYTES, ARTIFACT_TTL_S,
+                                pinned_artifacts(Design.after_artifact, Design.thumb_artifact, Design.medium_artifact),
+                                interval_s=EVICTION_INTERVAL_S)
+upload_artifacts.start_eviction(UPLOAD_QUOTA_BYTES, ARTIFACT_TTL_S, pinned_artifacts(Design.before_artifact),
+                                interval_s=EVICTION_INTERVAL_S)
+
+# Thumbnail / medium / full pyramid for saved designs, built off the request path
+pyramid_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix='pyramid')
+pyramid_pending = set()
+pyramid_lock = threading.Lock()
+# designs whose pyramid failed are not retried on every listing, only after an hour
+pyramid_failures = StatusTable(ttl=3600, max_entries=10000)
+
+
+def schedule_pyramid(design_id):
+    if pyramid_failures.get(design_id):
+        return
+    with pyramid_lock:
+        if design_id in pyramid_pending:
+            return
+        pyramid_pending.add(design_id)
+
+    def run():
+        try:
+            with app.app_context():
+                design = Design.query.get(design_id)
+                if design is None or not design.after_artifact:
+                    return
+                if not output_artifacts.exists(design.after_artifact):
+                    # nothing to build from any more - stop listing it for backfill
+                    print(f" Render {design.after_artifact} of design {design_id} is gone - clearing it")
+                    design.after_artifact = None
+                    db.session.commit()
+                    return
+                levels = build_pyramid(derived, design.after_artifact)
+                design.thumb_artifact = levels['thumb']
+                design.medium_artifact = levels['medium']
+                db.session.commit()
+        except Exception as e:
+            pyramid_failures.set(design_id, 'failed')
+            metrics.incr('pyramid_failures')
+            print(f" Thumbnail pyramid failed for design {design_id}: {e}")
+        finally:
+            with pyramid_lock:
+                pyramid_pending.discard(design_id)
+
+    pyramid_pool.submit(run)
+
+
+# 'local': this process renders with its own worker thread.
+# 'broker': stateless web tier - render_worker.py processes pull the jobs.
+RENDER_DISPATCH = os.environ.get('RENDER_DISPATCH', 'local')
+# renders running in parallel: one local worker thread, or (broker) the total
+# render_worker.py processes, e.g. RENDER_WORKERS=4 for --processes 4
+RENDER_WORKERS = 1 if RENDER_DISPATCH == 'local' else max(1, int(os.environ.get('RENDER_WORKERS', '1')))
+job_manager = JobManager(partial(run_render_job, artifacts=output_artifacts, uploads=upload_artifacts),
+                         max_workers=RENDER_WORKERS if RENDER_DISPATCH == 'local' else 0,
+                         max_per_user=1, user_weights=RENDER_USER_WEIGHTS,
+                         store=job_store, heartbeat_s=15, dispatch=RENDER_DISPATCH)
+
+# Max renders queued or running per endpoint - beyond that: 429 + Retry-After
+RENDER_ADMISSION_LIMITS = {'generate': 4, 'jobs': 8}
+admission = AdmissionController(RENDER_ADMISSION_LIMITS, workers=RENDER_WORKERS)
+
+
+def busy_response(rejected):
+    """429 with a Retry-After estimated from recent render timings"""
+    response = jsonify({'success': False, 'error': 'Server busy, please retry later',
+                        'retry_after': rejected.retry_after})
+    response.headers['Retry-After'] = str(rejected.retry_after)
+    return response, 429
+
+
+# Identical renders (same photo and preferences, or same Idempotency-Key) share one job
+RENDER_DEDUP_TTL_S = 600
+render_flights = SingleFlight(ttl=RENDER_DEDUP_TTL_S)
+
+# Form fields that change the rendered image
+FINGERPRINT_FIELDS = ['room_type', 'style', 'palette', 'width', 'length', 'quality', 'output_format']
+
+
+def idempotency_key(endpoint):
+    """Flight key from the client's Idempotency-Key header, if it sent one - scoped to the caller"""
+    key = request.headers.get('Idempotency-Key', '').strip()
+    return f"{endpoint}:idem:{scheduling_key()}:{key}" if key else None
+
+
+def request_digest():
+    """Fingerprint of a render request body: preferences, seed and photo (its upload id or its bytes)"""
+    photo_id = request.form.get('upload_id')
+    photo = request.files.get('photo')
+    if not photo_id and photo:
+        digest = hashlib.sha256()
+        for chunk in iter(lambda: photo.stream.read(64 * 1024), b''):
+            digest.update(chunk)
+        photo.stream.seek(0)
+        photo_id = digest.hexdigest()[:32]  # same as the upload id ingest assigns
+    form = read_design_form(request.form)
+    fields = {name: form.get(name) for name in FINGERPRINT_FIELDS}
+    fields['seed'] = request.form.get('seed')
+    return request_fingerprint(photo_id or '', fields)
+
+
+def idempotency_conflict(job, digest):
+    """422 when an Idempotency-Key is reused with a different request body, else None"""
+    if job.params.get('request_digest') == digest:
+        return None
+    metrics.incr('idempotency_conflicts')
+    return jsonify({'success': False, 'error': 'Idempotency-Key was already used for a different request'}), 422
+
+
+def render_fingerprint(endpoint, form, upload_id, seed=None):
+    """Flight key from the photo content and the render-relevant preferences"""
+    fields = {name: form.get(name) for name in FINGERPRINT_FIELDS}
+    fields['seed'] = seed
+    return f"{endpoint}:{request_fingerprint(upload_id, fields)}"
+
+
+def submit_admitted(endpoint, params, flight_key=None):
+    """Submit a render job that holds its admission slot until it finishes"""
+    job = job_manager.submit(params)
+    job.add_done_callback(lambda finished_job: admission.release(endpoint))
+    if flight_key:
+        def forget_unless_done(finished_job):
+            # only successful renders are replayed; a retry after failure renders again
+            if finished_job.status != 'done':
+                render_flights.forget(flight_key)
+        job.add_done_callback(forget_unless_done)
+    return job
+
+
+def reusable(job):
+    """A shared job is only worth attaching to while it can still succeed"""
+    return job is not None and not job.cancel_event.is_set() and job.status in ('queued', 'running', 'done')
+
+
+def submit_once(flight_key, submit):
+    """Submit through the single-flight table; returns (job, shared)"""
+    job, shared = render_flights.run(flight_key, submit)
+    if shared and not reusable(job):
+        # the shared job failed or is being cancelled - start a fresh one
+        render_flights.forget(flight_key)
+        job, shared = render_flights.run(flight_key, submit)
+    return job, shared
+
+
+def record_dedup(endpoint, job):
+    """Count a request served by an existing job instead of a new render"""
+    job.hold(scheduling_key())
+    metrics.incr('renders_avoided', endpoint=endpoint)
+    print(f" Duplicate {endpoint} request attached to job {job.id} ({job.status})")
+
+
+def before_artifact(job):
+    """Upload artifact a job renders from (jobs queued before uploads were passed by name carry a path)"""
+    return job.params.get('before_artifact') or os.path.basename(job.params['before_path'])
+
+
+def before_url(job):
+    return upload_artifacts.url(before_artifact(job))
+
+
+def comparison_url(job, layout='side-by-side'):
+    """Stable URL of a finished job's before/after image, or None"""
+    after_name = output_artifacts.name_from_url(job.result_url)
+    if not after_name:
+        return None
+    return f"/api/comparison/{before_artifact(job)}/{after_name}?layout={layout}"
+
+
+def generate_result(job, user_id=None, deduplicated=False):
+    """Wait for a /api/generate job and build its response"""
+    # a blocked request counts as watching, so a closed event stream elsewhere cannot cancel it
+    job.attach('waiters')
+    try:
+        job.wait()
+    finally:
+        job.detach('waiters')
+    if job.status != 'done':
+        return jsonify({'success': False, 'error': job.error or f"Render {job.status}",
+                        'job_id': job.id}), 500
+
+    print(f"\n{'='*80}")
+    print("GENERATION COMPLETE")
+    print(f"{'='*80}\n")
+
+    return jsonify({
+        'success': True,
+        'user_id': user_id,
+        'before_url': before_url(job),
+        'after_url': job.result_url,
+        'comparison_url': comparison_url(job),
+        'room_type': job.params['room_type'],
+        'quality_tier': job.quality_tier,
+        'deduplicated': deduplicated
+    }), 200
+
+
+@app.route('/api/uploads', methods=['POST'])
+def upload_photo():
+    """
+    Store the photo as soon as it is picked and start perception in the background.
+    Takes the image as the raw request body (streamed) or as a multipart 'photo' field.
+    """
+    if request.mimetype.startswith('image/') or request.mimetype == 'application/octet-stream':
+        stream = request.stream
+    else:
+        photo = request.files.get('photo')
+        if not photo:
+            return jsonify({'success': False, 'error': 'No input image provided'}), 400
+        stream = photo.stream
+    try:
+        upload_id, before_path = save_upload(stream)
+    except IngestError as e:
+        metrics.incr('uploads_rejected', status=e.status)
+        return jsonify({'success': False, 'error': str(e)}), e.status
+    start_perception(upload_id, before_path)
+    return jsonify({
+        'success': True,
+        'upload_id': upload_id,
+        'before_url': f"/uploads/{os.path.basename(before_path)}",
+        'perception': perception_status.get(upload_id)
+    }), 201
+
+
+@app.route('/api/uploads/<upload_id>', methods=['GET'])
+def get_upload(upload_id):
+    before_path = find_upload(upload_id)
+    if not before_path:
+        return jsonify({'success': False, 'error': 'Upload not found'}), 404
+    return jsonify({
+        'success': True,
+        'upload_id': upload_id,
+        'before_url': f"/uploads/{os.path.basename(before_path)}",
+        'perception': perception_status.get(upload_id, 'unknown')
+    }), 200
+
+
 @app.route('/api/generate', methods=['POST'])
 @app.route('/generate', methods=['POST'])
 def generate():
+    # A retried request with the same Idempotency-Key (and the same body) never needs a slot
+    idem_key = idempotency_key('generate')
+    digest = request_digest() if idem_key else None
+    replay = render_flights.peek(idem_key) if idem_key else None
+    if reusable(replay):
+        conflict = idempotency_conflict(replay, digest)
+        if conflict:
+            return conflict
+        record_dedup('generate', replay)
+        return generate_result(replay, deduplicated=True)
+
+    # Without an Idempotency-Key, admission comes before touching request.form - parsing it buffers the upload
+    try:
+        admission.admit('generate')
+    except AdmissionRejected as rejected:
+        return busy_response(rejected)
+    submitted = False
+
     try:
         print("\n" + "="*80)
         print(" GENERATION REQUEST RECEIVED")
         print("="*80)
         
-        room_type = request.form.get('roomType') or 'Living Hall'
-        style = request.form.get('style') or 'Modern'
-        palette = request.form.get('palette') or request.form.get('customColor') or 'neutral'
-        width = request.form.get('width', '10')
-        length = request.form.get('length', '12')
-        user_id = request.form.get('user_id')
+        form = read_design_form(request.form)
+        room_type, style, palette = form['room_type'], form['style'], form['palette']
+        width, length, user_id = form['width'], form['length'], form['user_id']
 
         print(f"\n📊 Parameters: {room_type}, {style}, {palette}, {width}ft × {length}ft")
 
@@ -354,116 +1022,265 @@ def generate():
                 user_id = None
                 user_obj = None
 
-        photo = request.files.get('photo')
-        if not photo:
+        upload_id, before_path = resolve_photo(request.form)
+        if not upload_id:
             return jsonify({'success': False, 'error': 'No input image provided'}), 400
 
-        # ensure safe, non-empty filename
-        orig_name = getattr(photo, 'filename', '') or ''
-        safe_name = secure_filename(orig_name)
-        if not safe_name:
-            safe_name = f"upload_{int(time.time())}.png"
+        flight_key = idem_key or render_fingerprint('generate', form, upload_id)
+        user_key = scheduling_key()
 
-        timestamp = int(time.time())
-        original_filename = f"{timestamp}_{safe_name}"
-        before_filename = f"before_{original_filename}"
-        before_path = os.path.join(UPLOAD_DIR, before_filename)
+        def submit():
+            # Same queue as /api/jobs, but without the draft stage and waiting for the result
+            return submit_admitted('generate', dict(form, original_filename=output_name(upload_id),
+                                                    before_artifact=os.path.basename(before_path),
+                                                    seed=None, draft=False,
+                                                    user_key=user_key, priority=render_priority(user_key),
+                                                    request_digest=digest),
+                                   flight_key)
 
-        photo.save(before_path)
+        job, shared = submit_once(flight_key, submit)
+        if shared:
+            # our slot was never used - the finally below gives it back
+            conflict = idem_key and idempotency_conflict(job, digest)
+            if conflict:
+                return conflict
+            record_dedup('generate', job)
+        else:
+            submitted = True
+        return generate_result(job, user_id=user_id, deduplicated=shared)
 
-        after_filename = f"after_{original_filename}"
-        after_path = os.path.join(OUTPUT_DIR, after_filename)
+    except IngestError as e:
+        metrics.incr('uploads_rejected', status=e.status)
+        return jsonify({'success': False, 'error': str(e)}), e.status
+    except Exception as e:
+        print(f"\n ERROR: {e}")
+        traceback.print_exc()
+        return jsonify({'success': False, 'error': str(e)}), 500
+    finally:
+        if not submitted:
+            admission.release('generate')
 
-        furniture_by_room = {
-            'bedroom': ['bed', 'nightstand', 'dresser', 'wardrobe', 'bedside lamp', 'rug'],
-            'kitchen': ['dining table', 'chairs', 'bar stools', 'pendant lights', 'kitchen island', 'cabinets'],
-            'living hall': ['sofa', 'coffee table', 'TV stand', 'armchair', 'floor lamp', 'rug', 'side table'],
-            'living room': ['sofa', 'coffee table', 'TV stand', 'armchair', 'floor lamp', 'rug', 'side table'],
-            'bathroom': ['vanity', 'mirror', 'storage cabinet', 'towel rack', 'bath mat', 'shelf']
-        }
-        
-        suggested_items = furniture_by_room.get(room_type.lower(), ['sofa', 'coffee table', 'chair', 'lamp', 'rug'])
-
-        room_descriptions = {
-            'bedroom': f"A {style} bedroom with {palette} tones, cozy bed, nightstands, and warm lighting",
-            'kitchen': f"A {style} kitchen with {palette} colors, dining table, chairs, and modern appliances",
-            'living hall': f"A {style} living room with {palette} tones, comfortable sofa, coffee table, and modern furniture",
-            'living room': f"A {style} living room with {palette} tones, comfortable sofa, coffee table, and modern furniture",
-            'bathroom': f"A {style} bathroom with {palette} colors, elegant vanity, mirror, and modern fixtures"
-        }
-        
-        description = room_descriptions.get(room_type.lower(), f"A {style} interior with {palette} tones and modern furniture")
-
-        room_data = {
-            'room_type': room_type.lower().replace(' ', '_'),
-            'style': style,
-            'palette': palette,
-            'description': description,
-            'suggested_items': suggested_items,
-            'is_empty': True
-        }
 
-        print(f"\n🤖 AI Available: {AI_RENDERER_AVAILABLE}")
-        
-        if AI_RENDERER_AVAILABLE and ImageToImageRenderer is not None:
-            try:
-                print("Initializing AI renderer...")
-                renderer = ImageToImageRenderer()
-                
-                print("Generating furnished design...")
-                # defensive call: renderer may return a path or write file directly
-                result = renderer.edit_room_image(
-                    original_image_path=before_path,
-                    room_data=room_data,
-                    output_path=after_path,
-                    strength=0.75
-                )
-                
-                # if renderer wrote to a different path, try to handle it
-                if os.path.exists(after_path):
-                    print(f"AI generation successful to {after_path}")
-                else:
-                    # if result is a path and exists, copy it
-                    if isinstance(result, str) and os.path.exists(result):
-                        shutil.copy(result, after_path)
-                        print("AI generation successful (from result path)")
-                    else:
-                        # fallback: copy original
-                        print(" AI returned nothing usable; copying original image as fallback")
-                        shutil.copy(before_path, after_path)
-                    
-            except Exception as e:
-                print(f"AI error: {e}")
-                traceback.print_exc()
-                try:
-                    shutil.copy(before_path, after_path)
-                except Exception as e2:
-                    print(" Failed to copy fallback image:", e2)
+@app.route('/api/jobs', methods=['POST'])
+def create_job():
+    """Start a render in the background: draft preview first, then the final design"""
+    idem_key = idempotency_key('jobs')
+    digest = request_digest() if idem_key else None
+    replay = render_flights.peek(idem_key) if idem_key else None
+    if reusable(replay):
+        conflict = idempotency_conflict(replay, digest)
+        if conflict:
+            return conflict
+        record_dedup('jobs', replay)
+        return job_created_response(replay, estimated_wait=0, deduplicated=True)
+
+    try:
+        estimated_wait = admission.admit('jobs')
+    except AdmissionRejected as rejected:
+        return busy_response(rejected)
+    submitted = False
+
+    try:
+        form = read_design_form(request.form)
+
+        upload_id, before_path = resolve_photo(request.form)
+        if not upload_id:
+            return jsonify({'success': False, 'error': 'No input image provided'}), 400
+
+        seed = request.form.get('seed')
+        try:
+            seed = int(seed)
+        except (TypeError, ValueError):
+            seed = None
+
+        previews = request.form.get('previews', '').lower() in ('1', 'true', 'yes')
+
+        # a random seed is only drawn for the first of identical requests
+        flight_key = idem_key or render_fingerprint('jobs', form, upload_id, seed)
+        user_key = scheduling_key()
+
+        def submit():
+            job_seed = seed if seed is not None else random.randint(0, 2**31 - 1)
+            return submit_admitted('jobs', dict(form, original_filename=output_name(upload_id),
+                                                before_artifact=os.path.basename(before_path),
+                                                seed=job_seed, previews=previews,
+                                                user_key=user_key, priority=render_priority(user_key),
+                                                request_digest=digest),
+                                   flight_key)
+
+        job, shared = submit_once(flight_key, submit)
+        if shared:
+            conflict = idem_key and idempotency_conflict(job, digest)
+            if conflict:
+                return conflict
+            record_dedup('jobs', job)
         else:
-            print(" AI not available, copying original")
-            shutil.copy(before_path, after_path)
+            submitted = True
+        return job_created_response(job, estimated_wait, deduplicated=shared)
+    except IngestError as e:
+        metrics.incr('uploads_rejected', status=e.status)
+        return jsonify({'success': False, 'error': str(e)}), e.status
+    except Exception as e:
+        traceback.print_exc()
+        return jsonify({'success': False, 'error': str(e)}), 500
+    finally:
+        if not submitted:
+            admission.release('jobs')
 
-        print(f"\n{'='*80}")
-        print("GENERATION COMPLETE")
-        print(f"{'='*80}\n")
 
-        return jsonify({
-            'success': True,
-            'user_id': user_id,
-            'before_url': f"/uploads/{before_filename}",
-            'after_url': f"/output/{after_filename}",
-            'room_type': room_type
-        }), 200
+def job_created_response(job, estimated_wait, deduplicated=False):
+    return jsonify({
+        'success': True,
+        'job_id': job.id,
+        'status_url': f"/api/jobs/{job.id}",
+        'events_url': f"/api/jobs/{job.id}/events?client={job_clients.dumps([job.id, scheduling_key()])}",
+        'before_url': before_url(job),
+        'room_type': job.params['room_type'],
+        'seed': job.params['seed'],
+        'quality_tier': job.quality_tier,
+        'priority': job.priority,
+        'queue_position': job_manager.queue_depth(job.user_key),
+        'estimated_wait_s': round(estimated_wait, 1),
+        'deduplicated': deduplicated
+    }), 202
+
+
+@app.route('/api/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    job = job_manager.get(job_id)
+    if not job:
+        return jsonify({'success': False, 'error': 'Job not found'}), 404
+    result = dict(job.to_dict(), success=True)
+    if job.status == 'done':
+        result['comparison_url'] = comparison_url(job)
+    return jsonify(result), 200
+
+
+@app.route('/api/comparison/<before>/<after>', methods=['GET'])
+def get_comparison(before, after):
+    """Before/after image built on first request: ?layout=side-by-side|slider|thumbnail (&split=0.5)"""
+    try:
+        layout, options = comparison_options(request.args)
+    except ValueError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+    if not upload_artifacts.exists(before) or not output_artifacts.exists(after):
+        return jsonify({'success': False, 'error': 'Image not found'}), 404
 
+    try:
+        output_format = negotiate(request.headers.get('Accept'), request.args.get('format'))
+        name = derived.get('comparison', [before, after], options, output_format,
+                           lambda path: compose_comparison(upload_artifacts.path(before), output_artifacts.path(after),
+                                                           path, layout, options.get('split', 0.5)))
+        response = send_from_directory(OUTPUT_DIR, name, max_age=24 * 3600)
+        response.headers['Vary'] = 'Accept'
+        return response
     except Exception as e:
-        print(f"\n ERROR: {e}")
         traceback.print_exc()
         return jsonify({'success': False, 'error': str(e)}), 500
 
+
+@app.route('/api/jobs/<job_id>', methods=['DELETE'])
+def cancel_job(job_id):
+    """
+    Give up the caller's share of a render; once no client holds it, it is
+    cancelled and stops at the next denoising step
+    """
+    job = job_manager.get(job_id)
+    if not job:
+        return jsonify({'success': False, 'error': 'Job not found'}), 404
+    client = job_client(job)
+    if not job.held_by(client):
+        return jsonify({'success': False, 'error': 'Not allowed'}), 403
+    job = job_manager.cancel(job_id, client)
+    return jsonify(dict(job.to_dict(), success=True, cancel_requested=job.cancel_event.is_set())), 202
+
+
+# Reconnecting EventSource clients get this long before their job is cancelled
+DISCONNECT_GRACE_S = 5.0
+
+
+def cancel_if_abandoned(job, client):
+    """
+    Give up client's share of a job once nobody is watching it any more.
+    Deduplicated jobs are shared, so this only cancels the render when no
+    other client still holds it.
+    """
+    def check():
+        if not job.finished and not job.watched and job.held_by(client):
+            print(f" Client disconnected - releasing job {job.id}")
+            metrics.incr('jobs_abandoned')
+            job_manager.cancel(job.id, client)
+    threading.Timer(DISCONNECT_GRACE_S, check).start()
+
+
+@app.route('/api/jobs/<job_id>/events', methods=['GET'])
+def stream_job_events(job_id):
+    """Server-Sent Events: stage transitions, step progress with ETA, optional latent previews"""
+    job = job_manager.get(job_id)
+    if not job:
+        return jsonify({'success': False, 'error': 'Job not found'}), 404
+
+    try:
+        last_id = int(request.headers.get('Last-Event-ID') or request.args.get('last_event_id') or 0)
+    except ValueError:
+        last_id = 0
+
+    cancel_on_disconnect = request.args.get('cancel_on_disconnect', '1') != '0'
+    client = job_client(job)
+
+    def stream():
+        nonlocal last_id
+        job.attach('subscribers')
+        try:
+            # current state first so late subscribers can catch up
+            yield f"event: status\ndata: {json.dumps(job.to_dict())}\n\n"
+            while True:
+                events = job.events_since(last_id, timeout=5.0)
+                if not events:
+                    if job.finished:
+                        return
+                    # keepalives also surface a closed connection within a few seconds
+                    yield ": keepalive\n\n"
+                    continue
+                for event_id, event, data in events:
+                    last_id = event_id
+                    yield f"id: {event_id}\nevent: {event}\ndata: {json.dumps(data)}\n\n"
+        finally:
+            # GeneratorExit lands here when the client goes away
+            job.detach('subscribers')
+            if cancel_on_disconnect and not job.finished:
+                cancel_if_abandoned(job, client)
+
+    return Response(stream_with_context(stream()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@app.route('/api/metrics', methods=['GET'])
+def get_metrics():
+    snapshot = metrics.snapshot()
+    snapshot['user_queue_depth'] = job_manager.scheduler.user_depths()
+    snapshot['job_store'] = job_store.counts()
+    return jsonify(snapshot), 200
+
+
+# Browsers downscale photos to this before uploading - renders work at
+# 512px and detection at 640px, so larger uploads only cost transfer and decode
+MAX_UPLOAD_DIM = 1024
+UPLOAD_FORMATS = ['image/webp', 'image/jpeg']
+UPLOAD_QUALITY = 0.85
+# Already-small JPEG/WebP files under this size are sent as they are
+UPLOAD_PASSTHROUGH_BYTES = 1024 * 1024
+
+
 @app.route('/api/config', methods=['GET'])
 def get_config():
     return jsonify({
-        "api_base": request.host_url.rstrip('/')
+        "api_base": request.host_url.rstrip('/'),
+        "upload": {
+            "max_dim": MAX_UPLOAD_DIM,
+            "formats": UPLOAD_FORMATS,
+            "quality": UPLOAD_QUALITY,
+            "passthrough_bytes": UPLOAD_PASSTHROUGH_BYTES
+        }
     })
 
 if __name__ == '__main__':
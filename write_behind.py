@@ -0,0 +1,198 @@
+"""
+write_behind.py - Batched write-behind queue
+Requests hand non-critical rows to the queue and return at once; a
+background thread commits them in batches, so a burst of saves costs a
+few transactions (and a few SQLite write locks) instead of one each.
+Errors the caller marks as permanent (a bad row, e.g. IntegrityError) make
+the batch be written again one item at a time, so a bad item only drops
+itself. Any other error (a locked database, a full disk) keeps the whole
+batch queued and retries it with exponential backoff - nothing is dropped.
+close() drains whatever is still queued - register it with atexit so a
+normal shutdown never drops accepted writes.
+"""
+
+import threading
+import time
+import traceback
+from metrics import metrics
+
+
+class WriteBehindQueue:
+    """Collects items and calls flush(batch) from one background thread"""
+
+    def __init__(self, flush, name='write_behind', max_batch=200, max_delay_s=0.5, max_backoff_s=30.0,
+                 permanent=()):
+        """
+        Args:
+            flush: Called with a list of items; raising keeps the batch queued for a retry
+            max_batch: Largest batch per flush call
+            max_delay_s: Longest an item waits before it is flushed
+            max_backoff_s: Longest wait between retries after a transient failure
+            permanent: Exception types that mean an item can never be written -
+                the batch is split and only the failing items are dropped (and logged)
+        """
+        self.flush_fn = flush
+        self.name = name
+        self.max_batch = max_batch
+        self.max_delay_s = max_delay_s
+        self.max_backoff_s = max_backoff_s
+        self.permanent = tuple(permanent)
+        self.items = []
+        self.failures = 0  # transient failures in a row
+        self.retry_at = 0.0
+        self.closed = False
+        self.cond = threading.Condition()
+        self.flush_lock = threading.Lock()
+        self.thread = threading.Thread(target=self._loop, name=name, daemon=True)
+        self.thread.start()
+
+    def put(self, item):
+        with self.cond:
+            if self.closed:
+                raise RuntimeError(f"{self.name} is closed")
+            self.items.append(item)
+            metrics.set_gauge('write_behind_depth', len(self.items), queue=self.name)
+            if len(self.items) >= self.max_batch:
+                self.cond.notify()
+
+    def depth(self):
+        with self.cond:
+            return len(self.items)
+
+    def _loop(self):
+        while True:
+            with self.cond:
+                if not self.items and not self.closed:
+                    self.cond.wait()
+                if self.closed:
+                    return  # close() flushes the rest
+                # after a transient failure, wait out the backoff
+                while time.time() < self.retry_at and not self.closed:
+                    self.cond.wait(self.retry_at - time.time())
+                # let a batch accumulate, unless it is already full
+                deadline = time.time() + self.max_delay_s
+                while len(self.items) < self.max_batch and not self.closed:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        break
+                    self.cond.wait(remaining)
+            self.flush()
+
+    def flush(self):
+        """Write everything queued now, in batches; returns the number of items written"""
+        written = 0
+        with self.flush_lock:
+            while True:
+                with self.cond:
+                    batch = self.items[:self.max_batch]
+                if not batch:
+                    return written
+                started = time.time()
+                try:
+                    self.flush_fn(batch)
+                    kept, dropped = [], 0
+                except self.permanent:
+                    traceback.print_exc()
+                    metrics.incr('write_behind_errors', queue=self.name)
+                    kept, dropped = self._flush_singly(batch)
+                except Exception as e:
+                    # lock contention or I/O trouble - splitting the batch would only add contention
+                    print(f"⚠️  {self.name}: batch of {len(batch)} failed: {e}")
+                    metrics.incr('write_behind_errors', queue=self.name)
+                    kept, dropped = batch, 0
+                done = len(batch) - len(kept) - dropped
+                if done:
+                    written += done
+                    metrics.observe('write_behind_batch_size', done, queue=self.name)
+                    metrics.observe('write_behind_flush_seconds', time.time() - started, queue=self.name)
+
+                with self.cond:
+                    self.items[:len(batch)] = kept
+                    metrics.set_gauge('write_behind_depth', len(self.items), queue=self.name)
+                    if kept:
+                        self.failures += 1
+                        delay = min(self.max_backoff_s, self.max_delay_s * 2 ** self.failures)
+                        self.retry_at = time.time() + delay
+                    else:
+                        self.failures = 0
+                        self.retry_at = 0.0
+                if kept:
+                    print(f"⚠️  {self.name}: retrying {len(kept)} item(s) in {delay:.1f}s")
+                    return written
+
+    def _flush_singly(self, batch):
+        """
+        Write a batch that hit a permanent error one item at a time; drops the
+        items that fail permanently. Returns (items kept for a retry, items dropped)
+        """
+        dropped = 0
+        for i, item in enumerate(batch):
+            try:
+                self.flush_fn([item])
+            except self.permanent as e:
+                print(f"❌ {self.name}: dropping an item that cannot be written ({e}): {item!r}")
+                metrics.incr('write_behind_dropped', queue=self.name)
+                dropped += 1
+            except Exception as e:
+                print(f"⚠️  {self.name}: write failed, keeping the rest for a retry: {e}")
+                return batch[i:], dropped
+        return [], dropped
+
+    def close(self, timeout=10.0):
+        """Stop accepting items and flush the rest before returning"""
+        with self.cond:
+            self.closed = True
+            self.cond.notify()
+        self.thread.join(timeout)
+        remaining = self.flush()
+        if self.depth():
+            print(f"⚠️  {self.name}: {self.depth()} item(s) could not be written at shutdown")
+        return remaining
+
+
+# Test
+if __name__ == "__main__":
+    written = []
+    queue = WriteBehindQueue(lambda batch: written.extend(batch), max_batch=50, max_delay_s=0.2)
+    started = time.time()
+    threads = [threading.Thread(target=lambda n=n: [queue.put((n, i)) for i in range(100)]) for n in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    print(f"   Queued 800 items in {(time.time() - started) * 1000:.1f} ms")
+    queue.close()
+    assert len(written) == 800, len(written)
+
+    def strict_flush(batch):
+        if any(item is None for item in batch):
+            raise ValueError("NOT NULL constraint failed")
+        written.extend(batch)
+
+    written.clear()
+    queue = WriteBehindQueue(strict_flush, name='strict', max_batch=50, max_delay_s=0.05, permanent=(ValueError,))
+    for i in range(100):
+        queue.put(None if i == 10 else i)
+    queue.close()
+    assert sorted(written) == [i for i in range(100) if i != 10], len(written)
+    print(f"   One bad item in a batch: {len(written)} of 100 written, the bad one dropped")
+
+    calls = []
+
+    def locked_flush(batch):
+        calls.append(len(batch))
+        if len(calls) <= 3:
+            raise RuntimeError("database is locked")
+        written.extend(batch)
+
+    written.clear()
+    queue = WriteBehindQueue(locked_flush, name='locked', max_batch=50, max_delay_s=0.05, permanent=(ValueError,))
+    for i in range(50):
+        queue.put(i)
+    deadline = time.time() + 5
+    while len(written) < 50 and time.time() < deadline:
+        time.sleep(0.05)
+    queue.close()
+    assert sorted(written) == list(range(50)) and calls == [50, 50, 50, 50], calls
+    print(f"   Locked database: batch retried whole with backoff ({len(calls)} attempts), nothing dropped")
+    print(f"✅ Flushed {len(written)} items: {metrics.snapshot()['timings']}")